@@ -0,0 +1,184 @@
+"""
+alerts.py
+
+Incremental district threshold alerts.
+
+utils keeps a district_daily_counts table up to date on every add_case /
+add_cases_bulk (inside the same transaction), so a district's rolling count over
+alerts.recent_days is a range sum over at most recent_days primary-key rows,
+independent of the size of the cases table. After each write the touched
+districts are evaluated against alerts.district_thresholds (falling back to
+alerts.high_activity_threshold):
+
+    count >= threshold and no open episode  -> open episode, 'fired' event, notification queued
+    count <  threshold and an open episode  -> close episode, 'cleared' event
+
+Episode state lives in alert_state and every transition in alert_events, so an
+episode fires exactly once however many cases arrive while it is open. Because
+windows also move with the calendar, evaluate() with no districts sweeps every
+district (run it daily, e.g. `python alerts.py --sweep`).
+
+`python alerts.py --check` recomputes the counters from the raw cases table and
+reports mismatches; `--rebuild` replaces them.
+"""
+import argparse
+from datetime import date, datetime, timedelta
+
+import pandas as pd
+
+from settings import load_config
+from utils import CONFIG, _archived_fields, _rebuild_daily_counts, connection, init_db, onset_day, transaction
+
+
+def window_bounds(today=None, recent_days=7):
+    """(first_day, last_day) ISO strings of the rolling window ending today."""
+    today = today or date.today()
+    return (today - timedelta(days=recent_days - 1)).isoformat(), today.isoformat()
+
+
+def rolling_counts(conn, districts=None, today=None, recent_days=7):
+    """{district: cases in the window} from the daily counters."""
+    start, end = window_bounds(today, recent_days)
+    sql = "SELECT district, SUM(cases) FROM district_daily_counts WHERE day BETWEEN ? AND ?"
+    params = [start, end]
+    if districts is not None:
+        districts = list(districts)
+        counts = {}
+        for i in range(0, len(districts), 500):
+            chunk = districts[i:i + 500]
+            counts.update(conn.execute(sql + f" AND district IN ({','.join('?' * len(chunk))}) GROUP BY district",
+                                       params + chunk).fetchall())
+        return counts
+    return dict(conn.execute(sql + " GROUP BY district", params).fetchall())
+
+
+def _notify(events, config):
+    if not config.notifications.enabled:
+        return
+    from notifications import enqueue_alert
+    for e in events:
+        if e["kind"] == "fired":
+            enqueue_alert(f"Surveilai alert: {e['district']}",
+                          f"{e['count']} cases in {e['district']} between {e['window_start']} and "
+                          f"{e['window_end']} (threshold {e['threshold']:g}).", config)
+
+
+def evaluate(districts=None, today=None, config=None):
+    """
+    Update alert state for the given districts (all known districts when None).
+    Returns the list of events (dicts) produced by this call.
+    """
+    config = config or load_config(CONFIG)
+    alerts = config.alerts
+    today = today or date.today()
+    start, end = window_bounds(today, alerts.recent_days)
+    now = datetime.now().isoformat(timespec="seconds")
+    events = []
+    with transaction() as conn:
+        counts = rolling_counts(conn, districts, today, alerts.recent_days)
+        if districts is None:
+            state = {r[0]: r[1:] for r in conn.execute("SELECT district, active, episode FROM alert_state")}
+            districts = set(counts) | set(state)
+        else:
+            districts = list(districts)
+            state = {}
+            for i in range(0, len(districts), 500):
+                chunk = districts[i:i + 500]
+                state.update({r[0]: r[1:] for r in conn.execute(
+                    f"SELECT district, active, episode FROM alert_state WHERE district IN ({','.join('?' * len(chunk))})",
+                    chunk)})
+        for district in districts:
+            count = counts.get(district, 0) or 0
+            threshold = alerts.threshold_for(district)
+            active, episode = state.get(district, (0, 0))
+            kind = None
+            if count >= threshold and not active:
+                kind, active, episode = "fired", 1, episode + 1
+            elif count < threshold and active:
+                kind, active = "cleared", 0
+            conn.execute(
+                """INSERT INTO alert_state (district, active, episode, count, threshold, fired_at, cleared_at, updated_at)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                   ON CONFLICT (district) DO UPDATE SET active = excluded.active, episode = excluded.episode,
+                       count = excluded.count, threshold = excluded.threshold,
+                       fired_at = COALESCE(excluded.fired_at, fired_at),
+                       cleared_at = COALESCE(excluded.cleared_at, cleared_at), updated_at = excluded.updated_at""",
+                (district, active, episode, count, threshold, now if kind == "fired" else None,
+                 now if kind == "cleared" else None, now))
+            if kind:
+                event = {"district": district, "episode": episode, "kind": kind, "count": count,
+                         "threshold": threshold, "window_start": start, "window_end": end, "created_at": now}
+                conn.execute("INSERT INTO alert_events (district, episode, kind, count, threshold, window_start, "
+                             "window_end, created_at) VALUES (:district, :episode, :kind, :count, :threshold, "
+                             ":window_start, :window_end, :created_at)", event)
+                events.append(event)
+        # queued in the same transaction, so a rolled-back write never notifies
+        _notify(events, config)
+    return events
+
+
+def on_cases_written(conn, districts):
+    """Hook called by utils inside the writing transaction with the districts whose counters changed."""
+    return evaluate(districts)
+
+
+def active_alerts():
+    with connection() as conn:
+        return pd.read_sql_query("SELECT district, episode, count, threshold, fired_at FROM alert_state "
+                                 "WHERE active = 1 ORDER BY count DESC", conn)
+
+
+def recent_events(limit=50):
+    with connection() as conn:
+        return pd.read_sql_query("SELECT * FROM alert_events ORDER BY id DESC LIMIT ?", conn, params=(limit,))
+
+
+def rebuild_counters(check_only=False):
+    """
+    Recompute district daily counts from the raw cases (hot table and archive) and
+    compare with the stored counters. Returns a DataFrame of mismatches (empty when consistent);
+    unless check_only is set the counters are then replaced.
+    """
+    with transaction() as conn:
+        expected = {}
+        for onset, district, n in conn.execute(
+                "SELECT onset_date, district, COUNT(*) FROM cases GROUP BY onset_date, district"):
+            day = onset_day(onset)
+            if district and day:
+                expected[(district, day)] = expected.get((district, day), 0) + n
+        for onset, district, _, _ in _archived_fields(conn):
+            day = onset_day(onset)
+            if district and day:
+                expected[(district, day)] = expected.get((district, day), 0) + 1
+        stored = {(d, day): n for d, day, n in conn.execute("SELECT district, day, cases FROM district_daily_counts")}
+        diffs = [k + (stored.get(k, 0), expected.get(k, 0)) for k in set(stored) | set(expected)
+                 if stored.get(k, 0) != expected.get(k, 0)]
+        if not check_only:
+            _rebuild_daily_counts(conn)
+    return pd.DataFrame(sorted(diffs), columns=["district", "day", "stored", "expected"])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Evaluate and verify district threshold alerts")
+    parser.add_argument("--sweep", action="store_true", help="re-evaluate every district against today's window")
+    parser.add_argument("--check", action="store_true", help="verify counters against the cases table")
+    parser.add_argument("--rebuild", action="store_true", help="recompute counters from the cases table")
+    args = parser.parse_args(argv)
+    init_db()
+    status = 0
+    if args.check or args.rebuild:
+        diffs = rebuild_counters(check_only=not args.rebuild)
+        if diffs.empty:
+            print("Alert counters are consistent with the cases table.")
+        else:
+            print(f"{len(diffs)} mismatched district-days" + (" (rebuilt)." if args.rebuild else ":"))
+            print(diffs.head(20).to_string(index=False))
+            status = 0 if args.rebuild else 1
+    if args.sweep or not (args.check or args.rebuild):
+        for e in evaluate():
+            print(f"{e['kind']}: {e['district']} ({e['count']} cases, threshold {e['threshold']:g})")
+    return status
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
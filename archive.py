@@ -0,0 +1,255 @@
+"""
+archive.py
+
+Tiered case storage: closed epiweeks move from the hot SQLite cases table into a
+zstd-compressed Parquet archive partitioned by ISO year and epiweek:
+
+    case_archive/year=2024/epiweek=07/part-<id>.parquet
+
+archive_closed_weeks() moves every epiweek that ended more than KEEP_WEEKS weeks
+ago (late reports still land in recent weeks) one week per transaction: the
+week's rows are written to Parquet, deleted from cases, and the file is put in
+place before the delete commits. Rollups and alert counters are totals and keep
+counting archived cases; the deletes leave tombstones, so load_cases() drops
+them from the dashboard frame. Archived ids are kept in archived_cases and
+utils refuses to insert them again.
+
+query_cases() (and utils.query_summary) read the hot table and the archive as one
+set. Date filters prune whole partitions before any file is opened. If a run is
+interrupted between the file landing and the delete committing, the hot copy of
+a case wins over its archived duplicate.
+
+Usage:
+    python archive.py                 # archive closed weeks, keeping 8 weeks hot
+    python archive.py --keep-weeks 12
+    python archive.py --stats
+"""
+import argparse
+import os
+import uuid
+from datetime import date, timedelta
+
+import pandas as pd
+
+from export import arrow_table, build_query, pq
+from utils import CASE_COLUMNS, connection, init_db, read_snapshot, transaction, _type_cases
+
+ARCHIVE_DIR = os.environ.get("SURVEILAI_ARCHIVE_DIR", os.path.join(os.path.dirname(__file__), "case_archive"))
+KEEP_WEEKS = 8
+
+
+def _require_pyarrow():
+    if pq is None:
+        raise ValueError("The case archive requires pyarrow (pip install pyarrow)")
+
+
+def week_start(year, week):
+    return date.fromisocalendar(year, week, 1)
+
+
+def partition_dir(year, week, root=None):
+    return os.path.join(root or ARCHIVE_DIR, f"year={year}", f"epiweek={week:02d}")
+
+
+def partitions(root=None):
+    """[(year, epiweek, directory)] of every archive partition, oldest first."""
+    root = root or ARCHIVE_DIR
+    found = []
+    if not os.path.isdir(root):
+        return found
+    for ydir in os.listdir(root):
+        if not ydir.startswith("year="):
+            continue
+        for wdir in os.listdir(os.path.join(root, ydir)):
+            if wdir.startswith("epiweek="):
+                found.append((int(ydir[5:]), int(wdir[8:]), os.path.join(root, ydir, wdir)))
+    return sorted(found)
+
+
+def _as_date(value):
+    return None if value is None else date.fromisoformat(str(value)[:10])
+
+
+def prune(parts, start=None, end=None):
+    """Partitions whose week overlaps the inclusive [start, end] date range."""
+    start, end = _as_date(start), _as_date(end)
+    kept = []
+    for year, week, path in parts:
+        first = week_start(year, week)
+        if (end is None or first <= end) and (start is None or first + timedelta(days=6) >= start):
+            kept.append((year, week, path))
+    return kept
+
+
+def _files(path):
+    return sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith(".parquet"))
+
+
+# ---------- archiving ----------
+def closed_weeks(keep_weeks=KEEP_WEEKS, today=None):
+    """ISO (year, week) pairs in the hot table that ended before the keep window."""
+    today = today or date.today()
+    cutoff = today - timedelta(days=today.weekday()) - timedelta(weeks=keep_weeks)
+    with connection() as conn:
+        days = [r[0] for r in conn.execute(
+            "SELECT DISTINCT substr(onset_date, 1, 10) FROM cases WHERE onset_date < ?", (cutoff.isoformat(),))]
+    weeks = set()
+    for day in days:
+        try:
+            iso = date.fromisoformat(day).isocalendar()
+        except (TypeError, ValueError):
+            continue  # unparseable dates stay hot
+        weeks.add((iso[0], iso[1]))
+    return sorted(weeks)
+
+
+def archive_week(year, week, root=None):
+    """Move one epiweek from cases into the archive; returns the number of rows moved."""
+    _require_pyarrow()
+    first = week_start(year, week)
+    bounds = (first.isoformat(), (first + timedelta(days=7)).isoformat())
+    where = "onset_date >= ? AND onset_date < ?"
+    directory = partition_dir(year, week, root)
+    final = os.path.join(directory, f"part-{uuid.uuid4().hex}.parquet")
+    tmp = final + ".tmp"
+    try:
+        with transaction() as conn:
+            rows = conn.execute(f"SELECT {', '.join(CASE_COLUMNS)} FROM cases WHERE {where}", bounds).fetchall()
+            if not rows:
+                return 0
+            os.makedirs(directory, exist_ok=True)
+            with open(tmp, "wb") as f:
+                pq.write_table(arrow_table(rows), f, compression="zstd")
+                f.flush()
+                os.fsync(f.fileno())
+            # archived ids stay reserved, so a re-sent case is not inserted (and counted) again
+            conn.executemany("INSERT OR IGNORE INTO archived_cases (case_id, year, epiweek) VALUES (?, ?, ?)",
+                             [(r[0], year, week) for r in rows])
+            conn.execute(f"DELETE FROM cases WHERE {where}", bounds)
+            os.replace(tmp, final)
+    except BaseException:
+        for path in (tmp, final):
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+    return len(rows)
+
+
+def index_archived_ids(conn, root=None):
+    """Record the id of every case already in the archive in archived_cases; returns the number of ids."""
+    count = 0
+    if pq is None:
+        return count
+    for year, week, path in partitions(root):
+        for f in _files(path):
+            ids = pq.read_table(f, columns=["case_id"]).column("case_id").to_pylist()
+            conn.executemany("INSERT OR IGNORE INTO archived_cases (case_id, year, epiweek) VALUES (?, ?, ?)",
+                             [(i, year, week) for i in ids])
+            count += len(ids)
+    return count
+
+
+def archive_closed_weeks(keep_weeks=KEEP_WEEKS, today=None, root=None):
+    """Archive every closed epiweek; returns {"weeks": n, "rows": n}."""
+    moved = {"weeks": 0, "rows": 0}
+    for year, week in closed_weeks(keep_weeks, today):
+        n = archive_week(year, week, root)
+        if n:
+            moved["weeks"] += 1
+            moved["rows"] += n
+    return moved
+
+
+# ---------- reading ----------
+def _row_filters(start=None, end=None, districts=None, classifications=None):
+    filters = []
+    if start is not None:
+        filters.append(("onset_date", ">=", str(start)[:10]))
+    if end is not None:
+        filters.append(("onset_date", "<", (_as_date(end) + timedelta(days=1)).isoformat()))
+    if districts:
+        filters.append(("district", "in", list(districts)))
+    if classifications:
+        filters.append(("classification", "in", list(classifications)))
+    return filters or None
+
+
+def iter_archive_tables(start=None, end=None, districts=None, classifications=None, columns=None, root=None):
+    """Yield one Arrow table per archive file in the pruned partitions, rows filtered."""
+    if pq is None:
+        return
+    filters = _row_filters(start, end, districts, classifications)
+    for _, _, path in prune(partitions(root), start, end):
+        for f in _files(path):
+            table = pq.read_table(f, columns=columns, filters=filters)
+            if table.num_rows:
+                yield table
+
+
+def _hot_ids(conn, case_ids):
+    found = set()
+    for i in range(0, len(case_ids), 500):
+        chunk = case_ids[i:i + 500]
+        found.update(r[0] for r in conn.execute(
+            f"SELECT case_id FROM cases WHERE case_id IN ({','.join('?' * len(chunk))})", chunk))
+    return found
+
+
+def iter_archive_rows(conn, chunk_rows=10000, start=None, end=None, districts=None, classifications=None, root=None):
+    """Archived rows as CASE_COLUMNS tuples (in chunks), skipping cases still present in the hot table."""
+    for table in iter_archive_tables(start, end, districts, classifications, root=root):
+        for batch in table.to_batches(chunk_rows):
+            rows = list(zip(*(col.to_pylist() for col in batch.columns)))
+            hot = _hot_ids(conn, [r[0] for r in rows])
+            rows = [r for r in rows if r[0] not in hot] if hot else rows
+            if rows:
+                yield rows
+
+
+def archived_fields(conn, columns=("onset_date", "district", "sex", "age"), root=None):
+    """Yield tuples of the given columns for every archived case (used when rebuilding counters)."""
+    for rows in iter_archive_rows(conn, root=root):
+        idx = [CASE_COLUMNS.index(c) for c in columns]
+        for r in rows:
+            yield tuple(r[i] for i in idx)
+
+
+def query_cases(start=None, end=None, districts=None, classifications=None, include_archive=True, root=None):
+    """Hot and archived cases as one typed DataFrame, filtered on onset date, district and classification."""
+    sql, params = build_query(start, end, districts, classifications)
+    with connection() as conn:
+        with read_snapshot(conn):
+            frames = [pd.read_sql_query(sql, conn, params=params)]
+            if include_archive:
+                frames += [pd.DataFrame.from_records(rows, columns=CASE_COLUMNS)
+                           for rows in iter_archive_rows(conn, start=start, end=end, districts=districts,
+                                                          classifications=classifications, root=root)]
+    frames = [f for f in frames if not f.empty] or frames[:1]
+    return _type_cases(pd.concat(frames, ignore_index=True))
+
+
+def archive_stats(root=None):
+    _require_pyarrow()
+    parts = partitions(root)
+    rows = sum(pq.ParquetFile(f).metadata.num_rows for _, _, p in parts for f in _files(p))
+    size = sum(os.path.getsize(f) for _, _, p in parts for f in _files(p))
+    return {"partitions": len(parts), "rows": rows, "bytes": size,
+            "first": f"{parts[0][0]}-W{parts[0][1]:02d}" if parts else None,
+            "last": f"{parts[-1][0]}-W{parts[-1][1]:02d}" if parts else None}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Move closed epiweeks from surveilai.db into the Parquet archive")
+    parser.add_argument("--keep-weeks", type=int, default=KEEP_WEEKS, help="recent weeks kept in the hot table")
+    parser.add_argument("--stats", action="store_true", help="only print archive statistics")
+    args = parser.parse_args(argv)
+    init_db()
+    if not args.stats:
+        moved = archive_closed_weeks(args.keep_weeks)
+        print(f"Archived {moved['rows']} cases from {moved['weeks']} epiweek(s).")
+    print(archive_stats())
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
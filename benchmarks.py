@@ -0,0 +1,248 @@
+"""
+benchmarks.py
+
+Benchmark suite for the hot paths, run against a throwaway database filled by
+synthetic.py. Each benchmark reports the median of several repeats (seconds per
+call, or per case for the per-row ones) and is compared with the stored
+baselines in benchmark_baselines.json:
+
+    regression = median > baseline * (1 + tolerance)  and  median - baseline > noise floor
+
+Any regression makes the run exit with status 1. Baselines are machine specific:
+record them once on the machine that runs the suite with --update-baselines, and
+re-record after an intentional change in cost.
+
+Usage:
+    python benchmarks.py                      # compare with benchmark_baselines.json
+    python benchmarks.py --rows 200000 --only query_summary --only classify
+    python benchmarks.py --update-baselines
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+import archive
+import utils
+from settings import load_config
+from synthetic import generate_cases, synthetic_districts
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baselines.json")
+ROWS = 50000
+DISTRICTS = 260
+REPEAT = 5
+TOLERANCE = 0.5      # allowed slowdown before a benchmark counts as a regression
+NOISE_FLOOR = 0.002  # seconds; differences below this are timer noise
+
+
+def measure(fn, repeat=REPEAT, per=1):
+    """Median wall time of fn() over repeat runs after one untimed warm-up, divided by per (items handled)."""
+    fn()
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - started) / per)
+    return statistics.median(times)
+
+
+class Workload:
+    """Synthetic cases and polygons loaded into a temporary database."""
+
+    def __init__(self, rows=ROWS, districts=DISTRICTS, seed=0):
+        self.dir = tempfile.mkdtemp(prefix="surveilai-bench-")
+        self._saved = (utils.DB, utils.CONFIG, archive.ARCHIVE_DIR)
+        shutil.copy(utils.CONFIG, os.path.join(self.dir, "config.yaml"))
+        utils.DB = os.path.join(self.dir, "bench.db")
+        utils.CONFIG = os.path.join(self.dir, "config.yaml")
+        archive.ARCHIVE_DIR = os.path.join(self.dir, "case_archive")
+        utils.init_db()
+        self.districts = synthetic_districts(districts, seed=seed)
+        self.cases = generate_cases(rows, self.districts, seed=seed)
+        # extra rows for the per-row insert benchmarks, with ids that do not collide
+        self.spare = generate_cases((REPEAT + 1) * 200, self.districts, seed=seed + 1)
+        self.spare["case_id"] = "B" + self.spare["case_id"].str[1:]
+        self.records = self.cases[utils.CASE_COLUMNS].to_dict("records")
+        self.model_path = os.path.join(self.dir, "no_model.txt")  # missing: naive scoring
+
+    def close(self):
+        utils.close_pool()
+        utils.invalidate_cases()
+        utils.DB, utils.CONFIG, archive.ARCHIVE_DIR = self._saved
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+# ---------- benchmarks ----------
+# Each takes the Workload and returns {name: seconds}.
+
+def bench_insert(w):
+    started = time.perf_counter()
+    utils.add_cases_bulk(w.records)
+    results = {"add_cases_bulk_per_case": (time.perf_counter() - started) / len(w.records)}
+    spare = iter(w.spare[utils.CASE_COLUMNS].to_dict("records"))
+    results["add_case"] = measure(lambda: [utils.add_case(next(spare)) for _ in range(200)], per=200)
+    return results
+
+
+def bench_query_summary(w):
+    days = pd.to_datetime(w.cases["onset_date"])
+    end = days.max()
+    return {
+        "query_summary_all": measure(lambda: utils.query_summary(), repeat=3),
+        "query_summary_4_weeks": measure(lambda: utils.query_summary(end - pd.Timedelta(days=27), end)),
+    }
+
+
+def bench_geo(w):
+    sample = w.cases.sample(1000, random_state=0)
+    lats, lons = sample["lat"].tolist(), sample["lon"].tolist()
+    utils.assign_district_from_point(lats[0], lons[0], w.districts)  # build the index once
+    return {
+        "assign_district_from_point": measure(
+            lambda: [utils.assign_district_from_point(a, b, w.districts) for a, b in zip(lats, lons)], per=len(lats)),
+        "assign_districts_per_point": measure(
+            lambda: utils.assign_districts(w.cases["lat"], w.cases["lon"], w.districts), per=len(w.cases)),
+    }
+
+
+def bench_clustering(w):
+    recent = w.cases.sort_values("onset_date").tail(10000)[["lat", "lon", "onset_date"]]
+    recent = recent.assign(onset_date=pd.to_datetime(recent["onset_date"]))
+    return {
+        "cluster_epicenters_10k": measure(lambda: utils.cluster_epicenters(recent[["lat", "lon"]]), repeat=3),
+        "cluster_epicenters_st_10k": measure(
+            lambda: utils.cluster_epicenters(recent, time_window_days=14, eps_days=3), repeat=3),
+    }
+
+
+def bench_classify(w):
+    entries = w.cases.head(5000).to_dict("records")
+    frame = w.cases[["symptoms", "lab_positive"]]
+    rules = load_config(utils.CONFIG).classification_rules
+    return {
+        "classify_case": measure(lambda: [utils.classify_case(e, rules) for e in entries], per=len(entries)),
+        "classify_cases_per_case": measure(lambda: utils.classify_cases(frame, rules), per=len(frame)),
+    }
+
+
+def bench_scoring(w):
+    import score_districts  # imports the model server; only needed here
+    return {"score_districts_backfill": measure(
+        lambda: score_districts.run("backfill", model_path=w.model_path), repeat=3)}
+
+
+def bench_dashboard(w):
+    from alerts import active_alerts  # alerts imports utils
+
+    def render():
+        utils.query_rollups(("year", "epiweek"))
+        utils.query_rollups(("sex",))
+        utils.query_rollups(("age_band",))
+        active_alerts()
+        utils.query_district_scores("latest")
+
+    utils.invalidate_cases()
+    results = {"load_cases_cold": measure(lambda: (utils.invalidate_cases(), utils.load_cases()), repeat=3)}
+    results["load_cases_warm"] = measure(utils.load_cases)
+    results["dashboard_aggregations"] = measure(render)
+    return results
+
+
+BENCHMARKS = {
+    "insert": bench_insert,
+    "query_summary": bench_query_summary,
+    "geo": bench_geo,
+    "clustering": bench_clustering,
+    "classify": bench_classify,
+    "scoring": bench_scoring,
+    "dashboard": bench_dashboard,
+}
+
+
+def run(rows=ROWS, districts=DISTRICTS, only=None):
+    """Run the selected benchmark groups (all by default, insert always first); returns {name: seconds}."""
+    w = Workload(rows, districts)
+    results = {}
+    try:
+        for group, fn in BENCHMARKS.items():
+            # later groups need the loaded database, so the insert group always runs
+            if only and group not in only and group != "insert":
+                continue
+            results.update(fn(w))
+    finally:
+        w.close()
+    return results
+
+
+# ---------- baselines ----------
+def load_baselines(path=BASELINES):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baselines(results, rows, path=BASELINES):
+    data = {"rows": rows, "python": platform.python_version(), "machine": platform.machine(),
+            "recorded": time.strftime("%Y-%m-%d"), "seconds": {k: round(v, 9) for k, v in sorted(results.items())}}
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f, indent=2)
+        f.write("\n")
+    os.replace(tmp, path)
+
+
+def compare(results, baselines, tolerance=TOLERANCE, noise_floor=NOISE_FLOOR):
+    """DataFrame of benchmark, baseline, current, ratio, status (ok / REGRESSION / new)."""
+    stored = baselines.get("seconds", {})
+    rows = []
+    for name, current in results.items():
+        base = stored.get(name)
+        if base is None:
+            rows.append((name, None, current, None, "new"))
+            continue
+        ratio = current / base if base else float("inf")
+        bad = current > base * (1 + tolerance) and current - base > noise_floor
+        rows.append((name, base, current, ratio, "REGRESSION" if bad else "ok"))
+    return pd.DataFrame(rows, columns=["benchmark", "baseline", "current", "ratio", "status"])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark surveilai hot paths against stored baselines")
+    parser.add_argument("--rows", type=int, default=ROWS, help="synthetic cases loaded before timing")
+    parser.add_argument("--districts", type=int, default=DISTRICTS)
+    parser.add_argument("--only", action="append", choices=sorted(BENCHMARKS), help="run only this group (repeatable)")
+    parser.add_argument("--baselines", default=BASELINES)
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE, help="allowed slowdown, e.g. 0.5 = 50%%")
+    parser.add_argument("--update-baselines", action="store_true", help="record this run as the new baselines")
+    args = parser.parse_args(argv)
+    results = run(args.rows, args.districts, args.only)
+    baselines = load_baselines(args.baselines)
+    if args.update_baselines:
+        if args.only:
+            baselines.setdefault("seconds", {}).update(results)
+            results = baselines["seconds"]
+        save_baselines(results, args.rows, args.baselines)
+        print(f"Saved {len(results)} baselines to {args.baselines}")
+        return 0
+    if baselines.get("rows") not in (None, args.rows):
+        print(f"Warning: baselines were recorded with --rows {baselines['rows']}", file=sys.stderr)
+    report = compare(results, baselines, args.tolerance)
+    with pd.option_context("display.float_format", "{:.6f}".format):
+        print(report.to_string(index=False))
+    regressions = report[report["status"] == "REGRESSION"]
+    if not regressions.empty:
+        print(f"{len(regressions)} benchmark(s) regressed by more than {args.tolerance:.0%}.", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,341 @@
+"""
+case_server.py
+
+Asyncio HTTP endpoint for case submissions from field devices and partner systems.
+
+Requests are parsed, validated and classified (large batches in a worker thread)
+(ingest.validate_row, with the rules from config.yaml) and queued for one writer
+task. The writer waits COMMIT_INTERVAL (a few milliseconds) after the first
+queued request so concurrent submissions can join it, then writes everything
+queued in one utils.add_cases_bulk transaction (group commit), so dedup, epi
+links, rollups and alerts run once per group instead of once per case. A request
+is answered after its group has committed. When more than MAX_QUEUE_ROWS rows
+are waiting, new submissions get 429 with Retry-After.
+
+    POST /cases   one case object, a JSON list of cases, or {"cases": [...]}
+               -> 200 {"accepted": 2, "case_ids": ["3f2b9c0e6d4a4f1e9b7c2a5d8e1f0a63", "K-17"], "duplicates": ["K-17"],
+                       "rejected": [{"index": 2, "error": "onset_date is required"}]}
+                  400 when no case is valid, 429 when the queue is full
+    GET  /health -> {"queued": 0, "requests": 10, "rows": 420, "written": 418, "commits": 6, "throttled": 0}
+
+Cases without a case_id get one assigned; a case_id that already exists is
+reported in "duplicates" and left unchanged. Set SURVEILAI_INGEST_TOKEN to
+require "Authorization: Bearer <token>" on POST.
+
+Usage:
+    python case_server.py --port 8766
+"""
+import argparse
+import asyncio
+import hmac
+import json
+import os
+import urllib.request
+from collections import deque
+
+import instrumentation
+from ingest import validate_row
+from settings import load_config
+from utils import CONFIG, add_cases_bulk, init_db, transaction
+
+SERVER_HOST = os.environ.get("SURVEILAI_INGEST_HOST", "127.0.0.1")
+SERVER_PORT = int(os.environ.get("SURVEILAI_INGEST_PORT", "8766"))
+TOKEN = os.environ.get("SURVEILAI_INGEST_TOKEN", "")
+COMMIT_INTERVAL = float(os.environ.get("SURVEILAI_INGEST_COMMIT_MS", "5")) / 1000
+MAX_QUEUE_ROWS = int(os.environ.get("SURVEILAI_INGEST_QUEUE_ROWS", "20000"))
+MAX_COMMIT_ROWS = 5000
+MAX_BATCH_ROWS = 5000
+MAX_REQUEST_BYTES = 8 * 1024 * 1024
+MAX_HEADER_BYTES = 16 * 1024
+IDLE_TIMEOUT = 30  # seconds a keep-alive connection may wait for its next request
+RETRY_AFTER = 1  # seconds suggested to throttled clients
+REASONS = {200: "OK", 400: "Bad Request", 401: "Unauthorized", 404: "Not Found", 405: "Method Not Allowed",
+           411: "Length Required", 413: "Payload Too Large", 429: "Too Many Requests",
+           431: "Request Header Fields Too Large", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+
+class QueueFull(Exception):
+    """More rows are waiting for the writer than MAX_QUEUE_ROWS."""
+
+
+# ---------- writer ----------
+def commit_group(entries):
+    """Insert validated entries in one transaction; returns 'created' or 'duplicate' per entry."""
+    with transaction() as conn:
+        ids = list({e["case_id"] for e in entries})
+        existing = set()
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            existing.update(r[0] for r in conn.execute(
+                f"SELECT case_id FROM cases WHERE case_id IN ({','.join('?' * len(chunk))})", chunk))
+        status, fresh = [], []
+        for entry in entries:
+            if entry["case_id"] in existing:
+                status.append("duplicate")
+            else:
+                existing.add(entry["case_id"])  # the first of two submissions with one id wins
+                fresh.append(entry)
+                status.append("created")
+        # the write lock is held since the lookup, so 'ignore' only guards against concurrent importers
+        add_cases_bulk(fresh, on_conflict="ignore")
+    return status
+
+
+class GroupCommitWriter:
+    """Single writer task: everything queued within one commit interval is written in one transaction."""
+
+    def __init__(self, interval=COMMIT_INTERVAL, max_queue_rows=MAX_QUEUE_ROWS, max_commit_rows=MAX_COMMIT_ROWS,
+                 commit=commit_group):
+        self.interval = interval
+        self.max_queue_rows = max_queue_rows
+        self.max_commit_rows = max_commit_rows
+        self.commit = commit
+        self.pending = deque()  # (entries, future)
+        self.queued = 0  # rows waiting or being written; bounds memory and sets the 429 threshold
+        self.stats = {"requests": 0, "rows": 0, "written": 0, "commits": 0, "throttled": 0}
+        self._wakeup = None
+        self._closing = False
+
+    def submit(self, entries):
+        """Queue entries; returns a future of their statuses. Raises QueueFull when over capacity."""
+        if self.queued and self.queued + len(entries) > self.max_queue_rows:
+            self.stats["throttled"] += 1
+            raise QueueFull()
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((entries, future))
+        self.queued += len(entries)
+        self.stats["requests"] += 1
+        self._event().set()
+        return future
+
+    def _event(self):
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        return self._wakeup
+
+    def _take(self):
+        group, rows = [], 0
+        while self.pending and (not group or rows + len(self.pending[0][0]) <= self.max_commit_rows):
+            entries, future = self.pending.popleft()
+            group.append((entries, future))
+            rows += len(entries)
+        return group, rows
+
+    async def _write(self, group, rows):
+        entries = [e for batch, _ in group for e in batch]
+        try:
+            with instrumentation.span("ingest", "group_commit"):
+                # sqlite blocks, so the transaction runs in a worker thread; only this task ever writes
+                status = await asyncio.to_thread(self.commit, entries)
+        except Exception as e:
+            for _, future in group:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            self.queued -= rows
+        self.stats["commits"] += 1
+        self.stats["rows"] += rows
+        self.stats["written"] += status.count("created")
+        offset = 0
+        for batch, future in group:
+            if not future.done():  # the client may have gone away
+                future.set_result(status[offset:offset + len(batch)])
+            offset += len(batch)
+
+    async def run(self):
+        wakeup = self._event()
+        while True:
+            if not self.pending:
+                if self._closing:
+                    return
+                wakeup.clear()
+                await wakeup.wait()
+                if not self._closing:
+                    await asyncio.sleep(self.interval)  # let concurrent submissions join this commit
+            if self.pending:
+                await self._write(*self._take())
+
+    def close(self):
+        """Stop after writing what is queued."""
+        self._closing = True
+        self._event().set()
+
+
+# ---------- HTTP ----------
+def parse_cases(body):
+    """List of raw case dicts from a request body (object, list or {"cases": [...]}); raises ValueError."""
+    try:
+        data = json.loads(body or b"null")
+    except (json.JSONDecodeError, UnicodeDecodeError) as e:
+        raise ValueError(f"invalid JSON: {e}")
+    if isinstance(data, dict) and isinstance(data.get("cases"), list):
+        data = data["cases"]
+    elif isinstance(data, dict):
+        data = [data]
+    if not isinstance(data, list) or not data:
+        raise ValueError("expected a case object, a list of cases or {\"cases\": [...]}")
+    if len(data) > MAX_BATCH_ROWS:
+        raise ValueError(f"at most {MAX_BATCH_ROWS} cases per request")
+    return data
+
+
+class CaseServer:
+    def __init__(self, writer=None, token=TOKEN, config_path=None):
+        self.writer = writer or GroupCommitWriter()
+        self.token = token
+        self.config_path = config_path or CONFIG
+
+    def validate(self, raws):
+        rules = load_config(self.config_path).classification_rules
+        accepted, rejected = [], []
+        for i, raw in enumerate(raws):
+            entry, error = validate_row(raw, rules) if isinstance(raw, dict) else (None, "case is not a JSON object")
+            if entry is None:
+                rejected.append({"index": i, "error": error})
+            else:
+                accepted.append(entry)
+        return accepted, rejected
+
+    async def handle_post(self, headers, body):
+        if self.token and not hmac.compare_digest(headers.get("authorization", ""), f"Bearer {self.token}"):
+            return 401, {"error": "missing or wrong bearer token"}, {}
+        try:
+            raws = parse_cases(body)
+        except ValueError as e:
+            return 400, {"error": str(e)}, {}
+        # large batches are validated off the event loop so other requests keep flowing
+        accepted, rejected = (await asyncio.to_thread(self.validate, raws) if len(raws) > 100
+                              else self.validate(raws))
+        if not accepted:
+            return 400, {"accepted": 0, "case_ids": [], "duplicates": [], "rejected": rejected}, {}
+        try:
+            future = self.writer.submit(accepted)
+        except QueueFull:
+            return 429, {"error": "ingest queue is full, retry later"}, {"Retry-After": str(RETRY_AFTER)}
+        try:
+            status = await future
+        except Exception as e:
+            return 503, {"error": f"cases were not saved: {e}"}, {}
+        ids = [e["case_id"] for e in accepted]
+        return 200, {"accepted": len(accepted), "case_ids": ids,
+                     "duplicates": [i for i, s in zip(ids, status) if s == "duplicate"], "rejected": rejected}, {}
+
+    async def route(self, method, path, headers, body):
+        path = path.split("?", 1)[0]
+        if path == "/health":
+            if method != "GET":
+                return 405, {"error": "use GET"}, {"Allow": "GET"}
+            return 200, dict(self.writer.stats, queued=self.writer.queued), {}
+        if path == "/cases":
+            if method != "POST":
+                return 405, {"error": "use POST"}, {"Allow": "POST"}
+            return await self.handle_post(headers, body)
+        return 404, {"error": "not found"}, {}
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), IDLE_TIMEOUT)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                    return
+                except asyncio.LimitOverrunError:
+                    await self._respond(writer, 431, {"error": "headers too large"}, {}, keep_alive=False)
+                    return
+                try:
+                    request_line, *lines = head.decode("latin-1").split("\r\n")
+                    method, path, version = request_line.split(" ", 2)
+                except ValueError:
+                    await self._respond(writer, 400, {"error": "malformed request"}, {}, keep_alive=False)
+                    return
+                headers = {}
+                for line in lines:
+                    if ":" in line:
+                        name, value = line.split(":", 1)
+                        headers[name.strip().lower()] = value.strip()
+                keep_alive = headers.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+                if "chunked" in headers.get("transfer-encoding", "").lower():
+                    await self._respond(writer, 411, {"error": "send a Content-Length"}, {}, keep_alive=False)
+                    return
+                try:
+                    length = int(headers.get("content-length") or 0)
+                except ValueError:
+                    length = -1
+                if length < 0 or length > MAX_REQUEST_BYTES:
+                    await self._respond(writer, 413, {"error": "request too large"}, {}, keep_alive=False)
+                    return
+                body = await reader.readexactly(length) if length else b""
+                try:
+                    status, payload, extra = await self.route(method.upper(), path, headers, body)
+                except Exception as e:  # never leave the client without an answer
+                    status, payload, extra = 500, {"error": str(e)}, {}
+                await self._respond(writer, status, payload, extra, keep_alive)
+                if not keep_alive:
+                    return
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _respond(writer, status, payload, extra, keep_alive):
+        body = json.dumps(payload, default=str).encode("utf-8")
+        head = [f"HTTP/1.1 {status} {REASONS.get(status, '')}", "Content-Type: application/json",
+                f"Content-Length: {len(body)}", f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+        head += [f"{k}: {v}" for k, v in extra.items()]
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body)
+        await writer.drain()
+
+
+async def start(host=SERVER_HOST, port=SERVER_PORT, server=None):
+    """Start listening and the writer task; returns (asyncio server, CaseServer, writer task)."""
+    server = server or CaseServer()
+    task = asyncio.create_task(server.writer.run())
+    listener = await asyncio.start_server(server.handle_connection, host, port, limit=MAX_HEADER_BYTES)
+    return listener, server, task
+
+
+async def _serve(host, port):
+    listener, server, task = await start(host, port)
+    print(f"Accepting cases on http://{host}:{listener.sockets[0].getsockname()[1]}/cases")
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        server.writer.close()
+        await task
+
+
+def serve(host=SERVER_HOST, port=SERVER_PORT):
+    init_db()
+    try:
+        asyncio.run(_serve(host, port))
+    except KeyboardInterrupt:
+        pass
+
+
+def submit_cases(cases, url=None, token=None, timeout=30):
+    """Client for the endpoint: POST one case dict or a list of them; returns the acknowledgement dict."""
+    url = url or f"http://{SERVER_HOST}:{SERVER_PORT}"
+    headers = {"Content-Type": "application/json"}
+    token = token if token is not None else TOKEN
+    if token:
+        headers["Authorization"] = f"Bearer {token}"
+    req = urllib.request.Request(url.rstrip("/") + "/cases", data=json.dumps(cases, default=str).encode("utf-8"),
+                                 headers=headers)
+    with urllib.request.urlopen(req, timeout=timeout) as resp:
+        return json.loads(resp.read())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Accept case submissions over HTTP with group-committed writes")
+    parser.add_argument("--host", default=SERVER_HOST)
+    parser.add_argument("--port", type=int, default=SERVER_PORT)
+    args = parser.parse_args(argv)
+    serve(args.host, args.port)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,167 @@
+"""
+classification.py
+
+Case-definition rules compiled once and applied to single cases or whole DataFrames.
+
+Rules come from config.yaml `classification_rules` (and structured per-disease
+`case_definitions`):
+
+    confirmed:  {lab_positive: true}
+    probable:   {symptoms_required: [fever, cough], epi_link_required: true}
+    suspected:  {symptoms_required_any: [fever], additional_symptoms: [chills, headache],
+                 additional_required: 0}
+
+Levels are checked in order Confirmed -> Probable -> Suspected. When the suspected
+rule is empty every remaining case is Suspected (the historical behaviour);
+otherwise cases meeting no definition are "Not a case". `additional_symptoms` are
+part of the symptom vocabulary and, with `additional_required: N`, at least N of
+them must be present as well. Case definitions given as plain text are kept as
+descriptions only; a definition given as a rule mapping is used for cases whose
+`disease` matches.
+"""
+import json
+import re
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+CONFIRMED = "Confirmed"
+PROBABLE = "Probable"
+SUSPECTED = "Suspected"
+NOT_A_CASE = "Not a case"
+
+DEFAULT_RULES = {
+    'confirmed': {'lab_positive': True},
+    'probable': {'symptoms_required': ['fever', 'cough'], 'epi_link_required': False},
+    'suspected': {},
+}
+
+_SPLIT = re.compile(r"[;,]")
+
+
+def split_symptoms(text):
+    return [s.strip().lower() for s in _SPLIT.split(text or "") if s.strip()]
+
+
+def _names(values):
+    return [str(v).strip().lower() for v in (values or []) if str(v).strip()]
+
+
+class CaseRules:
+    """Compiled form of one classification_rules mapping."""
+
+    def __init__(self, config_rules=None):
+        rules = config_rules if config_rules is not None else DEFAULT_RULES
+        conf = rules.get('confirmed') or {}
+        prob = rules.get('probable') or {}
+        susp = rules.get('suspected') or {}
+        self.confirm_on_lab = bool(conf.get('lab_positive'))
+        self.probable_all = _names(prob.get('symptoms_required'))
+        # older configs spell it out in full
+        self.probable_needs_epi = bool(prob.get('epi_link_required', prob.get('epidemiological_link_required')))
+        self.suspected_any = _names(susp.get('symptoms_required_any'))
+        self.suspected_additional = _names(susp.get('additional_symptoms'))
+        self.additional_required = int(susp.get('additional_required', 0) or 0)
+        self.suspected_open = not (self.suspected_any or self.additional_required)
+        vocab = []
+        for name in self.probable_all + self.suspected_any + self.suspected_additional:
+            if name not in vocab:
+                vocab.append(name)
+        self.vocabulary = vocab
+        self._patterns = {name: rf"(?:^|[;,])\s*{re.escape(name)}\s*(?:[;,]|$)" for name in vocab}
+        self._col = {name: i for i, name in enumerate(vocab)}
+
+    # ---------- single case ----------
+    def classify(self, entry):
+        if self.confirm_on_lab and entry.get('lab_positive'):
+            return CONFIRMED
+        present = set(split_symptoms(entry.get('symptoms')))
+        if self.probable_all and all(s in present for s in self.probable_all):
+            if not self.probable_needs_epi or entry.get('epi_link'):
+                return PROBABLE
+        if self.suspected_open:
+            return SUSPECTED
+        if (not self.suspected_any or any(s in present for s in self.suspected_any)) and \
+                sum(s in present for s in self.suspected_additional) >= self.additional_required:
+            return SUSPECTED
+        return NOT_A_CASE
+
+    # ---------- DataFrame ----------
+    def symptom_matrix(self, symptoms):
+        """Boolean array (cases x vocabulary): which known symptoms each case reports."""
+        text = pd.Series(symptoms, dtype=object).fillna("").astype(str).str.lower()
+        out = np.zeros((len(text), len(self.vocabulary)), dtype=bool)
+        for name, pattern in self._patterns.items():
+            out[:, self._col[name]] = text.str.contains(pattern, regex=True).to_numpy()
+        return out
+
+    def _cols(self, names):
+        return [self._col[n] for n in names]
+
+    def classify_frame(self, df):
+        n = len(df)
+        m = self.symptom_matrix(df['symptoms'] if 'symptoms' in df.columns else [None] * n)
+        lab = pd.to_numeric(df['lab_positive'], errors='coerce').fillna(0).to_numpy() != 0 \
+            if 'lab_positive' in df.columns else np.zeros(n, dtype=bool)
+        epi = pd.to_numeric(df['epi_link'], errors='coerce').fillna(0).to_numpy() != 0 \
+            if 'epi_link' in df.columns else np.zeros(n, dtype=bool)
+        confirmed = lab if self.confirm_on_lab else np.zeros(n, dtype=bool)
+        if self.probable_all:
+            probable = m[:, self._cols(self.probable_all)].all(axis=1)
+            if self.probable_needs_epi:
+                probable &= epi
+        else:
+            probable = np.zeros(n, dtype=bool)
+        if self.suspected_open:
+            suspected = np.ones(n, dtype=bool)
+        else:
+            suspected = m[:, self._cols(self.suspected_any)].any(axis=1) if self.suspected_any else np.ones(n, dtype=bool)
+            if self.additional_required:
+                suspected &= m[:, self._cols(self.suspected_additional)].sum(axis=1) >= self.additional_required
+        out = np.select([confirmed, probable, suspected], [CONFIRMED, PROBABLE, SUSPECTED], NOT_A_CASE)
+        return pd.Series(out, index=df.index, name='classification')
+
+
+class RuleSet:
+    """Default rules plus per-disease overrides from structured case_definitions."""
+
+    def __init__(self, config_rules=None, case_definitions=None):
+        self.default = CaseRules(config_rules)
+        self.diseases = {}
+        self.descriptions = {}
+        for disease, levels in (case_definitions or {}).items():
+            levels = levels or {}
+            structured = {k: v for k, v in levels.items() if isinstance(v, dict)}
+            self.descriptions[disease] = {k: v for k, v in levels.items() if isinstance(v, str)}
+            if structured:
+                self.diseases[str(disease).lower()] = CaseRules(structured)
+
+    def rules_for(self, disease):
+        return self.diseases.get(str(disease).lower(), self.default) if disease else self.default
+
+    def classify(self, entry):
+        return self.rules_for(entry.get('disease')).classify(entry)
+
+    def classify_frame(self, df):
+        if not self.diseases or 'disease' not in df.columns:
+            return self.default.classify_frame(df)
+        key = df['disease'].fillna("").astype(str).str.lower()
+        out = self.default.classify_frame(df)
+        for disease, rules in self.diseases.items():
+            sel = (key == disease).to_numpy()
+            if sel.any():
+                out[sel] = rules.classify_frame(df[sel]).to_numpy()
+        return out
+
+
+@lru_cache(maxsize=16)
+def _compile(key):
+    spec = json.loads(key)
+    return RuleSet(spec['rules'], spec['definitions'])
+
+
+def compile_rules(config_rules=None, case_definitions=None):
+    """Cached RuleSet for these rules; recompiled only when their content changes."""
+    key = json.dumps({'rules': config_rules, 'definitions': case_definitions}, sort_keys=True, default=str)
+    return _compile(key)
@@ -0,0 +1,292 @@
+"""
+clustering.py
+
+Space-time DBSCAN for case epicenters.
+
+Points are bucketed on a lat/lon grid (partition_km per side, default 100 km). Neighbours are
+found per bucket with a haversine BallTree built over the bucket plus a halo
+one eps wide, so no tree ever spans the whole country. With eps_days set, two
+cases are neighbours only if they are within eps_meters AND eps_days of each
+other (ST-DBSCAN). The neighbour graph is kept between updates: adding cases
+only searches around the new points and merges clusters with a vectorized
+union-find; expiring cases drops their edges and relabels the graph once with
+connected components (onset dates are daily, so at most once per day).
+"""
+import numpy as np
+import pandas as pd
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from sklearn.neighbors import BallTree
+
+KMS_PER_RADIAN = 6371.0088
+KMS_PER_DEGREE_LAT = 111.2
+NS_PER_DAY = 86400 * 10**9
+
+
+def _to_days(onset):
+    """Onset dates as float days since epoch (NaN where missing)."""
+    if onset is None:
+        return None
+    onset = pd.to_datetime(pd.Series(onset), errors="coerce")
+    days = onset.to_numpy(dtype="datetime64[ns]").astype("int64") / NS_PER_DAY
+    days[onset.isna().to_numpy()] = np.nan
+    return days
+
+
+class ClusterEngine:
+    """
+    Incremental (ST-)DBSCAN over a rolling window of cases.
+
+    engine = ClusterEngine(eps_meters=2000, min_samples=3, eps_days=7, window_days=14)
+    engine.update(new_cases_df)   # lat, lon and optional onset_date columns
+    engine.clusters()             # [{'lat', 'lon', 'count', 'mean_date'}, ...]
+    """
+
+    def __init__(self, eps_meters=2000, min_samples=3, eps_days=None, window_days=None, partition_km=100.0):
+        self.eps_km = eps_meters / 1000.0
+        self.eps_rad = self.eps_km / KMS_PER_RADIAN
+        self.min_samples = min_samples
+        self.eps_days = eps_days
+        self.window_days = window_days
+        self.cell_deg = max(partition_km, self.eps_km) / KMS_PER_DEGREE_LAT
+        self.lat = np.empty(0)
+        self.lon = np.empty(0)
+        self.t = np.empty(0)
+        self.alive = np.empty(0, dtype=bool)
+        self.src = np.empty(0, dtype=np.int64)
+        self.dst = np.empty(0, dtype=np.int64)
+        self.degree = np.empty(0, dtype=np.int64)
+        self.core = np.empty(0, dtype=bool)
+        self.parent = np.empty(0, dtype=np.int64)
+        self.buckets = {}
+        self._stale = False
+        self._labels = None
+
+    def __len__(self):
+        return int(self.alive.sum())
+
+    # ---------- grid ----------
+    def _bucket_keys(self, lat, lon):
+        return np.floor(lat / self.cell_deg).astype(np.int64), np.floor(lon / self.cell_deg).astype(np.int64)
+
+    def _halo_deg(self, max_abs_lat):
+        dlat = self.eps_km / KMS_PER_DEGREE_LAT
+        coslat = np.cos(np.radians(min(max_abs_lat + dlat, 89.0)))
+        return dlat, dlat / max(coslat, 1e-6)
+
+    def _candidates(self, lat_min, lat_max, lon_min, lon_max):
+        rows = range(int(np.floor(lat_min / self.cell_deg)), int(np.floor(lat_max / self.cell_deg)) + 1)
+        cols = range(int(np.floor(lon_min / self.cell_deg)), int(np.floor(lon_max / self.cell_deg)) + 1)
+        found = [self.buckets[(r, c)] for r in rows for c in cols if (r, c) in self.buckets]
+        if not found:
+            return np.empty(0, dtype=np.int64)
+        idx = np.concatenate(found)
+        idx = idx[self.alive[idx]]
+        keep = ((self.lat[idx] >= lat_min) & (self.lat[idx] <= lat_max)
+                & (self.lon[idx] >= lon_min) & (self.lon[idx] <= lon_max))
+        return idx[keep]
+
+    # ---------- updates ----------
+    def _cutoff(self, now):
+        if self.window_days is None:
+            return None
+        now = pd.Timestamp.now() if now is None else pd.Timestamp(now)
+        return now.value / NS_PER_DAY - float(self.window_days)
+
+    def add(self, lat, lon, onset=None, now=None):
+        lat = np.asarray(lat, dtype=float)
+        lon = np.asarray(lon, dtype=float)
+        t = _to_days(onset) if onset is not None else np.full(lat.shape[0], np.nan)
+        ok = np.isfinite(lat) & np.isfinite(lon)
+        cutoff = self._cutoff(now)
+        if cutoff is not None:
+            # cases already outside the window are never indexed
+            ok &= t >= cutoff
+        lat, lon, t = lat[ok], lon[ok], t[ok]
+        if lat.size == 0:
+            return
+        start = self.lat.size
+        new = np.arange(start, start + lat.size)
+        self.lat = np.concatenate([self.lat, lat])
+        self.lon = np.concatenate([self.lon, lon])
+        self.t = np.concatenate([self.t, t])
+        self.alive = np.concatenate([self.alive, np.ones(lat.size, dtype=bool)])
+        self.degree = np.concatenate([self.degree, np.zeros(lat.size, dtype=np.int64)])
+        self.core = np.concatenate([self.core, np.zeros(lat.size, dtype=bool)])
+        self.parent = np.concatenate([self.parent, new])
+        rows, cols = self._bucket_keys(lat, lon)
+        order = np.lexsort((cols, rows))
+        rows, cols, new = rows[order], cols[order], new[order]
+        bounds = np.flatnonzero(np.r_[True, (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1]), True])
+        groups = [(rows[a], cols[a], new[a:b]) for a, b in zip(bounds[:-1], bounds[1:])]
+        for r, c, members in groups:
+            key = (int(r), int(c))
+            self.buckets[key] = np.concatenate([self.buckets[key], members]) if key in self.buckets else members
+        src, dst = [], []
+        for _, _, members in groups:
+            s, d = self._search(members)
+            src.append(s)
+            dst.append(d)
+        s, d = np.concatenate(src), np.concatenate(dst)
+        # edges between two new points are found from both sides; keep each direction once
+        old_dst = d < start
+        s, d = np.concatenate([s, d[old_dst]]), np.concatenate([d, s[old_dst]])
+        if start == 0:
+            self._stale = True  # first load: one connected-components pass is cheaper than unions
+        if not self._stale:
+            self._link(s, d)
+        self.src = np.concatenate([self.src, s])
+        self.dst = np.concatenate([self.dst, d])
+        self._labels = None
+
+    def _link(self, s, d):
+        # new edges only raise degrees, so clusters can only grow or merge
+        self.degree += np.bincount(s, minlength=self.degree.size)
+        new_core = self.alive & ~self.core & (self.degree >= self.min_samples)
+        self.core |= new_core
+        both = self.core[s] & self.core[d]
+        self._union(s[both], d[both])
+        if new_core.any() and self.src.size:
+            # existing edges of points that just became core
+            old = new_core[self.src] & self.core[self.dst]
+            self._union(self.src[old], self.dst[old])
+
+    def _find(self, x):
+        parent = self.parent
+        root = parent[x]
+        while True:
+            up = parent[root]
+            if np.array_equal(up, root):
+                break
+            root = up
+        parent[x] = root
+        return root
+
+    def _union(self, a, b):
+        while a.size:
+            ra, rb = self._find(a), self._find(b)
+            diff = ra != rb
+            if not diff.any():
+                break
+            a, b, ra, rb = a[diff], b[diff], ra[diff], rb[diff]
+            # always hang the larger root under the smaller one, so no cycles form;
+            # clashing writes are resolved on the next pass
+            self.parent[np.maximum(ra, rb)] = np.minimum(ra, rb)
+
+    def _search(self, members):
+        mlat, mlon = self.lat[members], self.lon[members]
+        dlat, dlon = self._halo_deg(float(np.abs(mlat).max()))
+        cand = self._candidates(mlat.min() - dlat, mlat.max() + dlat, mlon.min() - dlon, mlon.max() + dlon)
+        tree = BallTree(np.radians(np.column_stack([self.lat[cand], self.lon[cand]])), metric="haversine")
+        hits = tree.query_radius(np.radians(np.column_stack([mlat, mlon])), r=self.eps_rad)
+        counts = np.fromiter((h.size for h in hits), dtype=np.int64, count=len(hits))
+        src = np.repeat(members, counts)
+        dst = cand[np.concatenate(hits)] if counts.sum() else np.empty(0, dtype=np.int64)
+        if self.eps_days is not None:
+            keep = (np.abs(self.t[src] - self.t[dst]) <= self.eps_days) | (src == dst)
+            src, dst = src[keep], dst[keep]
+        return src, dst
+
+    def expire(self, now=None):
+        """Drop cases older than window_days before now (and cases without an onset date)."""
+        cutoff = self._cutoff(now)
+        if cutoff is None or self.lat.size == 0:
+            return
+        stale = self.alive & ~(self.t >= cutoff)
+        if stale.any():
+            self.alive &= ~stale
+            self._stale = True
+            self._labels = None
+            if self.alive.sum() < self.alive.size // 2:
+                self._compact()
+
+    def _compact(self):
+        keep = np.flatnonzero(self.alive)
+        remap = np.full(self.alive.size, -1, dtype=np.int64)
+        remap[keep] = np.arange(keep.size)
+        live_edges = self.alive[self.src] & self.alive[self.dst]
+        self.src, self.dst = remap[self.src[live_edges]], remap[self.dst[live_edges]]
+        self.lat, self.lon, self.t = self.lat[keep], self.lon[keep], self.t[keep]
+        self.alive = np.ones(keep.size, dtype=bool)
+        self.degree = np.zeros(keep.size, dtype=np.int64)
+        self.core = np.zeros(keep.size, dtype=bool)
+        self.parent = np.arange(keep.size, dtype=np.int64)
+        self._stale = True
+        rows, cols = self._bucket_keys(self.lat, self.lon)
+        self.buckets = {}
+        for key, idx in pd.Series(np.arange(keep.size)).groupby([rows, cols]).groups.items():
+            self.buckets[(int(key[0]), int(key[1]))] = np.asarray(idx, dtype=np.int64)
+
+    def update(self, df=None, now=None):
+        """Add new cases (DataFrame with lat, lon, optional onset_date), expire old ones, return clusters."""
+        if df is not None and len(df):
+            self.add(df["lat"].to_numpy(), df["lon"].to_numpy(),
+                     df["onset_date"] if "onset_date" in df.columns else None, now=now)
+        self.expire(now)
+        return self.clusters()
+
+    # ---------- labels ----------
+    def _rebuild(self):
+        n = self.alive.size
+        live = self.alive[self.src] & self.alive[self.dst]
+        src, dst = self.src[live], self.dst[live]
+        self.degree = np.bincount(src, minlength=n)
+        self.core = self.alive & (self.degree >= self.min_samples)
+        self.parent = np.arange(n, dtype=np.int64)
+        core_idx = np.flatnonzero(self.core)
+        if core_idx.size:
+            cc = self.core[src] & self.core[dst]
+            pos = np.full(n, -1, dtype=np.int64)
+            pos[core_idx] = np.arange(core_idx.size)
+            graph = coo_matrix((np.ones(int(cc.sum()), dtype=np.int8), (pos[src[cc]], pos[dst[cc]])),
+                               shape=(core_idx.size, core_idx.size)).tocsr()
+            # edges are stored in both directions, so strong components are the clusters
+            # and scipy skips the transpose an undirected search would build
+            ncomp, comp = connected_components(graph, directed=True, connection="strong")
+            root = np.full(ncomp, n, dtype=np.int64)
+            np.minimum.at(root, comp, core_idx)
+            self.parent[core_idx] = root[comp]
+        self._stale = False
+
+    def labels(self):
+        """DBSCAN label per stored point (-1 for noise or expired)."""
+        if self._labels is not None:
+            return self._labels
+        if self._stale:
+            self._rebuild()
+        n = self.alive.size
+        roots = np.full(n, -1, dtype=np.int64)
+        core_idx = np.flatnonzero(self.core)
+        if core_idx.size:
+            roots[core_idx] = self._find(core_idx)
+            # border points join the cluster of a core neighbour
+            border = ~self.core[self.src] & self.core[self.dst] & self.alive[self.src]
+            roots[self.src[border]] = roots[self.dst[border]]
+        labels = np.full(n, -1, dtype=np.int64)
+        member = roots >= 0
+        labels[member] = np.unique(roots[member], return_inverse=True)[1]
+        self._labels = labels
+        return labels
+
+    def clusters(self):
+        labels = self.labels()
+        member = labels >= 0
+        if not member.any():
+            return []
+        frame = pd.DataFrame({"label": labels[member], "lat": self.lat[member], "lon": self.lon[member],
+                              "t": self.t[member]})
+        stats = frame.groupby("label", sort=True).agg(lat=("lat", "mean"), lon=("lon", "mean"),
+                                                       count=("lat", "size"), t=("t", "mean"))
+        out = []
+        for row in stats.itertuples():
+            mean_date = None if np.isnan(row.t) else pd.Timestamp(int(round(row.t * NS_PER_DAY)))
+            out.append({"lat": float(row.lat), "lon": float(row.lon), "count": int(row.count),
+                        "mean_date": str(mean_date)})
+        return out
+
+
+def cluster_points(df_coords, eps_meters=2000, min_samples=3, time_window_days=None, eps_days=None, now=None):
+    """One-shot clustering of a DataFrame with lat, lon and optional onset_date columns."""
+    engine = ClusterEngine(eps_meters=eps_meters, min_samples=min_samples, eps_days=eps_days,
+                           window_days=time_window_days)
+    return engine.update(df_coords, now=now)
@@ -0,0 +1,333 @@
+"""
+dedup.py
+
+Duplicate report detection without an all-pairs scan.
+
+Cases are blocked on (district, sex, age band, phonetic name key), where the
+name key is the sorted Soundex codes of the name's words, so "Kofi Mensah",
+"Mensah Kofi" and "Kofi Mensa" share a block. Within a block cases are sorted
+by onset date and only neighbours at most window_days apart are compared
+(sorted-neighbourhood, capped at MAX_NEIGHBOURS per case), so the work grows
+with the number of cases rather than its square.
+
+Candidate pairs get a 0-1 score from name similarity, age, onset gap,
+community, coordinates and symptom overlap. Pairs at or above
+deduplication.threshold are written to case_duplicates with status 'flagged'
+(case_id is the later report). Nothing is deleted or merged: reviewers mark
+pairs 'confirmed' or 'dismissed'.
+
+utils.add_case / add_cases_bulk call on_cases_written() inside the writing
+transaction, which compares the new rows with each other and with existing
+cases in the same districts and date range. sweep() re-scans the whole table.
+
+Usage:
+    python dedup.py --sweep
+    python dedup.py --list
+"""
+import argparse
+import re
+import unicodedata
+from datetime import date, datetime, timedelta
+from difflib import SequenceMatcher
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from settings import load_config
+from utils import CONFIG, _age_band, connection, init_db, transaction
+
+MAX_NEIGHBOURS = 50
+FEW_ROWS = 20  # writes up to this size take the per-row lookup path
+COLUMNS = ["case_id", "name", "sex", "age", "district", "community", "onset_date", "symptoms", "coords", "row_version"]
+# weights of the pair score components; a missing component counts as 0.5 (no evidence either way)
+WEIGHTS = {"name": 0.35, "age": 0.2, "onset": 0.15, "community": 0.1, "coords": 0.1, "symptoms": 0.1}
+COORD_MATCH_KM = 2.0
+STATUSES = ("flagged", "confirmed", "dismissed")
+
+_SOUNDEX = str.maketrans("bfpvcgjkqsxzdtlmnr", "111122222222334556")
+
+
+# ---------- blocking ----------
+@lru_cache(maxsize=65536)
+def soundex(word):
+    """American Soundex code of one word ('' for words without letters)."""
+    word = "".join(c for c in unicodedata.normalize("NFKD", word or "").lower() if "a" <= c <= "z")
+    if not word:
+        return ""
+    digits = word.translate(_SOUNDEX)
+    code, last = word[0].upper(), digits[0]
+    for ch, digit in zip(word[1:], digits[1:]):
+        if digit.isdigit() and digit != last:
+            code += digit
+        if ch not in "hw":  # h and w do not separate equal codes
+            last = digit
+        if len(code) == 4:
+            break
+    return code.ljust(4, "0")
+
+
+def phonetic_key(name):
+    """Sorted Soundex codes of the words in a name, e.g. 'Kofi Mensah' -> 'K100-M520'."""
+    if not isinstance(name, str):
+        return ""
+    return "-".join(sorted(filter(None, (soundex(w) for w in re.split(r"[\s,.'-]+", name)))))
+
+
+def blocking_keys(df):
+    """Block id (int, -1 when the case cannot be blocked) and onset day number per case."""
+    day = pd.to_datetime(df["onset_date"], errors="coerce", format="ISO8601")
+    # names and ages repeat, so derive keys once per distinct value
+    band = df["age"].map({a: _age_band(a) for a in df["age"].dropna().unique()}).fillna("Unknown")
+    sex = df["sex"].fillna("Unknown").astype(str).str.lower()
+    phon = df["name"].map({n: phonetic_key(n) for n in df["name"].dropna().unique()}).fillna("")
+    block, _ = pd.factorize(pd.MultiIndex.from_arrays([df["district"].astype(object), sex, band, phon]))
+    ok = df["district"].notna().to_numpy() & day.notna().to_numpy()
+    block = np.where(ok, block, -1)
+    days = np.where(ok, day.to_numpy(dtype="datetime64[D]").astype(np.int64), 0)
+    return block, days
+
+
+def candidate_pairs(block, days, window_days=7, max_neighbours=MAX_NEIGHBOURS):
+    """(i, j) positional index arrays of cases in the same block at most window_days apart."""
+    order = np.lexsort((days, block))
+    b, d = block[order], days[order]
+    left, right = [], []
+    for k in range(1, max_neighbours + 1):
+        if k >= len(order):
+            break
+        hit = (b[k:] == b[:-k]) & (b[k:] >= 0) & (d[k:] - d[:-k] <= window_days)
+        if not hit.any():
+            break  # sorted by (block, day): no pair further apart can qualify either
+        left.append(order[:-k][hit])
+        right.append(order[k:][hit])
+    if not left:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    return np.concatenate(left), np.concatenate(right)
+
+
+# ---------- scoring ----------
+def _name_similarity(a, b):
+    if not isinstance(a, str) or not isinstance(b, str) or not a.strip() or not b.strip():
+        return np.nan
+    a, b = (" ".join(sorted(x.lower().split())) for x in (a, b))
+    return SequenceMatcher(None, a, b).ratio()
+
+
+def _symptom_overlap(a, b):
+    sa = {s.strip().lower() for s in re.split(r"[;,]", a or "") if s.strip()} if isinstance(a, str) else set()
+    sb = {s.strip().lower() for s in re.split(r"[;,]", b or "") if s.strip()} if isinstance(b, str) else set()
+    if not sa or not sb:
+        return np.nan
+    return len(sa & sb) / len(sa | sb)
+
+
+def _coords(df):
+    parts = df["coords"].astype("string").str.split(",", n=1, expand=True)
+    if parts.shape[1] < 2:
+        return np.full(len(df), np.nan), np.full(len(df), np.nan)
+    return (pd.to_numeric(parts[0], errors="coerce").to_numpy(dtype=float),
+            pd.to_numeric(parts[1], errors="coerce").to_numpy(dtype=float))
+
+
+def score_pairs(df, i, j, days, window_days=7):
+    """Weighted 0-1 similarity of the case pairs (i[k], j[k]) (positional indexes into df)."""
+    parts = {}
+    names, symptoms = df["name"].to_numpy(dtype=object), df["symptoms"].to_numpy(dtype=object)
+    parts["name"] = np.array([_name_similarity(names[a], names[b]) for a, b in zip(i, j)], dtype=float)
+    age = pd.to_numeric(df["age"], errors="coerce").to_numpy(dtype=float)
+    parts["age"] = np.clip(1 - np.abs(age[i] - age[j]) / 5, 0, 1)
+    parts["onset"] = 1 - np.abs(days[i] - days[j]) / (window_days + 1)
+    community = df["community"].fillna("").astype(str).str.strip().str.lower().to_numpy(dtype=object)
+    known = (community[i] != "") & (community[j] != "")
+    parts["community"] = np.where(known, (community[i] == community[j]).astype(float), np.nan)
+    lat, lon = _coords(df)
+    dlat, dlon = np.radians(lat[j] - lat[i]), np.radians(lon[j] - lon[i])
+    h = np.sin(dlat / 2) ** 2 + np.cos(np.radians(lat[i])) * np.cos(np.radians(lat[j])) * np.sin(dlon / 2) ** 2
+    km = 2 * 6371.0 * np.arcsin(np.sqrt(np.clip(h, 0, 1)))
+    parts["coords"] = np.clip(1 - km / COORD_MATCH_KM, 0, 1)
+    parts["symptoms"] = np.array([_symptom_overlap(symptoms[a], symptoms[b]) for a, b in zip(i, j)], dtype=float)
+    score = sum(WEIGHTS[k] * np.where(np.isnan(v), 0.5, v) for k, v in parts.items())
+    return score / sum(WEIGHTS.values())
+
+
+def find_duplicates(df, window_days=7, threshold=0.85, only=None, max_neighbours=MAX_NEIGHBOURS):
+    """
+    Likely duplicate pairs in df (COLUMNS), as a DataFrame of case_id (later report),
+    duplicate_of and score. With only (a boolean mask), pairs must involve at least one of those rows.
+    """
+    empty = pd.DataFrame(columns=["case_id", "duplicate_of", "score"])
+    if len(df) < 2:
+        return empty
+    df = df.reset_index(drop=True)
+    block, days = blocking_keys(df)
+    i, j = candidate_pairs(block, days, window_days, max_neighbours)
+    if only is not None:
+        only = np.asarray(only, dtype=bool)
+        keep = only[i] | only[j]
+        i, j = i[keep], j[keep]
+    # a pair missing a name scores 0.5 on that component at best; skip it when that cannot reach the threshold
+    cap = 1 - 0.5 * WEIGHTS["name"] / sum(WEIGHTS.values())
+    if threshold > cap:
+        named = df["name"].fillna("").astype(str).str.strip().to_numpy() != ""
+        keep = named[i] & named[j]
+        i, j = i[keep], j[keep]
+    if not len(i):
+        return empty
+    score = score_pairs(df, i, j, days, window_days)
+    hit = score >= threshold
+    i, j, score = i[hit], j[hit], score[hit]
+    version = df["row_version"].fillna(0).to_numpy() if "row_version" in df.columns else np.arange(len(df))
+    later = np.where(version[j] >= version[i], j, i)
+    earlier = np.where(later == j, i, j)
+    ids = df["case_id"].to_numpy(dtype=object)
+    return pd.DataFrame({"case_id": ids[later], "duplicate_of": ids[earlier], "score": score.round(3)})
+
+
+# ---------- storage ----------
+def flag(conn, pairs):
+    """Insert flagged pairs (existing pairs keep their review status); returns pairs newly flagged."""
+    if pairs.empty:
+        return 0
+    now = datetime.now().isoformat(timespec="seconds")
+    before = conn.total_changes
+    conn.executemany("INSERT OR IGNORE INTO case_duplicates (case_id, duplicate_of, score, status, created_at) "
+                     "VALUES (?, ?, ?, 'flagged', ?)",
+                     [(a, b, float(s), now) for a, b, s in pairs.itertuples(index=False)])
+    return conn.total_changes - before
+
+
+def _read(conn, where="", params=()):
+    return pd.read_sql_query(f"SELECT {', '.join(COLUMNS)} FROM cases {where}", conn, params=params)
+
+
+def _day(value):
+    """Onset date of a stored value, or None when it does not parse."""
+    try:
+        return date.fromisoformat(str(value)[:10])
+    except ValueError:
+        return None
+
+
+def _block_key(row):
+    """blocking_keys() for one COLUMNS tuple, in plain Python: (district, sex, age band, name key) or None."""
+    district, sex, age, name = row[4], row[2], row[3], row[1]
+    if district is None or _day(row[6]) is None:
+        return None
+    return district, str(sex if sex is not None else "Unknown").lower(), _age_band(age), phonetic_key(name)
+
+
+def _flag_few(conn, new, dedup, cap, version_before):
+    """on_cases_written for a handful of rows: indexed lookups per row, pandas only when a candidate exists."""
+    pairs = []
+    if len(new) > 1:
+        # pairs among the new rows themselves, oriented by row_version like any other pair
+        pairs.append(find_duplicates(pd.DataFrame(new, columns=COLUMNS), dedup.window_days, dedup.threshold))
+    for row in new:
+        key = _block_key(row)
+        if key is None or (dedup.threshold > cap and not key[3]):
+            continue
+        day = _day(row[6])
+        window = timedelta(days=dedup.window_days)
+        near = conn.execute(f"SELECT {', '.join(COLUMNS)} FROM cases WHERE district = ? AND onset_date >= ? "
+                            "AND onset_date < ? AND row_version <= ?",
+                            (row[4], (day - window).isoformat(), (day + window + timedelta(days=1)).isoformat(),
+                             version_before)).fetchall()
+        near = [r for r in near if _block_key(r) == key]
+        if not near:
+            continue
+        # every row already shares the new row's block, so score the pairs directly
+        df = pd.DataFrame([row] + near, columns=COLUMNS)
+        days = np.array([_day(r[6]).toordinal() for r in [row] + near])
+        j = np.arange(1, len(df))
+        score = score_pairs(df, np.zeros(len(j), dtype=np.int64), j, days, dedup.window_days)
+        hit = score >= dedup.threshold
+        pairs.append(pd.DataFrame({"case_id": row[0], "duplicate_of": df["case_id"].to_numpy()[j[hit]],
+                                   "score": score[hit].round(3)}))
+    pairs = [p for p in pairs if not p.empty]
+    return flag(conn, pd.concat(pairs, ignore_index=True)) if pairs else 0
+
+
+def on_cases_written(conn, version_before, config=None):
+    """Hook called by utils inside the writing transaction: flag duplicates among rows newer than version_before."""
+    dedup = (config or load_config(CONFIG)).deduplication
+    if not dedup.enabled:
+        return 0
+    new = conn.execute(f"SELECT {', '.join(COLUMNS)} FROM cases WHERE row_version > ? LIMIT ?",
+                       (version_before, FEW_ROWS + 1)).fetchall()
+    if not new:
+        return 0
+    if len(new) <= FEW_ROWS:
+        return _flag_few(conn, new, dedup, 1 - 0.5 * WEIGHTS["name"] / sum(WEIGHTS.values()), version_before)
+    new = _read(conn, "WHERE row_version > ?", (version_before,))
+    # existing cases that could share a block: same districts, onset within the window of the new rows
+    days = pd.to_datetime(new["onset_date"], errors="coerce", format="ISO8601")
+    if days.isna().all():
+        return 0
+    start = (days.min() - pd.Timedelta(days=dedup.window_days)).strftime("%Y-%m-%d")
+    end = (days.max() + pd.Timedelta(days=dedup.window_days + 1)).strftime("%Y-%m-%d")
+    districts = new["district"].dropna().unique().tolist()
+    frames = [new]
+    for k in range(0, len(districts), 500):
+        chunk = districts[k:k + 500]
+        frames.append(_read(conn, f"WHERE district IN ({','.join('?' * len(chunk))}) AND onset_date >= ? "
+                                  "AND onset_date < ? AND row_version <= ?", (*chunk, start, end, version_before)))
+    df = pd.concat([f for f in frames if not f.empty], ignore_index=True)
+    only = np.zeros(len(df), dtype=bool)
+    only[:len(new)] = True
+    return flag(conn, find_duplicates(df, dedup.window_days, dedup.threshold, only))
+
+
+def sweep(config=None):
+    """Re-scan every case in the table; returns {"cases": n, "flagged": newly flagged pairs}."""
+    dedup = (config or load_config(CONFIG)).deduplication
+    with transaction() as conn:
+        df = _read(conn)
+        flagged = flag(conn, find_duplicates(df, dedup.window_days, dedup.threshold))
+    return {"cases": len(df), "flagged": flagged}
+
+
+def duplicates(status="flagged", case_id=None, limit=500):
+    """Flagged pairs with both reports side by side (status=None for all), optionally for one later report."""
+    sql = """SELECT d.case_id, d.duplicate_of, d.score, d.status, d.created_at,
+                    a.name, a.district, a.onset_date, b.name AS other_name, b.onset_date AS other_onset_date
+             FROM case_duplicates d LEFT JOIN cases a ON a.case_id = d.case_id
+             LEFT JOIN cases b ON b.case_id = d.duplicate_of"""
+    where, params = [], []
+    if status is not None:
+        where.append("d.status = ?")
+        params.append(status)
+    if case_id is not None:
+        where.append("d.case_id = ?")
+        params.append(case_id)
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY d.score DESC, d.created_at DESC LIMIT ?"
+    with connection() as conn:
+        return pd.read_sql_query(sql, conn, params=params + [limit])
+
+
+def set_status(case_id, duplicate_of, status):
+    if status not in STATUSES:
+        raise ValueError(f"status must be one of {STATUSES}")
+    with transaction() as conn:
+        conn.execute("UPDATE case_duplicates SET status = ? WHERE case_id = ? AND duplicate_of = ?",
+                     (status, case_id, duplicate_of))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Flag likely duplicate case reports")
+    parser.add_argument("--sweep", action="store_true", help="re-scan the whole cases table")
+    parser.add_argument("--list", action="store_true", help="print flagged pairs")
+    args = parser.parse_args(argv)
+    init_db()
+    if args.sweep or not args.list:
+        result = sweep()
+        print(f"Scanned {result['cases']} cases, flagged {result['flagged']} new pair(s).")
+    if args.list:
+        print(duplicates().to_string(index=False))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
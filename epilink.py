@@ -0,0 +1,307 @@
+"""
+epilink.py
+
+Epidemiological links for the "Probable" case definition
+(classification_rules.probable.epi_link_required).
+
+A case is epi-linked when a laboratory-confirmed case other than itself has an
+onset date at most epi_link.window_days away and either lives in the same
+community of the same district (epi_link.match_community) or was reported within
+epi_link.distance_km of it (coords). The flag is stored in cases.epi_link and
+the confirmed case that supplied it in cases.epi_link_of.
+
+Confirmed cases are indexed instead of compared pairwise. Coordinates are
+bucketed into cells one distance_km across, and every (cell, onset day) and
+(community, onset day) becomes one sorted integer key. A case finds candidates
+in the 3x3 cells around its own, and in its community, with two searchsorted
+calls per key, so labelling n cases against m confirmed ones costs
+O((n + m) log m) plus the candidates inside the window.
+
+utils.add_case / add_cases_bulk call on_cases_written() inside the writing
+transaction. New cases are labelled; a new confirmation relabels the cases
+around it in space and time, and a case that is no longer confirmed relabels the
+cases linked to it. Cases whose link changed are reclassified. relink() labels
+the whole table.
+
+Usage:
+    python epilink.py            # relink and reclassify every case
+    python epilink.py --stats
+"""
+import argparse
+import math
+
+import numpy as np
+import pandas as pd
+
+from settings import load_config
+from utils import CONFIG, _reclassify, connection, init_db, transaction
+
+FEW_ROWS = 20  # writes up to this size only read cases around the written ones
+COLUMNS = ["case_id", "district", "community", "onset_date", "coords", "lab_positive", "epi_link_of"]
+KM_PER_DEGREE = 111.32
+EPOCH = np.datetime64("1900-01-01", "D")
+DAY_BITS = 17  # day numbers since EPOCH fit until 2258
+CELL_BITS = 23  # per axis; cells stay in range for distance_km >= 0.01
+NEIGHBOURS = [(0, 0)] + [(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1) if dx or dy]
+# coords is "lat,lon" text; used to narrow single-case lookups to a bounding box
+LAT_SQL = "CAST(substr(coords, 1, instr(coords, ',') - 1) AS REAL)"
+LON_SQL = "CAST(substr(coords, instr(coords, ',') + 1) AS REAL)"
+
+
+# ---------- parsing ----------
+def _days(values):
+    """Onset dates as day numbers since EPOCH (-1 when unknown)."""
+    text = [v.strip()[:10] if isinstance(v, str) and v.strip() else "NaT" for v in values]
+    try:
+        days = np.array(text, dtype="datetime64[D]")
+    except ValueError:
+        days = pd.to_datetime(pd.Series(text, dtype=object), errors="coerce", format="ISO8601").to_numpy(dtype="datetime64[D]")
+    out = (days - EPOCH).astype(np.int64)
+    return np.where(np.isnat(days) | (out < 0) | (out >= 1 << DAY_BITS), -1, out)
+
+
+def _iso(day):
+    return str(EPOCH + np.timedelta64(int(day), "D"))
+
+
+def _point(text):
+    try:
+        lat, lon = text.split(",", 1)
+        return float(lat), float(lon)
+    except (AttributeError, ValueError):
+        return np.nan, np.nan
+
+
+def _lat_lon(coords):
+    if len(coords) <= 256:  # plain floats beat numpy's string ops on short lists
+        points = np.array([_point(c) for c in coords], dtype=float).reshape(-1, 2)
+        lat, lon = points[:, 0].copy(), points[:, 1].copy()
+    else:
+        parts = np.char.partition(np.array([c if isinstance(c, str) else "" for c in coords], dtype=str), ",")
+        lat = pd.to_numeric(np.char.strip(parts[:, 0]), errors="coerce").astype(float)
+        lon = pd.to_numeric(np.char.strip(parts[:, 2]), errors="coerce").astype(float)
+    bad = ~((np.abs(lat) <= 90) & (np.abs(lon) <= 180))
+    lat[bad], lon[bad] = np.nan, np.nan
+    return lat, lon
+
+
+def _community(district, community):
+    if not isinstance(community, str) or not community.strip():
+        return None
+    return f"{district}|{community.strip().lower()}"
+
+
+def is_confirmed(lab_positive):
+    try:
+        return float(lab_positive) != 0
+    except (TypeError, ValueError):
+        return False
+
+
+# ---------- index ----------
+class ConfirmedIndex:
+    """Confirmed cases keyed by (cell, onset day) and (community, onset day) for window lookups."""
+
+    def __init__(self, confirmed, distance_km=2.0, window_days=14, match_community=True):
+        self.distance_km, self.window_days, self.match_community = distance_km, window_days, match_community
+        self.ids = np.array([r[0] for r in confirmed], dtype=object)
+        days = _days([r[3] for r in confirmed])
+        self.lat, self.lon = _lat_lon([r[4] for r in confirmed])
+        # cells are distance_km tall; their width holds distance_km even at the highest latitude present
+        self.cell_lat = distance_km / KM_PER_DEGREE
+        top = float(np.nanmax(np.abs(self.lat))) if np.isfinite(self.lat).any() else 0.0
+        self.cell_lon = distance_km / (KM_PER_DEGREE * math.cos(math.radians(min(top + self.cell_lat, 89.0))))
+        cx, cy = self._cells(self.lat, self.lon)
+        located = (days >= 0) & np.isfinite(self.lat)
+        self.spatial = self._sort(self._cell_key(cx, cy), days, located)
+        keys = [_community(r[1], r[2]) for r in confirmed]
+        self.communities = {k: i for i, k in enumerate(dict.fromkeys(k for k in keys if k))}
+        codes = np.array([self.communities.get(k, -1) for k in keys], dtype=np.int64)
+        self.by_community = self._sort(codes, days, (days >= 0) & (codes >= 0))
+
+    def __len__(self):
+        return len(self.ids)
+
+    @staticmethod
+    def _sort(groups, days, ok):
+        keys = (groups[ok] << DAY_BITS) | days[ok]
+        pos = np.flatnonzero(ok)
+        order = np.argsort(keys, kind="stable")
+        return keys[order], pos[order]
+
+    def _cells(self, lat, lon):
+        with np.errstate(invalid="ignore"):
+            cx = np.floor(np.nan_to_num(lon) / self.cell_lon).astype(np.int64)
+            cy = np.floor(np.nan_to_num(lat) / self.cell_lat).astype(np.int64)
+        return cx, cy
+
+    @staticmethod
+    def _cell_key(cx, cy):
+        bias = 1 << (CELL_BITS - 1)
+        return ((cx + bias) << CELL_BITS) | (cy + bias)
+
+    def _km(self, lat, lon, pos):
+        dlat, dlon = np.radians(self.lat[pos] - lat), np.radians(self.lon[pos] - lon)
+        h = np.sin(dlat / 2) ** 2 + np.cos(np.radians(lat)) * np.cos(np.radians(self.lat[pos])) * np.sin(dlon / 2) ** 2
+        return 2 * 6371.0 * np.arcsin(np.sqrt(np.clip(h, 0, 1)))
+
+    def _first(self, found, want, groups, days, index, ids, near=None):
+        """Fill found[q] with the first confirmed position in the window of each wanted query q."""
+        keys, pos = index
+        q = np.flatnonzero(want & (found < 0))
+        if not len(q) or not len(keys):
+            return
+        g = groups[q] << DAY_BITS
+        lo = np.searchsorted(keys, g | np.maximum(days[q] - self.window_days, 0))
+        hi = np.searchsorted(keys, g | np.minimum(days[q] + self.window_days, (1 << DAY_BITS) - 1), side="right")
+        # walk the candidates of all queries in lockstep; most queries stop at their first candidate
+        while True:
+            live = lo < hi
+            q, lo, hi = q[live], lo[live], hi[live]
+            if not len(q):
+                return
+            c = pos[lo]
+            hit = self.ids[c] != ids[q]
+            if near is not None:
+                hit &= self._km(near[0][q], near[1][q], c) <= self.distance_km
+            found[q[hit]] = c[hit]
+            q, lo, hi = q[~hit], lo[~hit] + 1, hi[~hit]
+
+    def links(self, rows):
+        """Case id of a linked confirmed case for each COLUMNS tuple in rows (None when not linked)."""
+        found = np.full(len(rows), -1, dtype=np.int64)
+        if not len(rows) or not len(self):
+            return [None] * len(rows)
+        ids = np.array([r[0] for r in rows], dtype=object)
+        days = _days([r[3] for r in rows])
+        dated = days >= 0
+        if self.match_community:
+            codes = np.array([self.communities.get(_community(r[1], r[2]), -1) for r in rows], dtype=np.int64)
+            self._first(found, dated & (codes >= 0), codes, days, self.by_community, ids)
+        lat, lon = _lat_lon([r[4] for r in rows])
+        cx, cy = self._cells(lat, lon)
+        located = dated & np.isfinite(lat)
+        for dx, dy in NEIGHBOURS:
+            self._first(found, located, self._cell_key(cx + dx, cy + dy), days, self.spatial, ids, (lat, lon))
+        return [self.ids[p] if p >= 0 else None for p in found]
+
+
+# ---------- database ----------
+def _select(conn, where, params=()):
+    return conn.execute(f"SELECT {', '.join(COLUMNS)} FROM cases WHERE {where}", params).fetchall()
+
+
+def _window(rows, pad):
+    """(start, end) ISO bounds for onset_date >= start AND onset_date < end around rows, or None."""
+    days = _days([r[3] for r in rows])
+    days = days[days >= 0]
+    if not len(days):
+        return None
+    return _iso(max(days.min() - pad, 0)), _iso(days.max() + pad + 1)
+
+
+def _near(rows, epi):
+    """SQL condition (and params) for cases within distance_km of, or in the community of, any of rows."""
+    terms, params = [], []
+    lat, lon = _lat_lon([r[4] for r in rows])
+    dlat = epi.distance_km / KM_PER_DEGREE
+    for r, a, b in zip(rows, lat, lon):
+        if np.isfinite(a):
+            dlon = dlat / max(math.cos(math.radians(min(abs(a) + dlat, 89.0))), 1e-6)
+            terms.append(f"({LAT_SQL} BETWEEN ? AND ? AND {LON_SQL} BETWEEN ? AND ?)")
+            params += [a - dlat, a + dlat, b - dlon, b + dlon]
+        if epi.match_community and _community(r[1], r[2]):
+            terms.append("(district IS ? AND lower(trim(community)) = ?)")
+            params += [r[1], r[2].strip().lower()]
+    return ("(" + " OR ".join(terms) + ")" if terms else "0"), params
+
+
+def _confirmed_for(conn, rows, epi):
+    """Confirmed cases that can link any of rows (restricted to their surroundings for a few rows)."""
+    window = _window(rows, epi.window_days)
+    if window is None:
+        return []
+    where, params = "lab_positive != 0 AND onset_date >= ? AND onset_date < ?", list(window)
+    if len(rows) <= FEW_ROWS:
+        near, extra = _near(rows, epi)
+        where, params = f"{where} AND {near}", params + extra
+    return _select(conn, where, params)
+
+
+def _store(conn, rows, links, config):
+    """Write changed links and reclassify those cases; returns the number of links changed."""
+    changed = [(int(link is not None), link, r[0]) for r, link in zip(rows, links) if link != r[6]]
+    if changed:
+        conn.executemany("UPDATE cases SET epi_link = ?, epi_link_of = ? WHERE case_id = ?", changed)
+        _reclassify(conn, [c[2] for c in changed], config.classification_rules, config.case_definitions)
+    return len(changed)
+
+
+def on_cases_written(conn, version_before, config=None):
+    """Hook called by utils inside the writing transaction: link rows newer than version_before and their neighbours."""
+    config = config or load_config(CONFIG)
+    epi = config.epi_link
+    if not epi.enabled:
+        return 0
+    new = _select(conn, "row_version > ?", (version_before,))
+    if not new:
+        return 0
+    targets = {r[0]: r for r in new}
+    # a new confirmation can link cases around it
+    confirmed = [r for r in new if is_confirmed(r[5])]
+    window = _window(confirmed, epi.window_days)
+    if window is not None:
+        where, params = "onset_date >= ? AND onset_date < ?", list(window)
+        if len(confirmed) <= FEW_ROWS:
+            near, extra = _near(confirmed, epi)
+            where, params = f"{where} AND {near}", params + extra
+        targets.update((r[0], r) for r in _select(conn, where, params))
+    # cases linked to a written row that is no longer confirmed need another link
+    targets.update((r[0], r) for r in _select(
+        conn, "epi_link_of IN (SELECT case_id FROM cases WHERE row_version > ? AND IFNULL(lab_positive, 0) = 0)",
+        (version_before,)))
+    rows = list(targets.values())
+    index = ConfirmedIndex(_confirmed_for(conn, rows, epi), epi.distance_km, epi.window_days, epi.match_community)
+    return _store(conn, rows, index.links(rows), config)
+
+
+def relink_all(conn, config=None):
+    """Label every case in one pass inside conn's transaction; returns {"cases", "linked", "changed"}."""
+    config = config or load_config(CONFIG)
+    epi = config.epi_link
+    rows = _select(conn, "1")
+    index = ConfirmedIndex([r for r in rows if is_confirmed(r[5])], epi.distance_km, epi.window_days,
+                           epi.match_community)
+    links = index.links(rows)
+    changed = _store(conn, rows, links, config)
+    return {"cases": len(rows), "linked": sum(link is not None for link in links), "changed": changed}
+
+
+def relink(config=None):
+    """Relink and reclassify the whole cases table."""
+    with transaction() as conn:
+        return relink_all(conn, config)
+
+
+def link_stats():
+    """Counts of cases, confirmed cases, epi-linked cases and Probable cases."""
+    with connection() as conn:
+        row = conn.execute("SELECT COUNT(*), SUM(lab_positive != 0), SUM(epi_link), "
+                           "SUM(classification = 'Probable') FROM cases").fetchone()
+    return dict(zip(("cases", "confirmed", "linked", "probable"), (int(v or 0) for v in row)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Label epidemiological links to confirmed cases")
+    parser.add_argument("--stats", action="store_true", help="only print link counts")
+    args = parser.parse_args(argv)
+    init_db()
+    if not args.stats:
+        result = relink()
+        print(f"Labelled {result['cases']} cases: {result['linked']} linked, {result['changed']} changed.")
+    print(", ".join(f"{k}: {v}" for k, v in link_stats().items()))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,188 @@
+"""
+export.py
+
+Streaming export of the cases table as CSV, gzipped CSV or Parquet.
+
+Rows are read from a database cursor in fixed-size chunks and encoded chunk by
+chunk, so memory use does not depend on table size. Date range, district and
+classification filters become SQL WHERE clauses (served by the onset_date and
+district indexes) instead of filtering a DataFrame. Cases already moved to the
+Parquet archive (archive.py) follow the hot rows, read only from the epiweek
+partitions the date filter can match.
+
+Usage:
+    python export.py cases.csv.gz --from 2024-01-01 --to 2024-03-31 --district Accra
+    python export.py cases.parquet --classification Confirmed --classification Probable
+"""
+import argparse
+import csv
+import io
+import os
+import tempfile
+import zlib
+from datetime import date, timedelta
+
+from utils import CASE_COLUMNS, connection, init_db, read_snapshot
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except Exception:
+    pa = pq = None
+
+EXPORT_CHUNK_ROWS = 10000
+FORMATS = {"csv": "text/csv", "csv.gz": "application/gzip", "parquet": "application/vnd.apache.parquet"}
+INTEGER_COLUMNS = {"age", "lab_positive"}
+
+
+def format_for(path):
+    path = path.lower()
+    if path.endswith(".csv.gz") or path.endswith(".gz"):
+        return "csv.gz"
+    if path.endswith(".parquet"):
+        return "parquet"
+    return "csv"
+
+
+def build_query(start=None, end=None, districts=None, classifications=None, columns=CASE_COLUMNS):
+    """SQL and parameters for the filtered export; start/end are inclusive dates."""
+    where, params = [], []
+    if start is not None:
+        where.append("onset_date >= ?")
+        params.append(str(start)[:10])  # a Timestamp would render with 00:00:00 and skip the day
+    if end is not None:
+        # onset_date may carry a time part, so compare against the following day
+        end = date.fromisoformat(str(end)[:10]) + timedelta(days=1)
+        where.append("onset_date < ?")
+        params.append(end.isoformat())
+    for col, values in (("district", districts), ("classification", classifications)):
+        if values:
+            values = list(values)
+            where.append(f"{col} IN ({','.join('?' * len(values))})")
+            params.extend(values)
+    sql = f"SELECT {', '.join(columns)} FROM cases"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    return sql, params
+
+
+def iter_chunks(chunk_rows=EXPORT_CHUNK_ROWS, include_archive=True, **filters):
+    """Yield lists of row tuples from one consistent snapshot of the cases table, then the archive."""
+    sql, params = build_query(**filters)
+    with connection() as conn:
+        with read_snapshot(conn):
+            cur = conn.execute(sql, params)
+            while True:
+                rows = cur.fetchmany(chunk_rows)
+                if not rows:
+                    break
+                yield rows
+            if include_archive:
+                from archive import iter_archive_rows  # archive imports export
+                yield from iter_archive_rows(conn, chunk_rows, **filters)
+
+
+def iter_csv(compress=False, chunk_rows=EXPORT_CHUNK_ROWS, **filters):
+    """Yield the export as CSV (optionally gzip) byte chunks."""
+    gz = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+
+    def encode(rows, header=False):
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        if header:
+            writer.writerow(CASE_COLUMNS)
+        writer.writerows(rows)
+        data = buf.getvalue().encode("utf-8")
+        return gz.compress(data) if gz else data
+
+    yield encode([], header=True)
+    for rows in iter_chunks(chunk_rows, **filters):
+        yield encode(rows)
+    if gz:
+        yield gz.flush()
+
+
+def arrow_schema():
+    return pa.schema([(c, pa.int64() if c in INTEGER_COLUMNS else pa.string()) for c in CASE_COLUMNS])
+
+
+def _int_or_none(value):
+    try:
+        return None if value is None or value == "" else int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def arrow_table(rows, schema=None):
+    """Arrow table of CASE_COLUMNS row tuples (integers coerced, everything else as text)."""
+    schema = schema or arrow_schema()
+    cols = list(zip(*rows)) if rows else [()] * len(CASE_COLUMNS)
+    arrays = [pa.array([_int_or_none(v) for v in col] if name in INTEGER_COLUMNS
+                       else [None if v is None else str(v) for v in col], type=schema.field(name).type)
+              for name, col in zip(CASE_COLUMNS, cols)]
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def write_parquet(fileobj, chunk_rows=EXPORT_CHUNK_ROWS, **filters):
+    """Write the export to fileobj as Parquet, one row group per chunk. Returns rows written."""
+    if pq is None:
+        raise ValueError("Parquet export requires pyarrow (pip install pyarrow)")
+    schema = arrow_schema()
+    written = 0
+    with pq.ParquetWriter(fileobj, schema, compression="zstd") as writer:
+        for rows in iter_chunks(chunk_rows, **filters):
+            writer.write_table(arrow_table(rows, schema))
+            written += len(rows)
+    return written
+
+
+def write_export(fileobj, fmt="csv", chunk_rows=EXPORT_CHUNK_ROWS, **filters):
+    """Stream the filtered export into a binary file object in the given format."""
+    if fmt not in FORMATS:
+        raise ValueError(f"Unsupported export format {fmt!r}; choose from {sorted(FORMATS)}")
+    if fmt == "parquet":
+        return write_parquet(fileobj, chunk_rows, **filters)
+    for chunk in iter_csv(compress=(fmt == "csv.gz"), chunk_rows=chunk_rows, **filters):
+        fileobj.write(chunk)
+
+
+def export_to_tempfile(fmt="csv", **filters):
+    """
+    Export into a temporary file and return it opened for reading (an io.BufferedReader,
+    which st.download_button accepts), so large exports are never held in memory.
+    """
+    with tempfile.NamedTemporaryFile(suffix=f".{fmt}", delete=False) as f:
+        path = f.name
+        try:
+            write_export(f, fmt, **filters)
+        except BaseException:
+            f.close()
+            os.remove(path)
+            raise
+    reader = open(path, "rb")
+    try:
+        os.remove(path)  # the open handle keeps the data readable; nothing is left behind on disk
+    except OSError:
+        pass  # Windows cannot remove an open file; the OS temp cleanup takes it
+    return reader
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export cases from surveilai.db")
+    parser.add_argument("path", help="output file (.csv, .csv.gz or .parquet)")
+    parser.add_argument("--format", choices=sorted(FORMATS), default=None)
+    parser.add_argument("--from", dest="start", default=None, help="first onset date (YYYY-MM-DD)")
+    parser.add_argument("--to", dest="end", default=None, help="last onset date (YYYY-MM-DD)")
+    parser.add_argument("--district", action="append", default=None)
+    parser.add_argument("--classification", action="append", default=None)
+    parser.add_argument("--chunk-rows", type=int, default=EXPORT_CHUNK_ROWS)
+    args = parser.parse_args(argv)
+    init_db()
+    with open(args.path, "wb") as f:
+        write_export(f, args.format or format_for(args.path), chunk_rows=args.chunk_rows, start=args.start,
+                     end=args.end, districts=args.district, classifications=args.classification)
+    print("Saved", args.path)
+
+
+if __name__ == "__main__":
+    main()
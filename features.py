@@ -0,0 +1,130 @@
+"""
+features.py
+
+District-week feature definitions shared by score_districts.py (scoring) and
+train_model.py (training), so both always see identical features.
+
+Weeks are ISO weeks; a district-week's features are computed as of its last day
+(Sunday) from daily case counts:
+    cases_7d, cases_14d, cases_28d   rolling case counts
+    growth_7d                        (cases_7d + 1) / (previous 7 days + 1)
+    cases_7d_lag1/2/4                cases_7d one, two and four weeks earlier
+    per_1000                         cases_7d per 1000 population (cases_7d without population data)
+    population                       district population (NaN when unknown)
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+from instrumentation import timed
+from utils import connection
+
+FEATURE_VERSION = 1
+WINDOWS = (7, 14, 28)
+LAG_WEEKS = (1, 2, 4)
+HISTORY_DAYS = max(WINDOWS) + 7 * max(LAG_WEEKS)
+FEATURE_COLUMNS = ([f"cases_{w}d" for w in WINDOWS] + ["growth_7d"]
+                   + [f"cases_7d_lag{k}" for k in LAG_WEEKS] + ["per_1000", "population"])
+POPULATION_CSV = "district_population.csv"
+
+
+def week_end(day):
+    """Sunday closing the ISO week that contains day."""
+    day = pd.Timestamp(day).normalize()
+    return day + pd.Timedelta(days=6 - day.weekday())
+
+
+def load_population(path=POPULATION_CSV):
+    if not path or not os.path.exists(path):
+        return None
+    pop = pd.read_csv(path)
+    return pop[["district", "population"]].drop_duplicates("district")
+
+
+def daily_counts(start=None, end=None):
+    """
+    Cases per (district, day), optionally restricted to [start, end]. Read from the
+    district_daily_counts table maintained on write, which also covers archived cases.
+    """
+    sql, where, params = "SELECT district, day, cases FROM district_daily_counts", [], []
+    if start is not None:
+        where.append("day >= ?")
+        params.append(pd.Timestamp(start).strftime("%Y-%m-%d"))
+    if end is not None:
+        where.append("day <= ?")
+        params.append(pd.Timestamp(end).strftime("%Y-%m-%d"))
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    with connection() as conn:
+        df = pd.read_sql_query(sql, conn, params=params)
+    df["day"] = pd.to_datetime(df["day"], format="%Y-%m-%d", errors="coerce")
+    return df.dropna(subset=["day"])
+
+
+def known_districts():
+    with connection() as conn:
+        rows = conn.execute("SELECT DISTINCT district FROM district_daily_counts").fetchall()
+    return [r[0] for r in rows]
+
+
+def district_week_features(daily, population=None, weeks=None, districts=None):
+    """
+    Feature matrix with one row per (district, week_end) in one vectorized pass.
+    daily: DataFrame of district, day, cases. weeks: week_end dates to emit (default:
+    every week covered by daily). districts: extra districts to include with zero cases.
+    """
+    names = sorted(set(daily["district"]) | set(districts or ()) |
+                   (set(population["district"]) if population is not None else set()))
+    if weeks is None:
+        if daily.empty:
+            return pd.DataFrame(columns=["district", "week_end"] + FEATURE_COLUMNS)
+        weeks = pd.date_range(week_end(daily["day"].min()), week_end(daily["day"].max()), freq="7D")
+    weeks = pd.DatetimeIndex(weeks).normalize()
+    if len(weeks) == 0 or not names:
+        return pd.DataFrame(columns=["district", "week_end"] + FEATURE_COLUMNS)
+    first = weeks.min() - pd.Timedelta(days=HISTORY_DAYS)
+    days = pd.date_range(first, weeks.max(), freq="D")
+    matrix = (daily.pivot_table(index="day", columns="district", values="cases", aggfunc="sum")
+              .reindex(index=days, columns=names, fill_value=0).fillna(0).to_numpy(dtype=np.int64))
+    # cumulative sums turn every rolling window into one subtraction
+    csum = np.vstack([np.zeros((1, len(names)), dtype=np.int64), np.cumsum(matrix, axis=0)])
+    at = (weeks - first).days.to_numpy() + 1  # row in csum holding totals through each week_end
+
+    def window(end_rows, length):
+        return csum[end_rows] - csum[np.maximum(end_rows - length, 0)]
+
+    feats = {f"cases_{w}d": window(at, w) for w in WINDOWS}
+    prev7 = window(at - 7, 7)
+    feats["growth_7d"] = (feats["cases_7d"] + 1) / (prev7 + 1)
+    for k in LAG_WEEKS:
+        feats[f"cases_7d_lag{k}"] = window(at - 7 * k, 7)
+    out = pd.DataFrame({
+        "district": np.tile(names, len(weeks)),
+        "week_end": np.repeat(weeks.to_numpy(), len(names)),
+    })
+    for col, values in feats.items():
+        out[col] = values.reshape(-1)
+    if population is not None:
+        out = out.merge(population, on="district", how="left")
+        out["per_1000"] = out["cases_7d"] / (out["population"] / 1000)
+    else:
+        out["population"] = np.nan
+        out["per_1000"] = out["cases_7d"].astype(float)
+    return out[["district", "week_end"] + FEATURE_COLUMNS]
+
+
+@timed("scoring")
+def build_features(start_week=None, end_week=None, population=None):
+    """Features for every district and every week_end in [start_week, end_week] straight from the DB."""
+    end_week = week_end(end_week if end_week is not None else pd.Timestamp.now())
+    if start_week is None:
+        daily = daily_counts(end=end_week)
+        if daily.empty:
+            return district_week_features(daily, population, weeks=[])
+        start_week = daily["day"].min()
+    else:
+        daily = daily_counts(start=week_end(start_week) - pd.Timedelta(days=HISTORY_DAYS), end=end_week)
+    weeks = pd.date_range(week_end(start_week), end_week, freq="7D")
+    # every known district gets a row each week, including weeks without cases
+    return district_week_features(daily, population, weeks=weeks, districts=known_districts())
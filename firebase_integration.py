@@ -1,45 +1,247 @@
-
 """
 firebase_integration.py
 
-This is an example scaffold showing how to initialize Firebase Admin SDK and write/read to Firestore.
-You must provide a service account JSON and set the path in GOOGLE_APPLICATION_CREDENTIALS env var,
-or pass the credentials JSON explicitly.
+Batched, incremental Firestore sync for the cases table.
+
+One Firestore client is created per process and reused (get_client). Local
+changes are pushed with batched writes of up to 500 documents (Firestore's batch
+limit), selecting only rows whose row_version is newer than the last push.
+Remote changes are pulled with a paginated query on updated_at newer than the
+last pull, then upserted locally. Both watermarks live in the sync_state table.
+Rows that arrive by pull are not pushed back, and documents this database wrote
+itself are skipped on pull. Deletions are not propagated in either direction,
+since archiving also deletes hot rows.
+
+You must provide a service account JSON (argument or GOOGLE_APPLICATION_CREDENTIALS).
+Alternatively, set FIRESTORE_EMULATOR_HOST to use the local emulator. Tests can
+inject any object with the Firestore client surface via set_client().
 
 Install dependencies:
     pip install firebase-admin google-cloud-firestore
 
 Example usage:
     export GOOGLE_APPLICATION_CREDENTIALS="/path/to/serviceAccount.json"
-    python firebase_integration.py
+    python firebase_integration.py sync
+    FIRESTORE_EMULATOR_HOST=localhost:8080 python firebase_integration.py push
 """
+import argparse
+import itertools
 import os
-import firebase_admin
-from firebase_admin import credentials, auth
-from google.cloud import firestore
+import threading
+import uuid
+from datetime import datetime, timezone
+
+from utils import CASE_COLUMNS, _case_version, add_cases_bulk, connection, init_db, read_snapshot, transaction
+
+try:
+    import firebase_admin
+    from firebase_admin import credentials
+    from google.cloud import firestore
+except Exception:
+    firebase_admin = credentials = firestore = None
+
+COLLECTION = "cases"
+BATCH_LIMIT = 500  # Firestore maximum writes per batch
+PUSH_WATERMARK = "firestore_push_version"
+PULL_WATERMARK = "firestore_pull_updated_at"
+ORIGIN_KEY = "firestore_origin"
+EMULATOR_PROJECT = os.environ.get("FIREBASE_PROJECT", "surveilai-dev")
 
+_client = None
+_client_lock = threading.Lock()
+
+
+# ---------- client ----------
 def init_firebase(service_account_path=None):
-    if service_account_path:
-        cred = credentials.Certificate(service_account_path)
+    """Initialise the Firebase app once and return a Firestore client."""
+    if firestore is None:
+        raise RuntimeError("Firestore sync requires firebase-admin and google-cloud-firestore")
+    if os.environ.get("FIRESTORE_EMULATOR_HOST"):
+        # the emulator needs no credentials
+        return firestore.Client(project=EMULATOR_PROJECT)
+    if not firebase_admin._apps:
+        cred = (credentials.Certificate(service_account_path) if service_account_path
+                else credentials.ApplicationDefault())
         firebase_admin.initialize_app(cred)
-    else:
-        # will use GOOGLE_APPLICATION_CREDENTIALS env var
-        cred = credentials.ApplicationDefault()
-        firebase_admin.initialize_app(cred)
-    db = firestore.Client()
-    return db
+    from firebase_admin import firestore as admin_firestore
+    return admin_firestore.client()
+
+
+def get_client(service_account_path=None):
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = init_firebase(service_account_path)
+        return _client
+
+
+def set_client(client):
+    """Use client (e.g. an emulator client or an in-memory fake) for every later call; None resets."""
+    global _client
+    with _client_lock:
+        _client = client
+
+
+def _server_timestamp():
+    return firestore.SERVER_TIMESTAMP if firestore is not None else datetime.now(timezone.utc)
+
+
+# ---------- watermarks ----------
+def get_watermark(key):
+    with connection() as conn:
+        row = conn.execute("SELECT value FROM sync_state WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+
+def origin_id():
+    """Stable id of this database, stamped on pushed documents so pulls can skip our own writes."""
+    with transaction() as conn:
+        value = get_watermark(ORIGIN_KEY)
+        if value is None:
+            value = uuid.uuid4().hex
+            _set_watermark(conn, ORIGIN_KEY, value)
+    return value
+
 
-def write_case_to_firestore(case_dict, collection="cases"):
-    db = init_firebase()
-    doc_ref = db.collection(collection).document(case_dict.get('case_id'))
-    doc_ref.set(case_dict)
+def _set_watermark(conn, key, value):
+    conn.execute("INSERT INTO sync_state (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+                 (key, None if value is None else str(value)))
+
+
+# ---------- push ----------
+def _document(case, origin):
+    doc = {c: case.get(c) for c in CASE_COLUMNS}
+    doc["updated_at"] = _server_timestamp()
+    doc["origin"] = origin
+    return doc
+
+
+def push_cases(cases, client=None, collection=COLLECTION, batch_size=BATCH_LIMIT, origin=None):
+    """Write case dicts as documents keyed by case_id in batches of up to 500; returns documents written."""
+    client = client or get_client()
+    batch_size = min(batch_size, BATCH_LIMIT)
+    coll = client.collection(collection)
+    origin = origin or origin_id()
+    written = 0
+    it = iter(cases)
+    while True:
+        chunk = list(itertools.islice(it, batch_size))
+        if not chunk:
+            break
+        batch = client.batch()
+        for case in chunk:
+            batch.set(coll.document(str(case["case_id"])), _document(case, origin))
+        batch.commit()
+        written += len(chunk)
+    return written
+
+
+def push_changes(client=None, collection=COLLECTION, batch_size=BATCH_LIMIT):
+    """Push cases inserted or updated since the last push; returns documents written."""
+    origin = origin_id()
+    with connection() as conn:
+        with read_snapshot(conn):
+            since = int(get_watermark(PUSH_WATERMARK) or 0)
+            version = _case_version(conn)
+            cur = conn.execute(f"SELECT {', '.join(CASE_COLUMNS)} FROM cases WHERE row_version > ? AND row_version <= ?",
+                               (since, version))
+            written = push_cases((dict(zip(CASE_COLUMNS, r)) for r in cur), client, collection, batch_size, origin)
+    with transaction() as conn:
+        _set_watermark(conn, PUSH_WATERMARK, version)
+    return written
+
+
+# ---------- pull ----------
+def _as_utc(value):
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value
+
+
+def iter_remote_changes(since=None, client=None, collection=COLLECTION, page_size=BATCH_LIMIT):
+    """Yield (updated_at, document dict) for documents updated after since, oldest first, one page per query."""
+    client = client or get_client()
+    query = client.collection(collection).order_by("updated_at")
+    if since is not None:
+        query = query.where("updated_at", ">", _as_utc(since))
+    last = None
+    while True:
+        page = query.start_after(last) if last is not None else query
+        docs = list(page.limit(page_size).stream())
+        for doc in docs:
+            data = doc.to_dict()
+            yield data.get("updated_at"), data
+        if len(docs) < page_size:
+            break
+        last = docs[-1]
+
+
+def pull_changes(client=None, collection=COLLECTION, page_size=BATCH_LIMIT):
+    """Upsert documents other databases changed since the last pull into cases; returns rows applied."""
+    since = get_watermark(PULL_WATERMARK)
+    origin = origin_id()
+    applied = 0
+    newest = _as_utc(since) if since else None
+    pages = iter_remote_changes(since, client, collection, page_size)
+    while True:
+        page = list(itertools.islice(pages, page_size))
+        if not page:
+            break
+        rows = []
+        for updated_at, doc in page:
+            if updated_at is not None:
+                newest = max(newest, _as_utc(updated_at)) if newest else _as_utc(updated_at)
+            if doc.get("case_id") is None or doc.get("origin") == origin:
+                continue
+            rows.append({c: doc.get(c) for c in CASE_COLUMNS})
+        with transaction() as conn:
+            before = _case_version(conn)
+            add_cases_bulk(rows, on_conflict="replace")
+            # pulled rows should not travel back on the next push
+            if int(get_watermark(PUSH_WATERMARK) or 0) >= before:
+                _set_watermark(conn, PUSH_WATERMARK, _case_version(conn))
+            if newest is not None:
+                _set_watermark(conn, PULL_WATERMARK, newest.isoformat())
+        applied += len(rows)
+    return applied
+
+
+def sync(client=None, collection=COLLECTION):
+    """Push local changes, then pull remote ones. Returns {"pushed": n, "pulled": n}."""
+    client = client or get_client()
+    return {"pushed": push_changes(client, collection), "pulled": pull_changes(client, collection)}
+
+
+# ---------- single-document helpers ----------
+def write_case_to_firestore(case_dict, collection=COLLECTION):
+    push_cases([case_dict], collection=collection)
     return True
 
-def read_cases_from_firestore(limit=100):
-    db = init_firebase()
-    docs = db.collection("cases").limit(limit).stream()
-    results = [d.to_dict() for d in docs]
-    return results
+
+def read_cases_from_firestore(limit=100, collection=COLLECTION):
+    docs = get_client().collection(collection).limit(limit).stream()
+    return [d.to_dict() for d in docs]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Sync surveilai cases with Firestore")
+    parser.add_argument("action", choices=["push", "pull", "sync"], nargs="?", default="sync")
+    parser.add_argument("--service-account", default=None, help="service account JSON (default: ADC)")
+    parser.add_argument("--collection", default=COLLECTION)
+    args = parser.parse_args(argv)
+    init_db()
+    client = get_client(args.service_account)
+    if args.action == "push":
+        print(f"Pushed {push_changes(client, args.collection)} cases.")
+    elif args.action == "pull":
+        print(f"Pulled {pull_changes(client, args.collection)} cases.")
+    else:
+        result = sync(client, args.collection)
+        print(f"Pushed {result['pushed']} cases, pulled {result['pulled']}.")
+    return 0
+
 
 if __name__ == "__main__":
-    print("Firebase scaffold. Ensure service account and credentials are configured.")
+    raise SystemExit(main())
@@ -0,0 +1,342 @@
+"""
+geo.py
+
+Boundary helpers:
+- a content-addressed cache of uploaded shapefile zips, converted once to
+  GeoParquet in EPSG:4326 and served from an in-memory LRU afterwards;
+- point-in-polygon district lookup backed by an STRtree over prepared polygons,
+  built once per boundary GeoDataFrame.
+"""
+import hashlib
+import io
+import json
+import os
+import tempfile
+import threading
+import weakref
+import zipfile
+from collections import OrderedDict
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+try:
+    import pyarrow  # noqa: F401  (GeoParquet support)
+except Exception:
+    pyarrow = None
+
+BOUNDARY_CACHE_DIR = os.getenv("SURVEILAI_BOUNDARY_CACHE", os.path.join(os.path.dirname(__file__), "boundary_cache"))
+BOUNDARY_CACHE_MAX_FILES = int(os.getenv("SURVEILAI_BOUNDARY_CACHE_FILES", "20"))
+BOUNDARY_MEMORY_SLOTS = int(os.getenv("SURVEILAI_BOUNDARY_MEMORY_SLOTS", "4"))
+
+# attribute columns tried, in order, for each administrative level
+DISTRICT_FIELDS = ['district', 'District', 'NAME_2', 'ADM2_NAME', 'ADM1_NAME', 'region', 'Region']
+REGION_FIELDS = ['region', 'Region', 'ADM1_NAME', 'NAME_1']
+COMMUNITY_FIELDS = ['community', 'COMMUNITY', 'NAME_3']
+LEVEL_FIELDS = {'district': DISTRICT_FIELDS, 'region': REGION_FIELDS, 'community': COMMUNITY_FIELDS}
+
+
+def to_wgs84(gdf):
+    if gdf.crs is None:
+        return gdf.set_crs(epsg=4326)
+    if gdf.crs.to_epsg() == 4326:
+        return gdf
+    return gdf.to_crs(epsg=4326)
+
+
+# ---------- BOUNDARY CACHE ----------
+_boundaries = OrderedDict()
+_boundaries_lock = threading.Lock()
+
+
+def boundary_key(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _read_shapefile_zip(data):
+    # each upload gets its own scratch directory, so concurrent uploads never collide
+    with tempfile.TemporaryDirectory(prefix="surveilai_shp_") as tmpdir:
+        with zipfile.ZipFile(io.BytesIO(data)) as z:
+            z.extractall(tmpdir)
+        shp = None
+        for root, _, files in os.walk(tmpdir):
+            for f in sorted(files):
+                if f.lower().endswith(".shp"):
+                    shp = os.path.join(root, f)
+                    break
+            if shp:
+                break
+        if not shp:
+            raise ValueError("No .shp file found in zip")
+        return to_wgs84(gpd.read_file(shp))
+
+
+def _cache_path(key):
+    return os.path.join(BOUNDARY_CACHE_DIR, f"{key}.parquet")
+
+
+def _evict_disk_cache():
+    try:
+        entries = [os.path.join(BOUNDARY_CACHE_DIR, f) for f in os.listdir(BOUNDARY_CACHE_DIR) if f.endswith(".parquet")]
+    except FileNotFoundError:
+        return
+    entries.sort(key=lambda p: os.path.getmtime(p), reverse=True)
+    for path in entries[BOUNDARY_CACHE_MAX_FILES:]:
+        for stale in (path, path[:-len(".parquet")] + ".layers.json"):
+            try:
+                os.remove(stale)
+            except OSError:
+                pass
+
+
+def _load_from_disk(key):
+    path = _cache_path(key)
+    if pyarrow is None or not os.path.exists(path):
+        return None
+    try:
+        gdf = gpd.read_parquet(path, memory_map=True)
+    except Exception:
+        return None
+    os.utime(path)  # mtime doubles as last-used time for eviction
+    return gdf
+
+
+def _store_on_disk(key, gdf):
+    if pyarrow is None:
+        return
+    os.makedirs(BOUNDARY_CACHE_DIR, exist_ok=True)
+    # write under a unique name then rename, so readers never see a partial file
+    fd, tmp = tempfile.mkstemp(dir=BOUNDARY_CACHE_DIR, suffix=".parquet.tmp")
+    os.close(fd)
+    try:
+        gdf.to_parquet(tmp)
+        os.replace(tmp, _cache_path(key))
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    _evict_disk_cache()
+
+
+def load_boundaries_from_zip(data):
+    """
+    Return (key, gdf) for a zipped shapefile given as bytes. key is the SHA-256 of the
+    zip; known zips come from memory or the on-disk GeoParquet cache without touching
+    the shapefile. The returned GeoDataFrame is shared between callers: do not modify it.
+    """
+    key = boundary_key(data)
+    with _boundaries_lock:
+        gdf = _boundaries.get(key)
+        if gdf is not None:
+            _boundaries.move_to_end(key)
+            return key, gdf
+    gdf = _load_from_disk(key)
+    if gdf is None:
+        gdf = _read_shapefile_zip(data)
+        _store_on_disk(key, gdf)
+    gdf.attrs["boundary_key"] = key  # lets derived caches (simplified layers) find this layer's key
+    with _boundaries_lock:
+        gdf = _boundaries.setdefault(key, gdf)
+        _boundaries.move_to_end(key)
+        while len(_boundaries) > BOUNDARY_MEMORY_SLOTS:
+            _boundaries.popitem(last=False)
+    return key, gdf
+
+
+def boundaries_by_key(key):
+    """Previously loaded boundaries by content key, or None if no longer cached."""
+    with _boundaries_lock:
+        gdf = _boundaries.get(key)
+        if gdf is not None:
+            _boundaries.move_to_end(key)
+            return gdf
+    gdf = _load_from_disk(key)
+    if gdf is not None:
+        gdf.attrs["boundary_key"] = key
+        with _boundaries_lock:
+            gdf = _boundaries.setdefault(key, gdf)
+    return gdf
+
+
+# ---------- SIMPLIFIED LAYERS ----------
+# (minimum map zoom, tolerance in degrees): about one screen pixel at that zoom
+SIMPLIFY_LEVELS = ((0, 0.04), (7, 0.01), (9, 0.0025), (11, 0.0006), (13, 0.00015))
+_layers = OrderedDict()
+_layers_lock = threading.Lock()
+
+
+def _layers_path(key):
+    return os.path.join(BOUNDARY_CACHE_DIR, f"{key}.layers.json")
+
+
+def _layer_key(gdf):
+    key = gdf.attrs.get("boundary_key")
+    if key is None:
+        key = hashlib.sha256(b"".join(shapely.to_wkb(np.asarray(gdf.geometry.values, dtype=object)))).hexdigest()
+    return key
+
+
+def _simplify(geoms, tolerance):
+    """Simplify a polygon layer without opening gaps or overlaps between neighbours, then quantize."""
+    try:
+        # treats shared edges once, so neighbouring districts stay edge-matched
+        out = shapely.coverage_simplify(geoms, tolerance)
+    except Exception:
+        out = shapely.simplify(geoms, tolerance, preserve_topology=True)
+    out = shapely.set_precision(out, tolerance / 4)
+    # slivers below the grid collapse to empty; keep them at full resolution instead
+    empty = shapely.is_empty(out) | shapely.is_missing(out)
+    out[empty] = geoms[empty]
+    return out
+
+
+def _feature_collection(geoms, names):
+    features = ",".join(
+        '{"type":"Feature","id":%s,"properties":{"district":%s},"geometry":%s}' % (json.dumps(n), json.dumps(n), g)
+        for n, g in zip(names, shapely.to_geojson(geoms)))
+    return '{"type":"FeatureCollection","features":[%s]}' % features
+
+
+def build_simplified_layers(gdf, levels=SIMPLIFY_LEVELS):
+    """{min_zoom: GeoJSON FeatureCollection string} with one feature per district, id = district name."""
+    gdf = to_wgs84(gdf)
+    fields = resolve_fields(gdf.columns)
+    names = gdf[fields["district"]].astype(str).tolist() if "district" in fields else [str(i) for i in range(len(gdf))]
+    geoms = shapely.make_valid(np.asarray(gdf.geometry.values, dtype=object))
+    return {zoom: _feature_collection(_simplify(geoms, tolerance), names) for zoom, tolerance in levels}
+
+
+def simplified_layers(gdf):
+    """
+    Simplified, quantized GeoJSON of a boundary layer at every SIMPLIFY_LEVELS tolerance,
+    parsed once and cached per boundary key in memory and next to the GeoParquet cache.
+    Returns {min_zoom: FeatureCollection dict}; the dicts are shared, do not modify them.
+    """
+    key = _layer_key(gdf)
+    with _layers_lock:
+        layers = _layers.get(key)
+        if layers is not None:
+            _layers.move_to_end(key)
+            return layers
+    path = _layers_path(key)
+    text = None
+    if os.path.exists(path):
+        try:
+            with open(path) as f:
+                text = {int(z): t for z, t in json.load(f).items()}
+        except (OSError, ValueError):
+            text = None
+    if text is None:
+        text = build_simplified_layers(gdf)
+        os.makedirs(BOUNDARY_CACHE_DIR, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=BOUNDARY_CACHE_DIR, suffix=".layers.tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(text, f)
+        os.replace(tmp, path)
+    layers = {zoom: json.loads(t) for zoom, t in text.items()}
+    with _layers_lock:
+        layers = _layers.setdefault(key, layers)
+        _layers.move_to_end(key)
+        while len(_layers) > BOUNDARY_MEMORY_SLOTS:
+            _layers.popitem(last=False)
+    return layers
+
+
+def layer_for_zoom(gdf, zoom):
+    """The simplified FeatureCollection suited to a map zoom level."""
+    layers = simplified_layers(gdf)
+    fitting = [z for z in layers if z <= zoom]
+    return layers[max(fitting) if fitting else min(layers)]
+
+
+def join_properties(layer, values, name):
+    """
+    Copy of a cached FeatureCollection with values[feature id] added as property name.
+    Geometry objects are shared, not copied, so this is cheap enough for every rerun
+    and callers (e.g. folium, which writes styles into properties) never touch the cache.
+    """
+    features = [{"type": "Feature", "id": f["id"], "properties": {**f["properties"], name: values.get(f["id"])},
+                 "geometry": f["geometry"]} for f in layer["features"]]
+    return {"type": "FeatureCollection", "features": features}
+
+
+# ---------- DISTRICT LOOKUP ----------
+def resolve_fields(columns):
+    """Map each level (district/region/community) to the first candidate column present."""
+    out = {}
+    for level, candidates in LEVEL_FIELDS.items():
+        for candidate in candidates:
+            if candidate in columns:
+                out[level] = candidate
+                break
+    return out
+
+
+class DistrictLocator:
+    """
+    Spatial index over a boundary layer. Build once per shapefile and reuse:
+    assign_districts() labels whole arrays of points in one STRtree query.
+    """
+
+    def __init__(self, gdf):
+        gdf = to_wgs84(gdf)
+        self.geoms = np.asarray(gdf.geometry.values, dtype=object)
+        shapely.prepare(self.geoms)
+        self.tree = shapely.STRtree(self.geoms)
+        self.fields = resolve_fields(gdf.columns)
+        self.values = {level: gdf[col].to_numpy(dtype=object) for level, col in self.fields.items()}
+
+    def match(self, lats, lons):
+        """Index of the first polygon containing each point, -1 where none does."""
+        lats = np.asarray(lats, dtype=float)
+        lons = np.asarray(lons, dtype=float)
+        out = np.full(lats.shape[0], -1, dtype=np.int64)
+        ok = np.isfinite(lats) & np.isfinite(lons)
+        if not ok.any():
+            return out
+        pts = shapely.points(lons[ok], lats[ok])
+        pt_idx, poly_idx = self.tree.query(pts, predicate='within')
+        if pt_idx.size:
+            # several polygons may contain a point; keep the lowest row, like iloc[0]
+            order = np.lexsort((poly_idx, pt_idx))
+            pt_idx, poly_idx = pt_idx[order], poly_idx[order]
+            first = np.r_[True, pt_idx[1:] != pt_idx[:-1]]
+            hits = np.full(pts.shape[0], -1, dtype=np.int64)
+            hits[pt_idx[first]] = poly_idx[first]
+            out[ok] = hits
+        return out
+
+    def assign_districts(self, lats, lons):
+        """DataFrame with one row per point and a column per resolved level (NaN where unmatched)."""
+        idx = self.match(lats, lons)
+        hit = idx >= 0
+        cols = {}
+        for level, values in self.values.items():
+            col = np.full(idx.shape[0], np.nan, dtype=object)
+            col[hit] = values[idx[hit]]
+            cols[level] = col
+        return pd.DataFrame(cols, index=pd.RangeIndex(idx.shape[0]))
+
+    def locate(self, lat, lon):
+        idx = self.match([lat], [lon])[0]
+        if idx < 0:
+            return {}
+        return {level: values[idx] for level, values in self.values.items()}
+
+
+_locators = {}
+_locators_lock = threading.Lock()
+
+
+def locator_for(gdf):
+    """Cached DistrictLocator for this GeoDataFrame object (rebuilt if a new frame is passed)."""
+    key = id(gdf)
+    with _locators_lock:
+        locator = _locators.get(key)
+    if locator is None:
+        locator = DistrictLocator(gdf)
+        with _locators_lock:
+            _locators[key] = locator
+        weakref.finalize(gdf, _locators.pop, key, None)
+    return locator
@@ -0,0 +1,220 @@
+"""
+ingest.py
+
+Streaming importer for case line lists (CSV or JSON Lines).
+
+Rows are read one at a time, validated, classified with the rules from config.yaml
+and written through utils.add_cases_bulk, so memory use does not grow with file size.
+Rejected rows are counted and reported (and optionally written to a CSV).
+
+Usage:
+    python ingest.py line_list.csv
+    python ingest.py line_list.jsonl --rejects rejects.csv --on-conflict ignore
+"""
+import argparse
+import csv
+import io
+import json
+import uuid
+from datetime import date, datetime
+
+from classification import RuleSet, compile_rules
+from settings import load_config
+from utils import CONFIG, add_cases_bulk, init_db, BULK_BATCH_SIZE
+
+SEXES = {"m": "Male", "male": "Male", "f": "Female", "female": "Female",
+         "o": "Other", "other": "Other", "u": "Unknown", "unknown": "Unknown", "": "Unknown"}
+TRUE_VALUES = {"1", "true", "yes", "y", "positive", "pos"}
+FALSE_VALUES = {"0", "false", "no", "n", "negative", "neg", "unknown", "presumed", ""}
+MAX_REPORTED_ERRORS = 1000
+
+
+def _text(value):
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value or None
+
+
+def _parse_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    value = _text(value)
+    if value is None:
+        raise ValueError("onset_date is required")
+    try:
+        return datetime.fromisoformat(value).date()
+    except ValueError:
+        pass
+    for fmt in ("%d/%m/%Y", "%d-%m-%Y", "%Y/%m/%d"):
+        try:
+            return datetime.strptime(value, fmt).date()
+        except ValueError:
+            continue
+    raise ValueError(f"unrecognised onset_date {value!r}")
+
+
+def _parse_bool(value, field):
+    if isinstance(value, bool):
+        return value
+    if value is None:
+        return False
+    text = str(value).strip().lower()
+    if text in TRUE_VALUES:
+        return True
+    if text in FALSE_VALUES:
+        return False
+    raise ValueError(f"invalid {field} {value!r}")
+
+
+def _parse_coords(raw):
+    lat, lon = raw.get("lat"), raw.get("lon")
+    if _text(lat) is None and _text(lon) is None:
+        return _text(raw.get("coords"))
+    lat, lon = float(lat), float(lon)
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        raise ValueError(f"coordinates out of range ({lat}, {lon})")
+    return f"{lat},{lon}"
+
+
+def validate_row(raw, config_rules=None, today=None):
+    """
+    Normalise one raw row (dict of strings) into a cases-table entry.
+    Returns (entry, None) on success or (None, error message) if the row is rejected.
+    """
+    try:
+        onset = _parse_date(raw.get("onset_date"))
+        if onset > (today or date.today()):
+            raise ValueError(f"onset_date {onset} is in the future")
+        age = _text(raw.get("age"))
+        if age is not None:
+            age = int(float(age))
+            if not 0 <= age <= 120:
+                raise ValueError(f"age out of range: {age}")
+        sex = SEXES.get((_text(raw.get("sex")) or "").lower())
+        if sex is None:
+            raise ValueError(f"invalid sex {raw.get('sex')!r}")
+        lab = raw.get("lab_positive", raw.get("lab_result"))
+        entry = {
+            "case_id": _text(raw.get("case_id")) or uuid.uuid4().hex,  # 128 bits: no collisions in large backfills
+            "name": _text(raw.get("name")),
+            "sex": sex,
+            "age": age,
+            "reporter": _text(raw.get("reporter")),
+            "region": _text(raw.get("region")),
+            "district": _text(raw.get("district")),
+            "community": _text(raw.get("community")),
+            "onset_date": onset.isoformat(),
+            "lab_positive": int(_parse_bool(lab, "lab_positive")),
+            "symptoms": _text(raw.get("symptoms")),
+            "coords": _parse_coords(raw),
+        }
+    except (TypeError, ValueError) as e:
+        return None, str(e)
+    rules = config_rules if isinstance(config_rules, RuleSet) else compile_rules(config_rules)
+    entry["classification"] = rules.classify(entry)
+    return entry, None
+
+
+def iter_rows(source, fmt=None):
+    """
+    Yield (line_no, raw_dict) from a path or a binary/text file object without loading it.
+    fmt is 'csv' or 'jsonl'; by default it is inferred from the file name.
+    """
+    name = source if isinstance(source, str) else getattr(source, "name", "")
+    fmt = fmt or ("jsonl" if str(name).lower().endswith((".jsonl", ".ndjson", ".json")) else "csv")
+    if isinstance(source, str):
+        f = open(source, "r", encoding="utf-8-sig", newline="")
+        close = True
+    else:
+        f = source if isinstance(source, io.TextIOBase) else io.TextIOWrapper(source, encoding="utf-8-sig", newline="")
+        close = False
+    try:
+        if fmt == "csv":
+            reader = csv.DictReader(f)
+            for row in reader:
+                yield reader.line_num, row
+        elif fmt == "jsonl":
+            for line_no, line in enumerate(f, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    row = json.loads(line)
+                except json.JSONDecodeError as e:
+                    row = {"_error": f"invalid JSON: {e.msg}"}
+                if not isinstance(row, dict):
+                    row = {"_error": "JSON line is not an object"}
+                yield line_no, row
+        else:
+            raise ValueError(f"Unsupported format {fmt!r}")
+    finally:
+        if close:
+            f.close()
+        elif not isinstance(source, io.TextIOBase):
+            # don't let the wrapper close the caller's stream
+            f.detach()
+
+
+def load_classification_rules(path=CONFIG):
+    return load_config(path).classification_rules
+
+
+def import_cases(source, fmt=None, config_rules=None, batch_size=BULK_BATCH_SIZE,
+                 on_conflict="ignore", rejects_path=None):
+    """
+    Stream a CSV/JSONL line list into the cases table.
+    Returns a report dict: accepted, rejected, written (rows actually inserted) and
+    errors, a list of (line_no, message) capped at MAX_REPORTED_ERRORS.
+    """
+    if config_rules is None:
+        config_rules = load_classification_rules()
+    rules = compile_rules(config_rules)
+    report = {"accepted": 0, "rejected": 0, "written": 0, "errors": []}
+    rejects = None
+    rejects_file = open(rejects_path, "w", newline="") if rejects_path else None
+    try:
+        if rejects_file:
+            rejects = csv.writer(rejects_file)
+            rejects.writerow(["line", "error", "row"])
+
+        def accepted_rows():
+            for line_no, raw in iter_rows(source, fmt):
+                entry, error = (None, raw["_error"]) if "_error" in raw else validate_row(raw, rules)
+                if entry is None:
+                    report["rejected"] += 1
+                    if len(report["errors"]) < MAX_REPORTED_ERRORS:
+                        report["errors"].append((line_no, error))
+                    if rejects:
+                        rejects.writerow([line_no, error, json.dumps(raw, default=str)])
+                    continue
+                report["accepted"] += 1
+                yield entry
+
+        report["written"] = add_cases_bulk(accepted_rows(), batch_size=batch_size, on_conflict=on_conflict)
+    finally:
+        if rejects_file:
+            rejects_file.close()
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Import a CSV/JSONL case line list into surveilai.db")
+    parser.add_argument("path")
+    parser.add_argument("--format", choices=["csv", "jsonl"], default=None)
+    parser.add_argument("--batch-size", type=int, default=BULK_BATCH_SIZE)
+    parser.add_argument("--on-conflict", choices=["abort", "ignore", "replace"], default="ignore")
+    parser.add_argument("--rejects", default=None, help="write rejected rows to this CSV")
+    args = parser.parse_args(argv)
+    init_db()
+    report = import_cases(args.path, fmt=args.format, batch_size=args.batch_size,
+                          on_conflict=args.on_conflict, rejects_path=args.rejects)
+    print(f"Accepted {report['accepted']} rows ({report['written']} written), rejected {report['rejected']}.")
+    for line_no, error in report["errors"][:20]:
+        print(f"  line {line_no}: {error}")
+    return 0 if report["rejected"] == 0 else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
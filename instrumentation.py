@@ -0,0 +1,231 @@
+"""
+instrumentation.py
+
+Opt-in timing for the hot paths: database, geo and clustering helpers in utils,
+the scoring pipeline and notification sends.
+
+Off by default. Enable with SURVEILAI_METRICS=1 (or enable() at runtime); while
+disabled a timed function costs one flag check per call. When enabled every call
+lands in a per-function latency histogram, and calls slower than
+SURVEILAI_SLOW_MS (default 250 ms) are kept in a bounded slow-call log and
+written to the "surveilai.slow" logger.
+
+    @timed("db")
+    def query_rollups(...): ...
+
+    with span("app", "rerun"): ...       # time an arbitrary block
+    write_prometheus("metrics.prom")     # Prometheus text format (node_exporter textfile collector)
+
+start_profile() / stop_profile() capture a cProfile of one block, e.g. a single
+Streamlit rerun requested from the admin "metrics" page.
+"""
+import cProfile
+import functools
+import io
+import logging
+import os
+import pstats
+import tempfile
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+
+import pandas as pd
+
+ENABLED = os.getenv("SURVEILAI_METRICS", "").lower() in ("1", "true", "yes", "on")
+SLOW_SECONDS = float(os.getenv("SURVEILAI_SLOW_MS", "250")) / 1000
+METRICS_FILE = os.getenv("SURVEILAI_METRICS_FILE", "metrics.prom")
+SLOW_LOG_SIZE = 200
+# upper bounds in seconds, as in Prometheus' default histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+log = logging.getLogger("surveilai.slow")
+
+
+class Histogram:
+    """Cumulative-bucket latency histogram for one (group, name)."""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)  # last slot is +Inf
+        self.total = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        i = 0
+        while i < len(BUCKETS) and seconds > BUCKETS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.total += seconds
+        self.count += 1
+        self.max = max(self.max, seconds)
+
+    def cumulative(self):
+        out, running = [], 0
+        for n in self.counts:
+            running += n
+            out.append(running)
+        return out
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-quantile, capped at the largest observation."""
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        for bound, running in zip(BUCKETS + (None,), self.cumulative()):
+            if running >= target:
+                return min(bound, self.max) if bound is not None else self.max
+        return self.max
+
+
+_lock = threading.Lock()
+_histograms = {}
+_slow = deque(maxlen=SLOW_LOG_SIZE)
+
+
+def enable(flag=True):
+    global ENABLED
+    ENABLED = bool(flag)
+
+
+def enabled():
+    return ENABLED
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
+        _slow.clear()
+
+
+def _describe(args, kwargs, limit=120):
+    parts = []
+    for a in args:
+        if isinstance(a, pd.DataFrame):
+            parts.append(f"<DataFrame {len(a)} rows>")
+        elif isinstance(a, (list, tuple)) and len(a) > 5:
+            parts.append(f"<{type(a).__name__} of {len(a)}>")
+        else:
+            parts.append(repr(a))
+    parts += [f"{k}={v!r}" for k, v in kwargs.items()]
+    text = ", ".join(parts)
+    return text if len(text) <= limit else text[:limit - 3] + "..."
+
+
+def record(group, name, seconds, detail=None):
+    """Add one observation; slow ones also go to the slow-call log."""
+    with _lock:
+        hist = _histograms.get((group, name))
+        if hist is None:
+            hist = _histograms[(group, name)] = Histogram()
+        hist.observe(seconds)
+        if seconds >= SLOW_SECONDS:
+            _slow.append({"at": datetime.now().isoformat(timespec="seconds"), "group": group, "name": name,
+                          "ms": round(seconds * 1000, 1), "detail": detail or ""})
+    if seconds >= SLOW_SECONDS:
+        log.warning("slow %s.%s %.1f ms %s", group, name, seconds * 1000, detail or "")
+
+
+def timed(group, name=None):
+    """Decorator recording the wall time of each call under (group, name or the function's name)."""
+    def decorate(fn):
+        label = name or fn.__name__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return fn(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - started
+                record(group, label, elapsed, _describe(args, kwargs) if elapsed >= SLOW_SECONDS else None)
+        return wrapper
+    return decorate
+
+
+@contextmanager
+def span(group, name):
+    """Time a block of code (no-op while disabled)."""
+    if not ENABLED:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(group, name, time.perf_counter() - started)
+
+
+# ---------- reporting ----------
+def summary():
+    """DataFrame with one row per timed function: calls, total, mean, p50, p95, max (seconds)."""
+    with _lock:
+        rows = [(g, n, h.count, h.total, h.total / h.count if h.count else 0.0, h.quantile(0.5), h.quantile(0.95), h.max)
+                for (g, n), h in sorted(_histograms.items())]
+    return pd.DataFrame(rows, columns=["group", "name", "calls", "total_s", "mean_s", "p50_s", "p95_s", "max_s"])
+
+
+def histogram(group, name):
+    """DataFrame of bucket upper bound (le) and calls in that bucket for one function."""
+    with _lock:
+        hist = _histograms.get((group, name))
+        counts = list(hist.counts) if hist else [0] * (len(BUCKETS) + 1)
+    return pd.DataFrame({"le": [str(b) for b in BUCKETS] + ["+Inf"], "calls": counts})
+
+
+def slow_calls():
+    with _lock:
+        return pd.DataFrame(list(reversed(_slow)), columns=["at", "group", "name", "ms", "detail"])
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def prometheus_text():
+    lines = ["# HELP surveilai_call_duration_seconds Wall time of instrumented calls.",
+             "# TYPE surveilai_call_duration_seconds histogram"]
+    with _lock:
+        for (group, name), h in sorted(_histograms.items()):
+            labels = f'group="{_label(group)}",name="{_label(name)}"'
+            for bound, running in zip(BUCKETS + ("+Inf",), h.cumulative()):
+                lines.append(f'surveilai_call_duration_seconds_bucket{{{labels},le="{bound}"}} {running}')
+            lines.append(f"surveilai_call_duration_seconds_sum{{{labels}}} {h.total:.6f}")
+            lines.append(f"surveilai_call_duration_seconds_count{{{labels}}} {h.count}")
+        lines += ["# HELP surveilai_slow_calls Calls slower than the slow-call threshold still in the log.",
+                  "# TYPE surveilai_slow_calls gauge", f"surveilai_slow_calls {len(_slow)}"]
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(path=None):
+    """Write the metrics atomically in Prometheus text format; returns the path."""
+    path = path or METRICS_FILE
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(prometheus_text())
+    os.replace(tmp, path)
+    return path
+
+
+# ---------- profiling ----------
+def start_profile():
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def stop_profile(profiler, sort="cumulative", limit=40):
+    """Stop profiler and return (pstats report text, .prof file bytes for pstats/snakeviz)."""
+    profiler.disable()
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats(sort).print_stats(limit)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "rerun.prof")
+        profiler.dump_stats(path)
+        with open(path, "rb") as f:
+            raw = f.read()
+    return out.getvalue(), raw
@@ -0,0 +1,221 @@
+"""
+model_server.py
+
+Warm, in-process district risk model with batched inference.
+
+ModelRegistry loads the model artifact once and keeps it in memory; each
+predict() only stats the file and reloads when its content hash changes (a new
+training run). Models are stored in LightGBM's native text format
+(district_risk_model.txt), which loads without unpickling; legacy joblib pickles
+are still accepted. Without any model the naive cases-per-population score is used.
+
+serve() exposes the registry over a small local HTTP endpoint so the Streamlit
+app and scheduled jobs can score many districts per request:
+
+    POST /predict  {"features": [{"district": "Accra", "cases_7d": 12, ...}, ...]}
+                -> {"model": "<sha256>", "scores": [{"district": "Accra", "score": 0.8}, ...]}
+    GET  /health   -> {"model": "<sha256>", "path": "district_risk_model.txt"}
+
+Usage:
+    python model_server.py --port 8765
+"""
+import argparse
+import hashlib
+import json
+import os
+import threading
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import joblib
+import pandas as pd
+
+from features import FEATURE_COLUMNS
+
+try:
+    import lightgbm as lgb
+except Exception:
+    lgb = None
+
+NATIVE_MODEL = "district_risk_model.txt"
+PICKLE_MODEL = "district_risk_model.pkl"
+SERVER_HOST = os.environ.get("SURVEILAI_MODEL_HOST", "127.0.0.1")
+SERVER_PORT = int(os.environ.get("SURVEILAI_MODEL_PORT", "8765"))
+MAX_REQUEST_BYTES = 16 * 1024 * 1024
+
+
+def default_model_path():
+    """Native model if present, else the legacy pickle."""
+    return NATIVE_MODEL if os.path.exists(NATIVE_MODEL) or not os.path.exists(PICKLE_MODEL) else PICKLE_MODEL
+
+
+def save_model(bst, path=NATIVE_MODEL):
+    """Write a LightGBM Booster in native format, atomically."""
+    tmp = path + ".tmp"
+    bst.save_model(tmp)
+    os.replace(tmp, path)
+
+
+def model_features(model):
+    """Feature names the model was trained on (LightGBM Booster or sklearn estimator)."""
+    names = None
+    if hasattr(model, "feature_name"):
+        names = model.feature_name()
+    elif hasattr(model, "feature_names_in_"):
+        names = list(model.feature_names_in_)
+    return list(names) if names else FEATURE_COLUMNS
+
+
+def predict_with(model, features):
+    """Scores for a feature DataFrame; without a model, per_1000 normalised within each week."""
+    if features.empty:
+        return pd.Series([], dtype=float, index=features.index)
+    if model is not None:
+        X = features.reindex(columns=model_features(model)).astype(float).fillna(0)
+        if hasattr(model, "predict_proba"):
+            return pd.Series(model.predict_proba(X)[:, 1], index=features.index)
+        return pd.Series(model.predict(X), index=features.index, dtype=float)
+    per_1000 = features["per_1000"].astype(float).fillna(0)
+    week = features["week_end"] if "week_end" in features else pd.Series(0, index=features.index)
+    week_max = per_1000.groupby(week).transform("max")
+    return per_1000 / week_max.where(week_max > 0, 1)
+
+
+class ModelRegistry:
+    """Keeps one model warm and reloads it only when the artifact's content changes."""
+
+    def __init__(self, path=None):
+        self.path = path or default_model_path()
+        self.model = None
+        self.digest = None
+        self._stamp = None
+        self._lock = threading.Lock()
+
+    def _load(self, path):
+        if path.endswith(".txt"):
+            if lgb is None:
+                raise RuntimeError("Loading a native model requires lightgbm (pip install lightgbm)")
+            return lgb.Booster(model_file=path)
+        return joblib.load(path)
+
+    def get(self):
+        """Current model (None when no artifact exists), reloading it if the file changed."""
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            with self._lock:
+                self.model = self.digest = self._stamp = None
+            return None
+        stamp = (st.st_mtime_ns, st.st_size)
+        if stamp == self._stamp:
+            return self.model
+        with self._lock:
+            if stamp != self._stamp:
+                with open(self.path, "rb") as f:
+                    digest = hashlib.sha256(f.read()).hexdigest()
+                # a touched but unchanged file keeps the loaded model
+                if digest != self.digest:
+                    self.model = self._load(self.path)
+                    self.digest = digest
+                self._stamp = stamp
+            return self.model
+
+    def predict(self, district_features):
+        """Batched scores for a DataFrame (or list of dicts) of district features, as a Series."""
+        if not isinstance(district_features, pd.DataFrame):
+            district_features = pd.DataFrame(list(district_features))
+        return predict_with(self.get(), district_features)
+
+
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+def registry(path=None):
+    """Process-wide registry for path, so every caller shares one warm model."""
+    path = path or default_model_path()
+    with _registries_lock:
+        if path not in _registries:
+            _registries[path] = ModelRegistry(path)
+        return _registries[path]
+
+
+def predict(district_features, path=None):
+    return registry(path).predict(district_features)
+
+
+# ---------- HTTP endpoint ----------
+class _Handler(BaseHTTPRequestHandler):
+    registry = None
+
+    def _send(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != "/health":
+            return self._send(404, {"error": "not found"})
+        self.registry.get()
+        self._send(200, {"model": self.registry.digest, "path": self.registry.path})
+
+    def do_POST(self):
+        if self.path != "/predict":
+            return self._send(404, {"error": "not found"})
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > MAX_REQUEST_BYTES:
+            return self._send(413, {"error": "request too large"})
+        try:
+            rows = json.loads(self.rfile.read(length) or b"{}").get("features", [])
+            features = pd.DataFrame(rows)
+            scores = self.registry.predict(features)
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            return self._send(400, {"error": str(e)})
+        districts = features["district"].tolist() if "district" in features else [None] * len(scores)
+        self._send(200, {"model": self.registry.digest,
+                         "scores": [{"district": d, "score": float(s)} for d, s in zip(districts, scores)]})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_server(host=SERVER_HOST, port=SERVER_PORT, model_path=None):
+    handler = type("Handler", (_Handler,), {"registry": registry(model_path)})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def serve(host=SERVER_HOST, port=SERVER_PORT, model_path=None):
+    server = make_server(host, port, model_path)
+    print(f"Serving district risk model on http://{host}:{server.server_port}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def predict_remote(district_features, url=None, timeout=30):
+    """Client for the HTTP endpoint; returns a list of {"district", "score"} dicts."""
+    url = url or f"http://{SERVER_HOST}:{SERVER_PORT}"
+    if isinstance(district_features, pd.DataFrame):
+        district_features = district_features.to_dict(orient="records")
+    body = json.dumps({"features": district_features}, default=str).encode("utf-8")
+    req = urllib.request.Request(url.rstrip("/") + "/predict", data=body,
+                                 headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(req, timeout=timeout) as resp:
+        return json.loads(resp.read())["scores"]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve district risk scores over local HTTP")
+    parser.add_argument("--host", default=SERVER_HOST)
+    parser.add_argument("--port", type=int, default=SERVER_PORT)
+    parser.add_argument("--model", default=None)
+    args = parser.parse_args(argv)
+    serve(args.host, args.port, args.model)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,34 +1,344 @@
-import smtplib, os, json
+"""
+notifications.py
+
+Email/SMS delivery through a persistent outbox.
+
+enqueue() / enqueue_alert() write one notification_outbox row per recipient and
+return immediately, so the UI never waits on SMTP or Twilio. Identical messages
+(same channel, recipient, subject and body) enqueued within DEDUP_WINDOW_SECONDS
+are dropped.
+
+A Dispatcher thread drains the outbox: emails go out over one reused SMTP
+connection, SMS are sent concurrently on a bounded thread pool, each channel is
+rate limited, and failures are retried with exponential backoff until
+MAX_ATTEMPTS. Claimed rows carry the dispatcher's owner id and claim time; a row
+left 'sending' is taken over only once its claim is CLAIM_TIMEOUT_SECONDS old,
+so dispatchers in several processes never resend each other's messages.
+Transports are plain objects with send(recipient, subject, body) returning a
+provider id, so tests can pass a local SMTP stand-in (SmtpTransport(host, port,
+use_tls=False)) or a fake SMS transport.
+"""
+import hashlib
+import os
+import random
+import smtplib
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from email.message import EmailMessage
+from email.utils import make_msgid
+
+from instrumentation import timed
+from utils import connection, transaction
+
 try:
     from twilio.rest import Client
 except Exception:
     Client = None
 
+DEDUP_WINDOW_SECONDS = 3600
+MAX_ATTEMPTS = 5
+BACKOFF_BASE_SECONDS = 30
+BACKOFF_MAX_SECONDS = 3600
+SMS_WORKERS = 4
+RATE_LIMITS = {"email": 5.0, "sms": 10.0}  # messages per second
+POLL_SECONDS = 2.0
+CLAIM_BATCH = 100
+CLAIM_TIMEOUT_SECONDS = 3600  # must exceed the time one claimed batch can take to send
+SMTP_IDLE_SECONDS = 60
+
+
+# ---------- transports ----------
+class SmtpTransport:
+    """One SMTP connection reused across messages; reconnects when idle or dropped. Not thread-safe."""
+
+    def __init__(self, host, port=587, user="", password="", sender="", use_tls=True, timeout=30):
+        self.host, self.port, self.user, self.password = host, port, user, password
+        self.sender, self.use_tls, self.timeout = sender, use_tls, timeout
+        self._server = None
+        self._last_used = 0.0
+
+    def _connect(self):
+        server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        if self.use_tls:
+            server.starttls()
+        if self.user:
+            server.login(self.user, self.password)
+        return server
+
+    def _connection(self):
+        if self._server is not None and time.monotonic() - self._last_used > SMTP_IDLE_SECONDS:
+            # servers drop idle sessions; check before reusing
+            try:
+                self._server.noop()
+            except smtplib.SMTPException:
+                self.close()
+        if self._server is None:
+            self._server = self._connect()
+        return self._server
+
+    @timed("notify", "smtp_send")
+    def send(self, recipient, subject, body):
+        msg = EmailMessage()
+        msg["From"] = self.sender
+        msg["To"] = recipient
+        msg["Subject"] = subject or ""
+        msg["Message-ID"] = make_msgid(domain=self.sender.rpartition("@")[2] or None)
+        msg.set_content(body)
+        try:
+            self._connection().send_message(msg)
+        except (smtplib.SMTPServerDisconnected, ConnectionError):
+            self.close()
+            self._connection().send_message(msg)
+        self._last_used = time.monotonic()
+        return msg["Message-ID"]
+
+    def close(self):
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except Exception:
+                pass
+            self._server = None
+
+
+class TwilioSmsTransport:
+    """One Twilio client shared by all SMS worker threads."""
+
+    def __init__(self, sid, token, from_number):
+        if Client is None:
+            raise RuntimeError("Twilio client not installed")
+        self.client = Client(sid, token)
+        self.from_number = from_number
+
+    @timed("notify", "sms_send")
+    def send(self, recipient, subject, body):
+        return self.client.messages.create(body=body, from_=self.from_number, to=recipient).sid
+
+    def close(self):
+        pass
+
+
+def transports_from_config(config):
+    """Transports for the channels enabled in a settings.Config."""
+    notes = config.notifications
+    transports = {}
+    if notes.email.enabled and notes.email.smtp_host:
+        e = notes.email
+        transports["email"] = SmtpTransport(e.smtp_host, e.smtp_port, e.smtp_user, e.smtp_password, e.sender)
+    if notes.sms.enabled and Client is not None:
+        s = notes.sms
+        transports["sms"] = TwilioSmsTransport(s.twilio_sid, s.twilio_token, s.from_number)
+    return transports
+
+
+# ---------- outbox ----------
+def dedup_key(channel, recipient, subject, body):
+    return hashlib.sha256("\x1f".join([channel, recipient, subject or "", body]).encode("utf-8")).hexdigest()
+
+
+def enqueue(channel, recipients, subject, body, dedup_window=DEDUP_WINDOW_SECONDS):
+    """Queue one message per recipient; returns the new outbox ids (duplicates are skipped)."""
+    if channel not in RATE_LIMITS:
+        raise ValueError(f"Unknown channel {channel!r}")
+    if isinstance(recipients, str):
+        recipients = [recipients]
+    now = time.time()
+    ids = []
+    with transaction() as conn:
+        for recipient in recipients:
+            key = dedup_key(channel, recipient, subject, body)
+            if conn.execute("SELECT 1 FROM notification_outbox WHERE dedup_key = ? AND created_at >= ? LIMIT 1",
+                            (key, now - dedup_window)).fetchone():
+                continue
+            cur = conn.execute(
+                "INSERT INTO notification_outbox (channel, recipient, subject, body, dedup_key, next_attempt_at, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)", (channel, recipient, subject, body, key, now, now))
+            ids.append(cur.lastrowid)
+    return ids
+
+
+def enqueue_alert(subject, body, config=None):
+    """Queue an alert to every configured email/SMS recipient; returns the new outbox ids."""
+    if config is None:
+        from settings import load_config
+        config = load_config()
+    notes = config.notifications
+    ids = []
+    if notes.email.enabled and notes.email.recipients:
+        ids += enqueue("email", notes.email.recipients, subject, body)
+    if notes.sms.enabled and notes.sms.recipients:
+        ids += enqueue("sms", notes.sms.recipients, None, f"{subject}: {body}" if subject else body)
+    return ids
+
+
+def outbox_counts():
+    with connection() as conn:
+        return dict(conn.execute("SELECT status, COUNT(*) FROM notification_outbox GROUP BY status").fetchall())
+
+
+class RateLimiter:
+    """Token bucket shared by threads: acquire() blocks until a send is allowed."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or max(rate, 1))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class Dispatcher:
+    """Background sender draining notification_outbox. transports: {"email": ..., "sms": ...}."""
+
+    def __init__(self, transports, sms_workers=SMS_WORKERS, rate_limits=None, max_attempts=MAX_ATTEMPTS,
+                 backoff_base=BACKOFF_BASE_SECONDS, poll_seconds=POLL_SECONDS, claim_timeout=CLAIM_TIMEOUT_SECONDS):
+        self.transports = dict(transports)
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.claim_timeout = claim_timeout
+        self.limiters = {ch: RateLimiter(r) for ch, r in {**RATE_LIMITS, **(rate_limits or {})}.items()}
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.poll_seconds = poll_seconds
+        self._sms_pool = ThreadPoolExecutor(max_workers=sms_workers, thread_name_prefix="sms")
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _claim(self, limit=CLAIM_BATCH):
+        channels = list(self.transports)
+        if not channels:
+            return []
+        now = time.time()
+        in_channels = f"channel IN ({','.join('?' * len(channels))})"
+        with transaction() as conn:
+            # due rows, plus rows whose sender died mid-send (claim older than claim_timeout)
+            rows = conn.execute(
+                f"SELECT id, channel, recipient, subject, body, attempts FROM ("
+                f"SELECT * FROM notification_outbox WHERE status = 'pending' AND next_attempt_at <= ? AND {in_channels} "
+                f"UNION ALL "
+                f"SELECT * FROM notification_outbox WHERE status = 'sending' AND claimed_at < ? AND {in_channels}"
+                f") ORDER BY next_attempt_at, id LIMIT ?",
+                (now, *channels, now - self.claim_timeout, *channels, limit)).fetchall()
+            conn.executemany("UPDATE notification_outbox SET status = 'sending', attempts = attempts + 1, "
+                             "claimed_by = ?, claimed_at = ? WHERE id = ?", [(self.owner, now, r[0]) for r in rows])
+        return rows
+
+    def _finish(self, row_id, attempts, provider_id=None, error=None):
+        # only while the claim is still ours: a row taken over as stale belongs to its new owner
+        with transaction() as conn:
+            if error is None:
+                conn.execute("UPDATE notification_outbox SET status = 'sent', sent_at = ?, provider_id = ?, "
+                             "last_error = NULL WHERE id = ? AND claimed_by = ?",
+                             (time.time(), provider_id, row_id, self.owner))
+            elif attempts >= self.max_attempts:
+                conn.execute("UPDATE notification_outbox SET status = 'failed', last_error = ? "
+                             "WHERE id = ? AND claimed_by = ?", (error, row_id, self.owner))
+            else:
+                delay = min(self.backoff_base * 2 ** (attempts - 1), BACKOFF_MAX_SECONDS) * random.uniform(0.8, 1.2)
+                conn.execute("UPDATE notification_outbox SET status = 'pending', next_attempt_at = ?, last_error = ? "
+                             "WHERE id = ? AND claimed_by = ?", (time.time() + delay, error, row_id, self.owner))
+
+    def _deliver(self, row):
+        row_id, channel, recipient, subject, body, attempts = row
+        self.limiters[channel].acquire()
+        try:
+            provider_id = self.transports[channel].send(recipient, subject, body)
+        except Exception as e:
+            self._finish(row_id, attempts + 1, error=f"{type(e).__name__}: {e}")
+            return False
+        self._finish(row_id, attempts + 1, provider_id=None if provider_id is None else str(provider_id))
+        return True
+
+    def run_once(self):
+        """Send everything currently due; returns (sent, failed_attempts)."""
+        rows = self._claim()
+        sms = [self._sms_pool.submit(self._deliver, r) for r in rows if r[1] == "sms"]
+        # SMTP connections are not thread-safe, so email goes out serially on this thread
+        results = [self._deliver(r) for r in rows if r[1] == "email"]
+        results += [f.result() for f in sms]
+        return sum(results), len(results) - sum(results)
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                sent, failed = self.run_once()
+            except Exception:
+                sent = failed = 0
+            if not sent and not failed:
+                self._wake.wait(self.poll_seconds)
+                self._wake.clear()
+
+    def wake(self):
+        self._wake.set()
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._loop, name="notification-dispatcher", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=10):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._sms_pool.shutdown(wait=True)
+        for transport in self.transports.values():
+            transport.close()
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def ensure_dispatcher(config=None):
+    """Start (once per process) a dispatcher for the channels enabled in config.yaml."""
+    global _dispatcher
+    if config is None:
+        from settings import load_config
+        config = load_config()
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = Dispatcher(transports_from_config(config)).start()
+        return _dispatcher
+
+
+# ---------- direct sends (no outbox) ----------
 def send_email(smtp_host, smtp_port, smtp_user, smtp_password, sender, recipients, subject, body):
-    msg = EmailMessage()
-    msg["From"] = sender
-    msg["To"] = ", ".join(recipients if isinstance(recipients, list) else [recipients])
-    msg["Subject"] = subject
-    msg.set_content(body)
+    transport = SmtpTransport(smtp_host, smtp_port, smtp_user, smtp_password, sender)
     try:
-        with smtplib.SMTP(smtp_host, smtp_port) as server:
-            server.starttls()
-            server.login(smtp_user, smtp_password)
-            server.send_message(msg)
+        for to in (recipients if isinstance(recipients, (list, tuple)) else [recipients]):
+            transport.send(to, subject, body)
         return True, "Email sent"
     except Exception as e:
         return False, str(e)
+    finally:
+        transport.close()
+
 
 def send_sms(twilio_sid, twilio_token, from_number, to_numbers, body):
     if Client is None:
         return False, "Twilio client not installed"
     try:
-        client = Client(twilio_sid, twilio_token)
-        results = []
-        for to in to_numbers:
-            msg = client.messages.create(body=body, from_=from_number, to=to)
-            results.append(msg.sid)
+        transport = TwilioSmsTransport(twilio_sid, twilio_token, from_number)
+        with ThreadPoolExecutor(max_workers=SMS_WORKERS) as pool:
+            results = list(pool.map(lambda to: transport.send(to, None, body), to_numbers))
         return True, results
     except Exception as e:
-        return False, str(e)
\ No newline at end of file
+        return False, str(e)
@@ -0,0 +1,26 @@
+"""
+rebuild_rollups.py
+
+Regenerate the case_rollups table (cases per year/epiweek/district/sex/age band)
+from the raw cases table and report any buckets that had drifted.
+
+Usage:
+    python rebuild_rollups.py          # check, then rebuild
+    python rebuild_rollups.py --check  # only report differences (exit 1 if any)
+"""
+import argparse
+from utils import init_db, rebuild_rollups
+
+parser = argparse.ArgumentParser(description="Rebuild and verify case_rollups from the cases table")
+parser.add_argument("--check", action="store_true", help="report differences without rewriting the rollups")
+args = parser.parse_args()
+
+init_db()
+diffs = rebuild_rollups(check_only=args.check)
+if diffs.empty:
+    print("Rollups consistent with cases table.")
+else:
+    print(f"{len(diffs)} rollup buckets differ from the cases table:")
+    print(diffs.to_string(index=False))
+    print("Checked only; rollups left unchanged." if args.check else "Rollups rebuilt.")
+raise SystemExit(1 if args.check and not diffs.empty else 0)
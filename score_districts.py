@@ -1,50 +1,109 @@
-
 """
 score_districts.py
 
-A simple scoring script to compute weekly district risk scores.
-If you have a trained model (district_risk_model.pkl) it will use it; otherwise
-it will compute a naive score based on recent cases per population.
+Weekly district risk scoring pipeline.
+
+Builds the shared district-week features (features.py) for every district and
+every ISO week in one vectorized pass, scores them with the trained model
+(held warm by model_server.py) when present, otherwise with a naive score based on
+cases per population, and upserts the results into the district_scores table.
+
+Modes:
+    incremental (default)  score weeks after the last stored week, re-scoring that
+                           week and the current (partial) week as late reports arrive
+    backfill               score every week from --since (default: first case)
 
-Outputs a CSV 'district_risk_scores.csv' with columns: district, date, score
+Usage:
+    python score_districts.py
+    python score_districts.py --mode backfill --since 2024-01-01
+    python score_districts.py --csv district_risk_scores.csv
+
+The optional CSV holds the latest scored week with columns: district, date, score
 """
-import pandas as pd
+import argparse
 import os
-import joblib
-from utils import query_summary
-from datetime import datetime, timedelta
-
-OUT = "district_risk_scores.csv"
-MODEL = "district_risk_model.pkl"
-
-df = query_summary()
-if df.empty:
-    print("No cases to score.")
-    raise SystemExit
-
-# naive aggregation: cases per district in last 7 days
-recent = df[df['onset_date'] >= (pd.Timestamp.now() - pd.Timedelta(days=7))]
-agg = recent.groupby('district').size().rename('cases_7d').reset_index()
-# load population if available
-pop = None
-if os.path.exists("district_population.csv"):
-    pop = pd.read_csv("district_population.csv")
-    agg = agg.merge(pop, on='district', how='left')
-    agg['per_1000'] = agg['cases_7d'] / (agg['population']/1000)
-else:
-    agg['per_1000'] = agg['cases_7d']
-
-# if model exists use it
-if os.path.exists(MODEL):
-    model = joblib.load(MODEL)
-    features = [c for c in agg.columns if c not in ['district']]
-    X = agg[features].fillna(0)
-    preds = model.predict_proba(X)[:,1]
-    agg['score'] = preds
-else:
-    # simple normalized score
-    agg['score'] = agg['per_1000'] / (agg['per_1000'].max() if agg['per_1000'].max()>0 else 1)
-
-agg['date'] = pd.Timestamp.now().strftime("%Y-%m-%d")
-agg[['district','date','score']].to_csv(OUT, index=False)
-print("Saved", OUT)
+
+import pandas as pd
+
+from features import POPULATION_CSV, build_features, load_population
+from instrumentation import timed
+from model_server import predict_with, registry
+from utils import connection, init_db, transaction
+
+NAIVE_MODEL = "naive"
+
+_UPSERT = """INSERT INTO district_scores
+    (district, week_end, cases_7d, cases_14d, cases_28d, growth_7d, per_1000, score, model, scored_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(district, week_end) DO UPDATE SET
+        cases_7d = excluded.cases_7d, cases_14d = excluded.cases_14d, cases_28d = excluded.cases_28d,
+        growth_7d = excluded.growth_7d, per_1000 = excluded.per_1000, score = excluded.score,
+        model = excluded.model, scored_at = excluded.scored_at"""
+
+
+def last_scored_week():
+    with connection() as conn:
+        row = conn.execute("SELECT MAX(week_end) FROM district_scores").fetchone()
+    return pd.Timestamp(row[0]) if row and row[0] else None
+
+
+def upsert_scores(scored, model_name):
+    """Insert or update (district, week_end) rows in district_scores; returns rows written."""
+    now = pd.Timestamp.now().isoformat(timespec="seconds")
+    rows = [
+        (r.district, r.week_end.strftime("%Y-%m-%d"), int(r.cases_7d), int(r.cases_14d), int(r.cases_28d),
+         float(r.growth_7d), None if pd.isna(r.per_1000) else float(r.per_1000), float(r.score), model_name, now)
+        for r in scored.itertuples(index=False)
+    ]
+    with transaction() as conn:
+        conn.executemany(_UPSERT, rows)
+    return len(rows)
+
+
+@timed("scoring")
+def run(mode="incremental", since=None, until=None, model_path=None, population_path=POPULATION_CSV):
+    """
+    Build features, score and upsert them. Returns the scored DataFrame
+    (district, week_end, features..., score).
+    """
+    if mode not in ("incremental", "backfill"):
+        raise ValueError("mode must be 'incremental' or 'backfill'")
+    start = since
+    if mode == "incremental" and since is None:
+        start = last_scored_week()  # None on first run: falls back to a full backfill
+    features = build_features(start, until, population=load_population(population_path))
+    models = registry(model_path)
+    model = models.get()
+    features["score"] = predict_with(model, features)
+    if not features.empty:
+        name = f"{os.path.basename(models.path)}@{models.digest[:12]}" if model is not None else NAIVE_MODEL
+        upsert_scores(features, name)
+    return features
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Score district risk per ISO week into district_scores")
+    parser.add_argument("--mode", choices=["incremental", "backfill"], default="incremental")
+    parser.add_argument("--since", default=None, help="first week to score (any date in that week)")
+    parser.add_argument("--until", default=None, help="last week to score (default: current week)")
+    parser.add_argument("--model", default=None, help="model artifact (default: district_risk_model.txt, else .pkl)")
+    parser.add_argument("--population", default=POPULATION_CSV)
+    parser.add_argument("--csv", default=None, help="also write the latest week's scores to this CSV")
+    args = parser.parse_args(argv)
+    init_db()
+    scored = run(args.mode, args.since, args.until, args.model, args.population)
+    if scored.empty:
+        print("No cases to score.")
+        return 0
+    weeks = scored["week_end"].nunique()
+    print(f"Scored {len(scored)} district-weeks across {weeks} week(s).")
+    if args.csv:
+        latest = scored[scored["week_end"] == scored["week_end"].max()]
+        out = latest.assign(date=latest["week_end"].dt.strftime("%Y-%m-%d"))
+        out[["district", "date", "score"]].to_csv(args.csv, index=False)
+        print("Saved", args.csv)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,370 @@
+"""
+settings.py
+
+Cached, validated access to config.yaml.
+
+load_config() parses and validates the file once and hands every caller the same
+immutable Config object until the file changes (checked by mtime/size, then by
+content hash, so touching the file does not force a re-parse). save_config_text()
+validates new YAML before atomically replacing the file, so a bad edit from the
+admin page never reaches disk.
+"""
+import hashlib
+import os
+import tempfile
+import threading
+from dataclasses import dataclass, field
+
+import yaml
+
+CONFIG_PATH = os.path.join(os.path.dirname(__file__), "config.yaml")
+
+DEFAULT_CONFIG = {
+    'classification_rules': {
+        'confirmed': {'lab_positive': True},
+        'probable': {'symptoms_required': ['fever', 'cough'], 'epidemiological_link_required': False},
+        'suspected': {}
+    },
+    'alerts': {
+        'recent_days': 7,
+        'high_activity_threshold': 10
+    }
+}
+
+
+class ConfigError(ValueError):
+    """config.yaml could not be parsed or failed validation."""
+
+    def __init__(self, errors):
+        self.errors = [errors] if isinstance(errors, str) else list(errors)
+        super().__init__("; ".join(self.errors))
+
+
+class FrozenDict(dict):
+    """Read-only dict (still a dict, so json/yaml/pandas accept it)."""
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("config is read-only; edit config.yaml via settings.save_config_text()")
+
+    __setitem__ = __delitem__ = update = pop = popitem = clear = setdefault = __ior__ = _readonly
+
+
+def freeze(value):
+    if isinstance(value, dict):
+        return FrozenDict((k, freeze(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+def thaw(value):
+    """Plain, mutable copy of a frozen config value (e.g. for yaml.safe_dump)."""
+    if isinstance(value, dict):
+        return {k: thaw(v) for k, v in value.items()}
+    if isinstance(value, tuple):
+        return [thaw(v) for v in value]
+    return value
+
+
+@dataclass(frozen=True)
+class AlertsConfig:
+    recent_days: int = 7
+    high_activity_threshold: int = 10
+    cluster_time_window_days: int = 14
+    district_thresholds: FrozenDict = field(default_factory=FrozenDict)
+
+    def threshold_for(self, district):
+        return self.district_thresholds.get(district, self.high_activity_threshold)
+
+
+@dataclass(frozen=True)
+class DeduplicationConfig:
+    enabled: bool = True
+    window_days: int = 7
+    threshold: float = 0.85
+
+
+@dataclass(frozen=True)
+class EpiLinkConfig:
+    enabled: bool = True
+    distance_km: float = 2.0
+    window_days: int = 14
+    match_community: bool = True
+
+
+@dataclass(frozen=True)
+class EmailConfig:
+    enabled: bool = False
+    smtp_host: str = ""
+    smtp_port: int = 587
+    smtp_user: str = ""
+    smtp_password: str = ""
+    sender: str = ""
+    recipients: tuple = ()
+
+
+@dataclass(frozen=True)
+class SmsConfig:
+    enabled: bool = False
+    twilio_sid: str = ""
+    twilio_token: str = ""
+    from_number: str = ""
+    recipients: tuple = ()
+
+
+@dataclass(frozen=True)
+class NotificationsConfig:
+    enabled: bool = False
+    email: EmailConfig = field(default_factory=EmailConfig)
+    sms: SmsConfig = field(default_factory=SmsConfig)
+
+
+@dataclass(frozen=True)
+class Config:
+    raw: FrozenDict
+    text: str
+    digest: str
+    classification_rules: FrozenDict
+    case_definitions: FrozenDict
+    alerts: AlertsConfig
+    notifications: NotificationsConfig
+    deduplication: DeduplicationConfig = field(default_factory=DeduplicationConfig)
+    epi_link: EpiLinkConfig = field(default_factory=EpiLinkConfig)
+
+    # dict-style access for code that predates the typed sections
+    def get(self, key, default=None):
+        return self.raw.get(key, default)
+
+    def __getitem__(self, key):
+        return self.raw[key]
+
+    def __contains__(self, key):
+        return key in self.raw
+
+
+# ---------- validation ----------
+def _is_str_list(value):
+    return isinstance(value, list) and all(isinstance(v, str) for v in value)
+
+
+def validate(data):
+    """Return a list of problems with a parsed config (empty when valid)."""
+    if data is None:
+        data = {}
+    if not isinstance(data, dict):
+        return ["top level must be a mapping"]
+    errors = []
+    rules = data.get('classification_rules', {})
+    if not isinstance(rules, dict):
+        errors.append("classification_rules must be a mapping")
+        rules = {}
+    for level in ('confirmed', 'probable', 'suspected'):
+        spec = rules.get(level) or {}
+        if not isinstance(spec, dict):
+            errors.append(f"classification_rules.{level} must be a mapping")
+            continue
+        for key in ('symptoms_required', 'symptoms_required_any', 'additional_symptoms'):
+            if key in spec and not _is_str_list(spec[key]):
+                errors.append(f"classification_rules.{level}.{key} must be a list of symptom names")
+        for key in ('lab_positive', 'epi_link_required', 'epidemiological_link_required'):
+            if key in spec and not isinstance(spec[key], bool):
+                errors.append(f"classification_rules.{level}.{key} must be true or false")
+        if 'additional_required' in spec and not (isinstance(spec['additional_required'], int) and spec['additional_required'] >= 0):
+            errors.append(f"classification_rules.{level}.additional_required must be a non-negative integer")
+
+    alerts = data.get('alerts', {}) or {}
+    if not isinstance(alerts, dict):
+        errors.append("alerts must be a mapping")
+        alerts = {}
+    for key in ('recent_days', 'high_activity_threshold', 'cluster_time_window_days'):
+        if key in alerts and not (isinstance(alerts[key], int) and not isinstance(alerts[key], bool) and alerts[key] > 0):
+            errors.append(f"alerts.{key} must be a positive integer")
+    thresholds = alerts.get('district_thresholds', {}) or {}
+    if not isinstance(thresholds, dict) or not all(
+            isinstance(v, (int, float)) and not isinstance(v, bool) and v > 0 for v in thresholds.values()):
+        errors.append("alerts.district_thresholds must map district names to positive numbers")
+
+    dedup = data.get('deduplication', {}) or {}
+    if not isinstance(dedup, dict):
+        errors.append("deduplication must be a mapping")
+        dedup = {}
+    if 'enabled' in dedup and not isinstance(dedup['enabled'], bool):
+        errors.append("deduplication.enabled must be true or false")
+    if 'window_days' in dedup and not (isinstance(dedup['window_days'], int) and not isinstance(dedup['window_days'], bool)
+                                       and dedup['window_days'] >= 0):
+        errors.append("deduplication.window_days must be a non-negative integer")
+    if 'threshold' in dedup and not (isinstance(dedup['threshold'], (int, float)) and not isinstance(dedup['threshold'], bool)
+                                     and 0 < dedup['threshold'] <= 1):
+        errors.append("deduplication.threshold must be a number in (0, 1]")
+
+    epi = data.get('epi_link', {}) or {}
+    if not isinstance(epi, dict):
+        errors.append("epi_link must be a mapping")
+        epi = {}
+    for key in ('enabled', 'match_community'):
+        if key in epi and not isinstance(epi[key], bool):
+            errors.append(f"epi_link.{key} must be true or false")
+    if 'distance_km' in epi and not (isinstance(epi['distance_km'], (int, float)) and not isinstance(epi['distance_km'], bool)
+                                     and 0.01 <= epi['distance_km'] <= 500):
+        errors.append("epi_link.distance_km must be a number between 0.01 and 500")
+    if 'window_days' in epi and not (isinstance(epi['window_days'], int) and not isinstance(epi['window_days'], bool)
+                                     and 0 <= epi['window_days'] <= 365):
+        errors.append("epi_link.window_days must be an integer between 0 and 365")
+
+    notes = data.get('notifications', {}) or {}
+    if not isinstance(notes, dict):
+        errors.append("notifications must be a mapping")
+        notes = {}
+    for channel in ('email', 'sms'):
+        spec = notes.get(channel, {}) or {}
+        if not isinstance(spec, dict):
+            errors.append(f"notifications.{channel} must be a mapping")
+            continue
+        if 'recipients' in spec and not (_is_str_list(spec['recipients']) or spec['recipients'] is None):
+            errors.append(f"notifications.{channel}.recipients must be a list of strings")
+        if 'enabled' in spec and not isinstance(spec['enabled'], bool):
+            errors.append(f"notifications.{channel}.enabled must be true or false")
+    email = notes.get('email') or {}
+    if isinstance(email, dict) and 'smtp_port' in email and not isinstance(email['smtp_port'], int):
+        errors.append("notifications.email.smtp_port must be an integer")
+
+    definitions = data.get('case_definitions', {}) or {}
+    if not isinstance(definitions, dict) or not all(isinstance(v, dict) for v in definitions.values()):
+        errors.append("case_definitions must map disease names to mappings of definitions")
+    return errors
+
+
+def _build(data, text, digest):
+    data = data or {}
+    alerts = data.get('alerts') or {}
+    notes = data.get('notifications') or {}
+    email = notes.get('email') or {}
+    sms = notes.get('sms') or {}
+    dedup = data.get('deduplication') or {}
+    epi = data.get('epi_link') or {}
+    return Config(
+        raw=freeze(data),
+        text=text,
+        digest=digest,
+        classification_rules=freeze(data.get('classification_rules') or {}),
+        case_definitions=freeze(data.get('case_definitions') or {}),
+        alerts=AlertsConfig(
+            recent_days=alerts.get('recent_days', 7),
+            high_activity_threshold=alerts.get('high_activity_threshold', 10),
+            cluster_time_window_days=alerts.get('cluster_time_window_days', 14),
+            district_thresholds=freeze(alerts.get('district_thresholds') or {}),
+        ),
+        notifications=NotificationsConfig(
+            enabled=bool(notes.get('enabled', False)),
+            email=EmailConfig(
+                enabled=bool(email.get('enabled', False)),
+                smtp_host=email.get('smtp_host', ""),
+                smtp_port=email.get('smtp_port', 587),
+                smtp_user=email.get('smtp_user', ""),
+                smtp_password=email.get('smtp_password', ""),
+                sender=email.get('from', ""),
+                recipients=tuple(email.get('recipients') or ()),
+            ),
+            sms=SmsConfig(
+                enabled=bool(sms.get('enabled', False)),
+                twilio_sid=sms.get('twilio_sid', ""),
+                twilio_token=sms.get('twilio_token', ""),
+                from_number=sms.get('from_number', ""),
+                recipients=tuple(sms.get('recipients') or ()),
+            ),
+        ),
+        deduplication=DeduplicationConfig(
+            enabled=bool(dedup.get('enabled', True)),
+            window_days=dedup.get('window_days', 7),
+            threshold=float(dedup.get('threshold', 0.85)),
+        ),
+        epi_link=EpiLinkConfig(
+            enabled=bool(epi.get('enabled', True)),
+            distance_km=float(epi.get('distance_km', 2.0)),
+            window_days=epi.get('window_days', 14),
+            match_community=bool(epi.get('match_community', True)),
+        ),
+    )
+
+
+def parse_config(text):
+    """Parse and validate YAML text into a Config; raises ConfigError."""
+    try:
+        data = yaml.safe_load(text)
+    except yaml.YAMLError as e:
+        raise ConfigError(f"invalid YAML: {e}")
+    errors = validate(data)
+    if errors:
+        raise ConfigError(errors)
+    return _build(data, text, hashlib.sha256(text.encode("utf-8")).hexdigest())
+
+
+# ---------- cache ----------
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def load_config(path=None):
+    """
+    Return the validated, immutable Config for path (default config.yaml).
+    Re-parses only when the file's mtime/size and then its content hash change.
+    A missing file yields an empty config; an invalid one raises ConfigError.
+    """
+    path = path or CONFIG_PATH
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return _build({}, "", "")
+    stamp = (st.st_mtime_ns, st.st_size)
+    with _cache_lock:
+        cached = _cache.get(path)
+    if cached and cached[0] == stamp:
+        return cached[1]
+    with open(path, encoding="utf-8") as f:
+        text = f.read()
+    digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    if cached and cached[1].digest == digest:
+        config = cached[1]
+    else:
+        config = parse_config(text)
+    with _cache_lock:
+        _cache[path] = (stamp, config)
+    return config
+
+
+def _file_mode(path):
+    try:
+        return os.stat(path).st_mode & 0o7777
+    except FileNotFoundError:
+        # reading the umask means setting it, which races with other threads creating files
+        return 0o644
+
+
+def save_config_text(text, path=None):
+    """Validate YAML text and atomically replace the config file with it; returns the new Config."""
+    path = path or CONFIG_PATH
+    config = parse_config(text)
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".config.", suffix=".yaml.tmp")
+    try:
+        # mkstemp creates the file 0600; keep the mode the config had (or a plain new file's)
+        os.chmod(tmp, _file_mode(path))
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    st = os.stat(path)
+    with _cache_lock:
+        _cache[path] = ((st.st_mtime_ns, st.st_size), config)
+    return config
+
+
+def ensure_config(path=None):
+    """Write the default config if the file does not exist yet."""
+    path = path or CONFIG_PATH
+    if not os.path.exists(path):
+        save_config_text(yaml.safe_dump(DEFAULT_CONFIG, sort_keys=False), path)
@@ -6,45 +6,95 @@ from utils import (
     create_user,
     check_password,
     add_case,
-    query_summary,
+    load_cases,
     load_shapefile_from_zip,
     cluster_epicenters,
     assign_district_from_point,
     get_all_users,
     set_user_role,
+    AGE_LABELS,
+    query_rollups,
+    query_district_scores,
+    classify_case,
+    reclassify_all,
 )
+from ingest import import_cases
+from export import export_to_tempfile, FORMATS as EXPORT_FORMATS
+from settings import load_config, save_config_text, ConfigError
+from notifications import ensure_dispatcher
+from tiles import cells_in_view, recent_epicenters
+from dedup import duplicates as flagged_duplicates, set_status as set_duplicate_status, sweep as sweep_duplicates
+from epilink import relink as relink_epi_links
+from geo import join_properties, layer_for_zoom
+from alerts import (
+    active_alerts,
+    evaluate as evaluate_alerts,
+    recent_events as recent_alert_events,
+    rebuild_counters as rebuild_alert_counters,
+)
+import instrumentation
 import sqlite3
 import uuid
+import numpy as np
 import pandas as pd
 import geopandas as gpd
 from datetime import datetime, date
 import folium
+import branca
 from streamlit_folium import st_folium
 import base64
-import yaml
 import os
 import plotly.express as px
+import time
 
 # ---------- CONFIG ----------
 st.set_page_config(page_title="Surveilai", layout="wide", initial_sidebar_state="expanded")
+# opt-in timing (SURVEILAI_METRICS=1); a profile is captured only when requested from the metrics page
+rerun_started = time.perf_counter()
+
+
+def finish_profile():
+    """Stop this session's profile capture, if one is running, and keep its report for the metrics page."""
+    profiler = st.session_state.pop("rerun_profiler", None)
+    if profiler is None:
+        return False
+    report, raw = instrumentation.stop_profile(profiler)
+    st.session_state["last_profile"] = (datetime.now().isoformat(timespec="seconds"), report, raw)
+    return True
+
+
+def rerun():
+    # every early exit closes the capture, or the profiler stays enabled and the next one fails to start
+    finish_profile()
+    st.rerun()
+
+
+def stop():
+    finish_profile()
+    st.stop()
+
+
+# a capture cut short some other way (an exception, a widget interrupting the script) ends here
+finish_profile()
+if st.session_state.pop("profile_next_rerun", False):
+    st.session_state["rerun_profiler"] = instrumentation.start_profile()
 init_db()
-CONFIG_PATH = os.path.join(os.path.dirname(__file__), "config.yaml")
-if os.path.exists(CONFIG_PATH):
-    with open(CONFIG_PATH) as f:
-        config = yaml.safe_load(f)
-else:
-    config = {}
+# parsed and validated once; re-read only when config.yaml changes on disk
+config = load_config()
+if config.notifications.enabled:
+    # one background sender per process drains the notification outbox
+    ensure_dispatcher(config)
 
 # ---------- SESSION STATE ----------
 if "user" not in st.session_state:
     st.session_state["user"] = None
 if "shapefile_gdf" not in st.session_state:
     st.session_state["shapefile_gdf"] = None
-if "cases_df" not in st.session_state:
-    try:
-        st.session_state["cases_df"] = query_summary()
-    except Exception:
-        st.session_state["cases_df"] = pd.DataFrame()
+# shared incremental frame: each rerun only fetches rows changed since the last one
+try:
+    st.session_state["cases_df"] = load_cases()
+except Exception:
+    st.session_state["cases_df"] = pd.DataFrame()
 
 # ---------- LOGIN / SIGNUP ----------
 if not st.session_state["user"]:
@@ -86,7 +136,7 @@ if not st.session_state["user"]:
             user = get_user(username)
             if user and check_password(password, user["password"]):
                 st.session_state["user"] = {"username": username, "name": user.get("name", username), "role": user.get("role", "user")}
-                st.rerun()
+                rerun()
             else:
                 st.sidebar.error("Invalid credentials")
     # --- 5-digit code login
@@ -106,11 +156,11 @@ if not st.session_state["user"]:
                     create_user(code_username, "code-login", code_username, "user")
                     user = get_user(code_username)
                 st.session_state["user"] = {"username": code_username, "name": user.get("name", code_username), "role": user.get("role", "user")}
-                st.rerun()
+                rerun()
             else:
                 st.sidebar.error("Invalid code or username")
 
-    st.stop()
+    stop()
 
 # ---------- SIDEBAR AFTER LOGIN ----------
 st.sidebar.title("Surveilai")
@@ -126,21 +176,55 @@ if st.sidebar.button("About Surveilai", key="about_button"):
     st.session_state["page"] = "about"
 if st.sidebar.button("Logout", key="logout_button"):
     st.session_state["user"] = None
-    st.rerun()
+    rerun()
+if st.session_state["user"].get("role") == "admin":
+    admin_choice = st.sidebar.selectbox("Admin pages", ["—", "users", "alerts", "metrics"], key="admin_page_select")
+    st.session_state["admin_page"] = None if admin_choice == "—" else admin_choice
 
-if st.sidebar.button("Download CSV of cases", key="download_csv"):
-    df = st.session_state.get("cases_df", pd.DataFrame())
-    if df.empty:
-        st.sidebar.warning("No cases to download")
-    else:
-        csv = df.to_csv(index=False).encode("utf-8")
-        st.sidebar.download_button("Download cases.csv", data=csv, file_name="cases.csv", mime="text/csv")
+with st.sidebar.expander("Export cases"):
+    # streamed from the database in chunks; filters are applied in SQL
+    export_fmt = st.selectbox("Format", list(EXPORT_FORMATS), key="export_format")
+    export_range = st.date_input("Onset date range", value=(), key="export_range")
+    export_districts = st.multiselect("Districts", query_rollups(("district",))["district"].tolist(), key="export_districts")
+    export_classes = st.multiselect("Classification", ["Confirmed", "Probable", "Suspected", "Not a case"], key="export_classes")
+    if st.button("Prepare export", key="download_csv"):
+        start, end = (export_range + (None, None))[:2] if isinstance(export_range, tuple) else (export_range, export_range)
+        try:
+            export_file = export_to_tempfile(export_fmt, start=start, end=end,
+                                             districts=export_districts, classifications=export_classes)
+            st.download_button(f"Download cases.{export_fmt}", data=export_file, file_name=f"cases.{export_fmt}",
+                               mime=EXPORT_FORMATS[export_fmt], key="download_export")
+        except Exception as e:
+            st.error(f"Export failed: {e}")
+
+with st.sidebar.expander("Bulk import cases (CSV / JSONL)"):
+    bulk_file = st.file_uploader("Line list", type=["csv", "jsonl", "ndjson"], key="bulk_upload")
+    if bulk_file is not None and st.button("Import line list", key="bulk_import_button"):
+        try:
+            report = import_cases(bulk_file, config_rules=config.get("classification_rules"))
+            st.success(f"Imported {report['written']} cases ({report['accepted']} valid rows).")
+            if report["rejected"]:
+                st.warning(f"{report['rejected']} rows rejected.")
+                st.dataframe(pd.DataFrame(report["errors"], columns=["line", "error"]))
+            st.session_state["cases_df"] = load_cases()
+        except Exception as e:
+            st.error(f"Import failed: {e}")
+
+with st.sidebar.expander("District boundaries (zipped shapefile)"):
+    shp_zip = st.file_uploader("Shapefile .zip", type=["zip"], key="shapefile_upload")
+    if shp_zip is not None:
+        try:
+            # cached by content hash, so re-uploading a known zip is near-instant
+            st.session_state["shapefile_gdf"] = load_shapefile_from_zip(shp_zip)
+            st.caption(f"{len(st.session_state['shapefile_gdf'])} boundary polygons loaded.")
+        except Exception as e:
+            st.error(f"Could not read shapefile: {e}")
 
 # ---------- ABOUT PAGE ----------
 if st.session_state.get("page") == "about":
     st.header("About Surveilai")
     st.markdown("**Surveilai** — an outbreak surveillance MVP built for rapid situational awareness.")
-    st.stop()
+    stop()
 
 # ---------- MAIN APP ----------
 st.header("Surveilai — District outbreak risk & case reporting")
@@ -149,8 +233,13 @@ col1, col2 = st.columns([1, 1])
 # ---------------- LEFT: Case reporting ----------------
 with col1:
     st.subheader("Report a case")
+    # rollups keep counting archived weeks; the loaded frame (and the map) only holds the hot table
+    total = query_rollups(())["cases"].fillna(0).iloc[0]
     df_cases = st.session_state.get("cases_df", pd.DataFrame())
-    st.write(f"Total cases recorded: **{len(df_cases)}**")
+    st.write(f"Total cases recorded: **{int(total)}**")
+    if int(total) > len(df_cases):
+        st.caption(f"{int(total) - len(df_cases)} cases from archived epiweeks are counted here but not on the map; "
+                   "exports and summaries still include them.")
 
     with st.form("case_form", clear_on_submit=True):
         case_id = st.text_input("Case ID (auto)", value=str(uuid.uuid4())[:8], disabled=True)
@@ -176,6 +265,8 @@ with col1:
 
         submitted = st.form_submit_button("Submit case")
         if submitted:
+            symptoms = [s for s, checked in (("fever", fever), ("cough", cough), ("rash", rash)) if checked]
+            symptoms += [s.strip() for s in other_symptoms.split(",") if s.strip()]
             record = {
                 "case_id": case_id,
                 "entry_date": pd.to_datetime(entry_date),
@@ -197,42 +288,97 @@ with col1:
                 "other_symptoms": other_symptoms,
                 "created_by": st.session_state["user"]["username"],
                 "created_at": datetime.utcnow(),
+                # cases-table columns
+                "name": name,
+                "reporter": reporter,
+                "lab_positive": int(lab_positive == "Positive"),
+                "symptoms": ", ".join(symptoms),
             }
+            record["classification"] = classify_case(record, config.get("classification_rules"))
             try:
                 add_case(record)
                 st.success(f"Case {case_id} saved.")
-                try:
-                    st.session_state["cases_df"] = query_summary()
-                except Exception:
-                    st.session_state["cases_df"] = pd.concat([df_cases, pd.DataFrame([record])], ignore_index=True)
-            except Exception:
-                st.session_state["cases_df"] = pd.concat([df_cases, pd.DataFrame([record])], ignore_index=True)
-                st.warning("Saved locally (DB save failed).")
+                # add_case flags likely duplicates in the same transaction (dedup.py)
+                possible = flagged_duplicates(case_id=case_id)
+                if not possible.empty:
+                    st.warning("Possible duplicate of " + ", ".join(possible["duplicate_of"]) + "; an admin can review it.")
+                st.session_state["cases_df"] = load_cases()
+            except Exception as e:
+                st.error(f"Could not save case: {e}")
 
 # ---------------- RIGHT: Analytics ----------------
 with col2:
     st.subheader("Analytics & dashboard")
-    cases_df = st.session_state.get("cases_df", pd.DataFrame())
-    if cases_df.empty:
+    # small rollup tables maintained on write; no scan of the case table per rerun
+    epi_curve = query_rollups(("year", "epiweek"))
+    epi_curve = epi_curve[epi_curve["year"] > 0]
+    if epi_curve.empty:
         st.info("No cases recorded yet.")
     else:
-        cases_df["onset_date"] = pd.to_datetime(cases_df["onset_date"], errors="coerce")
-        cases_df["entry_date"] = pd.to_datetime(cases_df["entry_date"], errors="coerce")
-        cases_df["epiweek"] = cases_df["onset_date"].dt.isocalendar().week
-        cases_df["year"] = cases_df["onset_date"].dt.isocalendar().year
-
-        epi_curve = cases_df.groupby(["year", "epiweek"]).size().reset_index(name="cases")
-        fig = px.bar(epi_curve, x="epiweek", y="cases", title="Epicurve (cases per epiweek)")
+        epi_curve["week"] = epi_curve["year"].astype(str) + "-W" + epi_curve["epiweek"].astype(str).str.zfill(2)
+        fig = px.bar(epi_curve, x="week", y="cases", title="Epicurve (cases per epiweek)")
         st.plotly_chart(fig, use_container_width=True)
 
         st.write("Cases by sex")
-        st.table(cases_df["sex"].value_counts())
+        st.table(query_rollups(("sex",)).set_index("sex")["cases"])
 
-        bins = [0, 4, 9, 14, 24, 44, 64, 120]
-        labels = ["0-4", "5-9", "10-14", "15-24", "25-44", "45-64", "65+"]
-        cases_df["age_group"] = pd.cut(cases_df["age"].fillna(0).astype(int), bins=bins, labels=labels, right=True)
         st.write("Cases by age group")
-        st.table(cases_df["age_group"].value_counts().reindex(labels))
+        st.table(query_rollups(("age_band",)).set_index("age_band")["cases"].reindex(AGE_LABELS, fill_value=0))
+
+    hotspots = active_alerts()
+    if not hotspots.empty:
+        st.warning("Active alerts: " + ", ".join(
+            f"{r.district} ({r.count} cases in {config.alerts.recent_days} days)" for r in hotspots.itertuples()))
+
+    scores = query_district_scores("latest")
+    if not scores.empty:
+        st.write(f"District risk scores (week ending {scores['week_end'].iloc[0]})")
+        st.dataframe(scores[["district", "cases_7d", "growth_7d", "per_1000", "score"]].head(20), use_container_width=True)
+
+# ---------- MAP ----------
+# cases are binned into grid cells per zoom level (tiles.py, cached per data version);
+# only the cells in the current viewport are drawn, so the payload does not grow with cases
+st.subheader("Case map")
+map_view = st.session_state.setdefault("map_view", {"center": (7.95, -1.02), "zoom": 6, "bounds": None})
+cells = cells_in_view(map_view["zoom"], map_view["bounds"])
+# the base map never changes, so st_folium updates the layer in place instead of re-rendering
+case_map = folium.Map(location=(7.95, -1.02), zoom_start=6, tiles="cartodbpositron")
+case_layer = folium.FeatureGroup(name="Cases")
+peak = max(int(cells["cases"].max()), 1) if not cells.empty else 1
+for cell in cells.itertuples():
+    shade = 0.15 + 0.6 * (np.log1p(cell.cases) / np.log1p(peak))
+    folium.Rectangle(bounds=[[cell.south, cell.west], [cell.north, cell.east]], weight=0, fill=True,
+                     fill_color="#d7301f", fill_opacity=float(shade),
+                     tooltip=f"{cell.cases} cases ({cell.confirmed} confirmed)").add_to(case_layer)
+boundaries = st.session_state.get("shapefile_gdf")
+if boundaries is not None:
+    # pre-simplified geometry for this zoom, built once per boundary file; only scores are joined per rerun
+    latest_scores = query_district_scores("latest")
+    risk = dict(zip(latest_scores["district"], latest_scores["score"].round(3)))
+    risk_scale = branca.colormap.LinearColormap(["#ffffb2", "#fd8d3c", "#bd0026"], vmin=0, vmax=1)
+    folium.GeoJson(
+        join_properties(layer_for_zoom(boundaries, map_view["zoom"]), risk, "score"),
+        style_function=lambda f: {"fillColor": risk_scale(f["properties"]["score"] or 0), "color": "#555555",
+                                  "weight": 0.5, "fillOpacity": 0.35 if f["properties"]["score"] is not None else 0.0},
+        tooltip=folium.GeoJsonTooltip(["district", "score"]),
+    ).add_to(case_layer)
+for epicenter in recent_epicenters(config.alerts.cluster_time_window_days):
+    folium.CircleMarker([epicenter["lat"], epicenter["lon"]], radius=6 + min(epicenter["count"], 50) ** 0.5,
+                        color="#000000", weight=2, fill=False,
+                        tooltip=f"Epicenter: {epicenter['count']} cases").add_to(case_layer)
+map_state = st_folium(case_map, feature_group_to_add=case_layer, center=map_view["center"], zoom=map_view["zoom"],
+                      height=450, use_container_width=True, key="case_map", returned_objects=["bounds", "zoom", "center"])
+if map_state and map_state.get("bounds") and map_state["bounds"].get("_southWest"):
+    sw, ne = map_state["bounds"]["_southWest"], map_state["bounds"]["_northEast"]
+    center = map_state.get("center") or {}
+    new_view = {"center": (center.get("lat", map_view["center"][0]), center.get("lng", map_view["center"][1])),
+                "zoom": map_state.get("zoom") or map_view["zoom"],
+                "bounds": (sw["lat"], sw["lng"], ne["lat"], ne["lng"])}
+    if new_view["zoom"] != map_view["zoom"] or new_view["bounds"] != map_view["bounds"]:
+        st.session_state["map_view"] = new_view
+        rerun()  # fetch the cells for the new viewport
+st.caption(f"{len(cells)} grid cells in view (level {int(cells['level'].iloc[0]) if not cells.empty else '-'}); "
+           "circles mark DBSCAN epicenters of recent cases. Archived epiweeks are not shown.")
 
 # ---------- ADMIN ----------
 if st.session_state["user"]["role"] == "admin" and st.session_state.get("admin_page") == "users":
@@ -253,17 +399,98 @@ if st.session_state["user"]["role"] == "admin" and st.session_state.get("admin_p
 
 if st.session_state["user"]["role"] == "admin" and st.session_state.get("admin_page") == "alerts":
     st.header("Alerts & thresholds / Config editor")
-    try:
-        cfg_text = open(CONFIG_PATH).read()
-    except Exception:
-        cfg_text = yaml.dump(config)
-    edited = st.text_area("config.yaml", value=cfg_text, height=300, key="config_text")
+    edited = st.text_area("config.yaml", value=config.text, height=300, key="config_text")
     if st.button("Save config.yaml", key="save_config"):
-        with open(CONFIG_PATH, "w") as f:
-            f.write(edited)
-        st.success("Config saved.")
+        try:
+            # validated first, then swapped in atomically; a bad edit never reaches disk
+            config = save_config_text(edited)
+            st.success("Config saved.")
+        except ConfigError as e:
+            st.error("Config not saved:\n" + "\n".join(f"- {err}" for err in e.errors))
     if st.button("Reload config", key="reload_config"):
-        st.rerun()
+        rerun()
+    if st.button("Reclassify all cases with current rules", key="reclassify_all"):
+        try:
+            changed = reclassify_all(config.get("classification_rules"), config.get("case_definitions"))
+            st.success(f"Reclassified {changed} cases.")
+        except Exception as e:
+            st.error(f"Reclassification failed: {e}")
+    if st.button("Relink cases to confirmed cases (epi_link)", key="relink_epi"):
+        # relabels every case with the epi_link settings and reclassifies the ones that changed
+        result = relink_epi_links(config)
+        st.success(f"{result['linked']} of {result['cases']} cases epi-linked; {result['changed']} changed.")
+
+    st.subheader("Threshold alerts")
+    if st.button("Re-evaluate all districts now", key="sweep_alerts"):
+        events = evaluate_alerts()
+        st.success(f"{len(events)} alert state change(s).")
+    if st.button("Verify alert counters", key="verify_alerts"):
+        diffs = rebuild_alert_counters(check_only=True)
+        if diffs.empty:
+            st.success("Alert counters match the cases table.")
+        else:
+            st.warning(f"{len(diffs)} district-days out of sync; rebuilding.")
+            rebuild_alert_counters()
+    st.dataframe(recent_alert_events(50), use_container_width=True)
+
+    st.subheader("Possible duplicate reports")
+    if st.button("Scan all cases for duplicates", key="sweep_duplicates"):
+        result = sweep_duplicates()
+        st.success(f"Scanned {result['cases']} cases, flagged {result['flagged']} new pair(s).")
+    dup_pairs = flagged_duplicates()
+    st.dataframe(dup_pairs, use_container_width=True)
+    if not dup_pairs.empty:
+        pair_labels = [f"{r.case_id} ~ {r.duplicate_of}" for r in dup_pairs.itertuples()]
+        chosen_pair = st.selectbox("Pair", pair_labels, key="duplicate_pair")
+        verdict = st.radio("Verdict", ["confirmed", "dismissed"], horizontal=True, key="duplicate_verdict")
+        if st.button("Save verdict", key="save_duplicate_verdict"):
+            set_duplicate_status(*chosen_pair.split(" ~ "), verdict)
+            rerun()
+
+if st.session_state["user"]["role"] == "admin" and st.session_state.get("admin_page") == "metrics":
+    st.header("Performance metrics (admin)")
+    if instrumentation.enabled():
+        if st.button("Disable timing", key="metrics_disable"):
+            instrumentation.enable(False)
+            rerun()
+    else:
+        st.info("Timing is off. Set SURVEILAI_METRICS=1 before starting the app, or enable it for this process.")
+        if st.button("Enable timing", key="metrics_enable"):
+            instrumentation.enable()
+            rerun()
+    metrics = instrumentation.summary()
+    if metrics.empty:
+        st.write("No timed calls yet.")
+    else:
+        st.dataframe(metrics, use_container_width=True)
+        labels = [f"{r.group}.{r.name}" for r in metrics.itertuples()]
+        chosen = st.selectbox("Latency histogram", labels, key="metrics_histogram")
+        group, name = chosen.split(".", 1)
+        hist = instrumentation.histogram(group, name)
+        st.plotly_chart(px.bar(hist, x="le", y="calls", title=f"{chosen} (calls per latency bucket, seconds)"),
+                        use_container_width=True)
+    st.subheader(f"Slow calls (over {instrumentation.SLOW_SECONDS * 1000:.0f} ms)")
+    st.dataframe(instrumentation.slow_calls(), use_container_width=True)
+    if st.button("Reset metrics", key="metrics_reset"):
+        instrumentation.reset()
+        rerun()
+    st.caption(f"Prometheus text file: {instrumentation.METRICS_FILE} (rewritten after every rerun while timing is on)")
+
+    st.subheader("Profile")
+    if st.button("Profile the next rerun", key="metrics_profile"):
+        st.session_state["profile_next_rerun"] = True
+        rerun()
+    if st.session_state.get("last_profile"):
+        captured_at, report, raw = st.session_state["last_profile"]
+        st.write(f"Captured {captured_at}")
+        st.code(report)
+        st.download_button("Download .prof", raw, file_name="surveilai_rerun.prof", key="metrics_profile_download")
 
 st.markdown("---")
 st.write("Surveilai — MVP. Created by LIMA Group.")
+
+if finish_profile():
+    st.rerun()  # show the capture
+if instrumentation.enabled():
+    instrumentation.record("app", "rerun", time.perf_counter() - rerun_started)
+    instrumentation.write_prometheus()
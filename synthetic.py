@@ -0,0 +1,165 @@
+"""
+synthetic.py
+
+Synthetic, realistic-looking surveillance data for benchmarks and demos.
+
+    synthetic_districts(n)   irregular (Voronoi) district polygons covering a bounding box
+    generate_cases(n, ...)   a case line list with seasonal onset dates, clustered
+                             coordinates, district assignment from the polygons,
+                             plausible sex/age/symptom mixes and rule-based classification
+
+Generation is chunked and seeded, so millions of rows can be streamed to CSV with
+bounded memory and the same arguments always give the same data.
+
+Usage:
+    python synthetic.py cases.csv --rows 1000000 --districts 260 --boundaries districts.zip
+"""
+import argparse
+import os
+import tempfile
+import zipfile
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from shapely.geometry import box
+
+from classification import compile_rules
+from geo import DistrictLocator
+from settings import load_config
+from utils import CASE_COLUMNS, CONFIG
+
+BBOX = (-3.26, 4.74, 1.2, 11.17)  # lon/lat box roughly covering Ghana
+START = "2023-01-01"
+END = "2025-12-31"
+CHUNK_ROWS = 200000
+SYMPTOMS = ["fever", "cough", "chills", "headache", "muscle pain", "rash", "vomiting", "diarrhea"]
+SYMPTOM_P = [0.8, 0.5, 0.3, 0.45, 0.3, 0.15, 0.2, 0.2]
+AGE_GROUPS = [(0, 4, 0.16), (5, 14, 0.22), (15, 24, 0.19), (25, 44, 0.25), (45, 64, 0.13), (65, 95, 0.05)]
+
+
+def synthetic_districts(n=260, bbox=BBOX, seed=0):
+    """GeoDataFrame (EPSG:4326) of n Voronoi districts with district and region columns."""
+    rng = np.random.default_rng(seed)
+    minx, miny, maxx, maxy = bbox
+    pts = shapely.points(rng.uniform(minx, maxx, n), rng.uniform(miny, maxy, n))
+    frame = box(*bbox)
+    cells = shapely.get_parts(shapely.voronoi_polygons(shapely.multipoints(pts), extend_to=frame))
+    cells = shapely.intersection(cells, frame)
+    # voronoi_polygons does not keep input order; sort cells so names are stable
+    order = np.lexsort((shapely.get_coordinates(shapely.centroid(cells))[:, 0],
+                        shapely.get_coordinates(shapely.centroid(cells))[:, 1]))
+    cells = cells[order]
+    names = [f"District {i + 1:03d}" for i in range(len(cells))]
+    regions = [f"Region {i % 16 + 1:02d}" for i in range(len(cells))]
+    return gpd.GeoDataFrame({"district": names, "region": regions}, geometry=list(cells), crs="EPSG:4326")
+
+
+def write_boundaries_zip(gdf, path):
+    """Write the polygons as a zipped shapefile, the format the upload widget expects."""
+    with tempfile.TemporaryDirectory() as tmp:
+        shp = os.path.join(tmp, "districts.shp")
+        gdf.to_file(shp)
+        with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zf:
+            for name in os.listdir(tmp):
+                zf.write(os.path.join(tmp, name), name)
+    return path
+
+
+def _seasonal_days(rng, n, start, end):
+    days = pd.date_range(start, end, freq="D")
+    doy = days.dayofyear.to_numpy()
+    # two rainy-season peaks plus a slow upward trend
+    weight = (1 + 0.8 * np.exp(-((doy - 150) / 25.0) ** 2) + 0.5 * np.exp(-((doy - 270) / 20.0) ** 2)
+              + np.linspace(0, 0.3, len(days)))
+    return days[rng.choice(len(days), size=n, p=weight / weight.sum())]
+
+
+def _coordinates(rng, n, hotspots, spread_km, background):
+    lat = np.empty(n)
+    lon = np.empty(n)
+    is_bg = rng.random(n) < background
+    k = int(is_bg.sum())
+    minx, miny, maxx, maxy = BBOX
+    lat[is_bg] = rng.uniform(miny, maxy, k)
+    lon[is_bg] = rng.uniform(minx, maxx, k)
+    centre = rng.integers(0, len(hotspots), n - k)
+    sd = spread_km / 111.0
+    lat[~is_bg] = hotspots[centre, 0] + rng.normal(0, sd, n - k)
+    lon[~is_bg] = hotspots[centre, 1] + rng.normal(0, sd, n - k)
+    return lat, lon
+
+
+def iter_case_chunks(n, districts=None, seed=0, start=START, end=END, hotspots=40, spread_km=3.0,
+                     background=0.3, chunk_rows=CHUNK_ROWS, config_rules=None):
+    """Yield DataFrames of CASE_COLUMNS (+ lat, lon) totalling n synthetic cases."""
+    districts = districts if districts is not None else synthetic_districts(seed=seed)
+    locator = DistrictLocator(districts)
+    rules = compile_rules(config_rules if config_rules is not None else load_config(CONFIG).classification_rules)
+    rng = np.random.default_rng(seed)
+    minx, miny, maxx, maxy = BBOX
+    centres = np.column_stack([rng.uniform(miny, maxy, hotspots), rng.uniform(minx, maxx, hotspots)])
+    lo, hi, p = (np.array(v) for v in zip(*AGE_GROUPS))
+    for offset in range(0, n, chunk_rows):
+        m = min(chunk_rows, n - offset)
+        crng = np.random.default_rng([seed, offset])
+        lat, lon = _coordinates(crng, m, centres, spread_km, background)
+        places = locator.assign_districts(lat, lon)
+        group = crng.choice(len(p), size=m, p=p / p.sum())
+        symptoms = crng.random((m, len(SYMPTOMS))) < np.array(SYMPTOM_P)
+        sym_text = [", ".join(SYMPTOMS[j] for j in np.flatnonzero(row)) for row in symptoms]
+        df = pd.DataFrame({
+            "case_id": [f"S{offset + i:08d}" for i in range(m)],
+            "name": None,
+            "sex": crng.choice(["Male", "Female"], size=m),
+            "age": crng.integers(lo[group], hi[group] + 1),
+            "reporter": crng.choice([f"Reporter {i}" for i in range(50)], size=m),
+            "region": places["region"].to_numpy() if "region" in places else None,
+            "district": places["district"].to_numpy() if "district" in places else None,
+            "community": None,
+            "onset_date": _seasonal_days(crng, m, start, end).strftime("%Y-%m-%d"),
+            "lab_positive": (crng.random(m) < 0.2).astype(int),
+            "symptoms": sym_text,
+            "coords": [f"{a:.5f},{b:.5f}" for a, b in zip(lat, lon)],
+            "lat": lat,
+            "lon": lon,
+        })
+        df["classification"] = rules.classify_frame(df)
+        yield df[CASE_COLUMNS + ["lat", "lon"]]
+
+
+def generate_cases(n, districts=None, seed=0, **kwargs):
+    """All n synthetic cases as one DataFrame (use iter_case_chunks for very large n)."""
+    return pd.concat(iter_case_chunks(n, districts, seed, **kwargs), ignore_index=True)
+
+
+def write_line_list(path, n, districts=None, seed=0, **kwargs):
+    """Stream n synthetic cases to a CSV line list (the ingest.py format)."""
+    with open(path, "w", newline="") as f:
+        for i, chunk in enumerate(iter_case_chunks(n, districts, seed, **kwargs)):
+            chunk[CASE_COLUMNS].to_csv(f, index=False, header=(i == 0))
+    return path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a synthetic case line list and district polygons")
+    parser.add_argument("path", help="output CSV")
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--districts", type=int, default=260)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--from", dest="start", default=START)
+    parser.add_argument("--to", dest="end", default=END)
+    parser.add_argument("--boundaries", default=None, help="also write the polygons as a zipped shapefile")
+    args = parser.parse_args(argv)
+    districts = synthetic_districts(args.districts, seed=args.seed)
+    write_line_list(args.path, args.rows, districts, args.seed, start=args.start, end=args.end)
+    print("Saved", args.path)
+    if args.boundaries:
+        write_boundaries_zip(districts, args.boundaries)
+        print("Saved", args.boundaries)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,18 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils  # noqa: E402
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """A fresh, migrated database for one test."""
+    path = str(tmp_path / "surveilai.db")
+    monkeypatch.setattr(utils, "DB", path)
+    utils.init_db()
+    yield path
+    utils.close_pool(path)
@@ -0,0 +1,90 @@
+"""
+In-memory stand-in for the part of the Firestore client that firebase_integration uses:
+collection().document(), batch().set()/commit(), and order_by/where/limit/start_after/stream
+queries. Install it with firebase_integration.set_client(FakeFirestore()).
+"""
+import copy
+import operator
+
+OPS = {"<": operator.lt, "<=": operator.le, "==": operator.eq, ">": operator.gt, ">=": operator.ge}
+
+
+class Snapshot:
+    def __init__(self, doc_id, data):
+        self.id = doc_id
+        self._data = data
+
+    def to_dict(self):
+        return copy.deepcopy(self._data)
+
+
+class DocumentRef:
+    def __init__(self, store, doc_id):
+        self.store, self.id = store, doc_id
+
+    def get(self):
+        return Snapshot(self.id, self.store.get(self.id))
+
+
+class Query:
+    def __init__(self, store, order=None, filters=(), limit=None, after=None):
+        self.store, self.order, self.filters, self._limit, self.after = store, order, tuple(filters), limit, after
+
+    def _with(self, **changes):
+        state = {"order": self.order, "filters": self.filters, "limit": self._limit, "after": self.after, **changes}
+        return Query(self.store, **state)
+
+    def order_by(self, field):
+        return self._with(order=field)
+
+    def where(self, field, op, value):
+        return self._with(filters=self.filters + ((field, OPS[op], value),))
+
+    def limit(self, n):
+        return self._with(limit=n)
+
+    def start_after(self, snapshot):
+        return self._with(after=snapshot)
+
+    def document(self, doc_id):
+        return DocumentRef(self.store, doc_id)
+
+    def stream(self):
+        docs = [(doc_id, data) for doc_id, data in self.store.items()
+                if all(field in data and op(data[field], value) for field, op, value in self.filters)]
+        if self.order is not None:
+            docs = sorted((d for d in docs if self.order in d[1]), key=lambda d: (d[1][self.order], d[0]))
+            if self.after is not None:
+                cursor = (self.after._data[self.order], self.after.id)
+                docs = [d for d in docs if (d[1][self.order], d[0]) > cursor]
+        if self._limit is not None:
+            docs = docs[:self._limit]
+        return iter([Snapshot(doc_id, data) for doc_id, data in docs])
+
+
+class Batch:
+    def __init__(self, client):
+        self.client, self.writes = client, []
+
+    def set(self, ref, data):
+        if len(self.writes) >= 500:
+            raise ValueError("a batch holds at most 500 writes")
+        self.writes.append((ref, copy.deepcopy(data)))
+
+    def commit(self):
+        for ref, data in self.writes:
+            ref.store[ref.id] = data
+        self.client.commits += 1
+        self.writes = []
+
+
+class FakeFirestore:
+    def __init__(self):
+        self.collections = {}
+        self.commits = 0
+
+    def collection(self, name):
+        return Query(self.collections.setdefault(name, {}))
+
+    def batch(self):
+        return Batch(self)
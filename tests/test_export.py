@@ -0,0 +1,14 @@
+from datetime import datetime
+
+import pandas as pd
+
+from export import iter_chunks
+from utils import add_case
+
+
+def test_start_filter_keeps_the_start_day(db):
+    add_case({"case_id": "c-1", "district": "Accra", "onset_date": "2026-01-05"})
+    add_case({"case_id": "c-2", "district": "Accra", "onset_date": "2026-01-04"})
+    for start in ("2026-01-05", datetime(2026, 1, 5), pd.Timestamp("2026-01-05")):
+        rows = [r for chunk in iter_chunks(start=start, end=start) for r in chunk]
+        assert [r[0] for r in rows] == ["c-1"]
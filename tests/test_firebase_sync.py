@@ -0,0 +1,79 @@
+import pytest
+
+import firebase_integration as fi
+import utils
+from utils import add_cases_bulk, connection, init_db, transaction
+
+from fake_firestore import FakeFirestore
+
+
+def case(case_id, district="Accra", classification="Suspected"):
+    return {"case_id": case_id, "name": "", "sex": "F", "age": 30, "reporter": "test", "region": "Greater Accra",
+            "district": district, "community": "", "onset_date": "2026-01-05", "lab_positive": 0,
+            "symptoms": "fever", "classification": classification, "coords": "5.6,-0.2"}
+
+
+@pytest.fixture
+def two_databases(tmp_path, monkeypatch):
+    """Switch utils.DB between two fresh databases sharing one fake Firestore."""
+    paths = {name: str(tmp_path / f"{name}.db") for name in ("a", "b")}
+
+    def use(name):
+        monkeypatch.setattr(utils, "DB", paths[name])
+        init_db()
+
+    client = FakeFirestore()
+    fi.set_client(client)
+    yield use, client
+    fi.set_client(None)
+    for path in paths.values():
+        utils.close_pool(path)
+
+
+def classification_of(case_id):
+    with connection() as conn:
+        return conn.execute("SELECT classification FROM cases WHERE case_id = ?", (case_id,)).fetchone()[0]
+
+
+def test_push_pull_round_trip_moves_watermarks(two_databases):
+    use, client = two_databases
+    use("a")
+    add_cases_bulk([case("a-1"), case("a-2")])
+    assert fi.push_changes() == 2
+    assert fi.push_changes() == 0  # push watermark moved past both rows
+    assert sorted(client.collections["cases"]) == ["a-1", "a-2"]
+
+    use("b")
+    assert fi.pull_changes() == 2
+    assert fi.pull_changes() == 0  # pull watermark moved past both documents
+    assert fi.push_changes() == 0  # pulled rows are not pushed back
+    with transaction() as conn:
+        conn.execute("UPDATE cases SET classification = 'Confirmed' WHERE case_id = 'a-1'")
+    add_cases_bulk([case("b-1")])
+    assert fi.push_changes() == 2
+
+    use("a")
+    assert fi.pull_changes() == 2  # a-2 was written by this database and is skipped
+    assert classification_of("a-1") == "Confirmed"
+    assert classification_of("b-1") == "Suspected"
+    assert fi.push_changes() == 0
+    assert fi.sync() == {"pushed": 0, "pulled": 0}
+
+
+def test_push_batches_at_most_batch_size(two_databases):
+    use, client = two_databases
+    use("a")
+    add_cases_bulk([case(f"a-{i}") for i in range(7)])
+    assert fi.push_changes(batch_size=3) == 7
+    assert client.commits == 3
+
+
+def test_pull_pages_through_many_documents(two_databases):
+    use, client = two_databases
+    use("a")
+    add_cases_bulk([case(f"a-{i}") for i in range(12)])
+    fi.push_changes()
+    use("b")
+    assert fi.pull_changes(page_size=5) == 12
+    with connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM cases").fetchone()[0] == 12
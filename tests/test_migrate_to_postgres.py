@@ -0,0 +1,25 @@
+import sqlite3
+
+from migrate_to_postgres import migrate
+from utils import add_case
+
+
+def column_defaults(path, table):
+    with sqlite3.connect(path) as conn:
+        return {r[1]: r[4] for r in conn.execute(f'PRAGMA table_info("{table}")')}
+
+
+def test_defaults_and_partial_indexes_survive(db, tmp_path):
+    add_case({"case_id": "c-1", "district": "Accra", "onset_date": "2026-01-05", "lab_positive": 1})
+    target = str(tmp_path / "copy.db")
+    assert migrate(db, f"sqlite:///{target}", workers=1)["cases"] == 1
+    for table in ("cases", "notification_outbox", "users", "alert_state", "case_rollups"):
+        source = {k: v for k, v in column_defaults(db, table).items() if v is not None}
+        assert source and {k: column_defaults(target, table)[k] for k in source} == source
+    with sqlite3.connect(target) as conn:
+        # inserts that leave defaulted columns out still work after cutover
+        conn.execute("INSERT INTO notification_outbox (channel, recipient, body, dedup_key, next_attempt_at, created_at) "
+                     "VALUES ('email', 'a@example.org', 'b', 'k', 0, 0)")
+        assert conn.execute("SELECT status, attempts FROM notification_outbox").fetchone() == ("pending", 0)
+        sql = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'idx_cases_confirmed_onset'").fetchone()[0]
+    assert sql.endswith("WHERE lab_positive != 0")
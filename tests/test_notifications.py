@@ -0,0 +1,106 @@
+import time
+
+import notifications
+from notifications import Dispatcher, SmtpTransport, enqueue, outbox_counts
+from utils import connection, transaction
+
+
+class FakeTransport:
+    def __init__(self, fail=False):
+        self.sent = []
+        self.fail = fail
+
+    def send(self, recipient, subject, body):
+        if self.fail:
+            raise ConnectionError("down")
+        self.sent.append((recipient, subject, body))
+        return f"fake-{len(self.sent)}"
+
+    def close(self):
+        pass
+
+
+def dispatcher(**transports):
+    return Dispatcher(transports, rate_limits={"email": 1000, "sms": 1000}, backoff_base=0)
+
+
+def test_dispatch_sends_each_message_once(db):
+    email, sms = FakeTransport(), FakeTransport()
+    enqueue("email", ["a@example.org", "b@example.org"], "Alert", "Cases rising")
+    enqueue("sms", "+233200000000", None, "Cases rising")
+    assert enqueue("email", "a@example.org", "Alert", "Cases rising") == []  # duplicate within the window
+    d = dispatcher(email=email, sms=sms)
+    try:
+        assert d.run_once() == (3, 0)
+        assert d.run_once() == (0, 0)
+    finally:
+        d.stop()
+    assert sorted(r for r, _, _ in email.sent) == ["a@example.org", "b@example.org"]
+    assert sms.sent == [("+233200000000", None, "Cases rising")]
+    assert outbox_counts() == {"sent": 3}
+
+
+def test_failures_retry_until_max_attempts(db):
+    enqueue("email", "a@example.org", "Alert", "Cases rising")
+    d = Dispatcher({"email": FakeTransport(fail=True)}, max_attempts=2, backoff_base=0)
+    try:
+        assert d.run_once() == (0, 1)
+        assert outbox_counts() == {"pending": 1}
+        assert d.run_once() == (0, 1)
+    finally:
+        d.stop()
+    with connection() as conn:
+        assert conn.execute("SELECT status, attempts, last_error FROM notification_outbox").fetchone() == \
+            ("failed", 2, "ConnectionError: down")
+
+
+def test_only_stale_claims_are_taken_over(db):
+    enqueue("email", ["live@example.org", "dead@example.org"], "Alert", "Cases rising")
+    now = time.time()
+    with transaction() as conn:
+        conn.execute("UPDATE notification_outbox SET status = 'sending', attempts = 1, claimed_by = 'other', "
+                     "claimed_at = ? WHERE recipient = 'live@example.org'", (now,))
+        conn.execute("UPDATE notification_outbox SET status = 'sending', attempts = 1, claimed_by = 'other', "
+                     "claimed_at = ? WHERE recipient = 'dead@example.org'", (now - 2 * notifications.CLAIM_TIMEOUT_SECONDS,))
+    email = FakeTransport()
+    d = dispatcher(email=email)  # starting a second dispatcher must not requeue the live claim
+    try:
+        assert d.run_once() == (1, 0)
+    finally:
+        d.stop()
+    assert email.sent == [("dead@example.org", "Alert", "Cases rising")]
+    with connection() as conn:
+        rows = dict(conn.execute("SELECT recipient, status FROM notification_outbox").fetchall())
+    assert rows == {"live@example.org": "sending", "dead@example.org": "sent"}
+
+
+def test_finish_ignores_rows_claimed_by_another_dispatcher(db):
+    enqueue("email", "a@example.org", "Alert", "Cases rising")
+    d = dispatcher(email=FakeTransport())
+    try:
+        (row,) = d._claim()
+        with transaction() as conn:
+            conn.execute("UPDATE notification_outbox SET claimed_by = 'other'")
+        d._finish(row[0], row[5] + 1, provider_id="late")
+    finally:
+        d.stop()
+    assert outbox_counts() == {"sending": 1}
+
+
+def test_smtp_transport_returns_message_id():
+    class FakeServer:
+        def __init__(self):
+            self.messages = []
+
+        def send_message(self, msg):
+            self.messages.append(msg)
+
+        def quit(self):
+            pass
+
+    server = FakeServer()
+    transport = SmtpTransport("localhost", sender="alerts@example.org", use_tls=False)
+    transport._connect = lambda: server
+    message_id = transport.send("a@example.org", "Alert", "Cases rising")
+    assert message_id and message_id.endswith("@example.org>")
+    assert server.messages[0]["Message-ID"] == message_id
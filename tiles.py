@@ -0,0 +1,256 @@
+"""
+tiles.py
+
+Map aggregation layer: geocoded cases binned into Web Mercator grid cells at
+several zoom levels, so the map sends a bounded number of cells instead of one
+marker per case.
+
+At level z the world is 2**z tiles across and each tile is split into
+CELLS_PER_TILE x CELLS_PER_TILE cells (64 px squares on screen at that zoom).
+All levels are built in one vectorized pass over the shared case frame
+(utils.load_cases); when the data version (case_version) moves, only the rows
+changed or deleted since then are re-binned, and reruns that only pan or zoom
+reuse the cells as they are. cells_in_view() picks the level for the map's zoom
+and returns just the cells inside the viewport, capped at MAX_CELLS; the
+payload therefore depends on the screen size, not on the number of cases.
+
+Usage:
+    from tiles import cells_in_view
+    cells = cells_in_view(zoom=8, bounds=(south, west, north, east))
+"""
+import math
+import threading
+
+import numpy as np
+import pandas as pd
+
+import utils
+from clustering import ClusterEngine
+from utils import _case_version, connection, load_cases, read_snapshot
+
+LEVELS = (2, 4, 6, 8, 10, 12, 14)
+CELLS_PER_TILE = 4
+MAX_CELLS = 2000
+MAX_LAT = 85.05112878  # Web Mercator limit
+CONFIRMED = "Confirmed"
+
+
+# ---------- projection ----------
+def mercator(lat, lon):
+    """Normalized Web Mercator coordinates in [0, 1): x grows east, y grows south."""
+    lat = np.clip(np.asarray(lat, dtype=float), -MAX_LAT, MAX_LAT)
+    lon = np.asarray(lon, dtype=float)
+    x = (lon + 180.0) / 360.0
+    y = 0.5 - np.log(np.tan(np.pi / 4 + np.radians(lat) / 2)) / (2 * np.pi)
+    return np.clip(x, 0, 1 - 1e-12), np.clip(y, 0, 1 - 1e-12)
+
+
+def _lat_of(y):
+    return np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * np.asarray(y, dtype=float)))))
+
+
+def cells_across(level):
+    return (2 ** level) * CELLS_PER_TILE
+
+
+def cell_bounds(level, cx, cy):
+    """(south, west, north, east) in degrees of grid cells (scalars or arrays)."""
+    n = cells_across(level)
+    cx, cy = np.asarray(cx, dtype=float), np.asarray(cy, dtype=float)
+    return _lat_of((cy + 1) / n), cx / n * 360.0 - 180.0, _lat_of(cy / n), (cx + 1) / n * 360.0 - 180.0
+
+
+def level_for(zoom):
+    """Finest stored level not finer than the map zoom (coarsest level for small zooms)."""
+    fitting = [lv for lv in LEVELS if lv <= zoom]
+    return fitting[-1] if fitting else LEVELS[0]
+
+
+# ---------- binning ----------
+def case_points(df):
+    """DataFrame of lat, lon, classification, onset_date (and case_id, if present) for cases with parseable coords."""
+    columns = ["lat", "lon", "classification", "onset_date"]
+    if df is None or df.empty or "coords" not in df.columns:
+        return pd.DataFrame(columns=(["case_id"] if df is not None and "case_id" in df.columns else []) + columns)
+    # numpy's fixed-width string ops are several times faster than .str.split on large frames
+    parts = np.char.partition(df["coords"].fillna("").to_numpy(dtype=str), ",")
+    lat = pd.to_numeric(np.char.strip(parts[:, 0]), errors="coerce")
+    lon = pd.to_numeric(np.char.strip(parts[:, 2]), errors="coerce")
+    ok = (lat >= -90) & (lat <= 90) & (lon >= -180) & (lon <= 180)
+    out = {"case_id": df["case_id"].to_numpy()[ok]} if "case_id" in df.columns else {}
+    out.update({"lat": lat[ok], "lon": lon[ok],
+                "classification": df["classification"].to_numpy()[ok],
+                "onset_date": df["onset_date"].to_numpy()[ok]})
+    return pd.DataFrame(out)
+
+
+def _keyed_cells(x, y, confirmed, level):
+    """DataFrame(cases, confirmed) indexed by cell key cx * n + cy."""
+    n = cells_across(level)
+    key = (x * n).astype(np.int64) * n + (y * n).astype(np.int64)
+    uniq, inverse, counts = np.unique(key, return_inverse=True, return_counts=True)
+    return pd.DataFrame({"cases": counts,
+                         "confirmed": np.bincount(inverse, weights=confirmed, minlength=len(uniq)).astype(np.int64)},
+                        index=uniq)
+
+
+def _unkey(cells, level):
+    n = cells_across(level)
+    key = cells.index.to_numpy(dtype=np.int64)
+    return pd.DataFrame({"cx": key // n, "cy": key % n, "cases": cells["cases"].to_numpy(),
+                         "confirmed": cells["confirmed"].to_numpy()})
+
+
+def bin_points(lat, lon, confirmed=None, levels=LEVELS):
+    """{level: DataFrame(cx, cy, cases, confirmed)} for every level, from one projection of the points."""
+    x, y = mercator(lat, lon)
+    confirmed = np.zeros(len(x), dtype=np.int64) if confirmed is None else np.asarray(confirmed, dtype=np.int64)
+    return {level: _unkey(_keyed_cells(x, y, confirmed, level), level) for level in levels}
+
+
+def _indexed_points(df):
+    """case_points of df indexed by case_id, with projected x, y and a confirmed flag."""
+    points = case_points(df)
+    x, y = mercator(points["lat"], points["lon"])
+    return pd.DataFrame({"lat": points["lat"].to_numpy(dtype=float), "lon": points["lon"].to_numpy(dtype=float),
+                         "x": x, "y": y,
+                         "confirmed": (points["classification"] == CONFIRMED).to_numpy(dtype=np.int64),
+                         "onset_date": pd.to_datetime(points["onset_date"], errors="coerce").to_numpy()},
+                        index=pd.Index(points["case_id"], name="case_id"))
+
+
+class _TileCache:
+    """
+    Binned cells and epicenter engines for one database. The first refresh bins the
+    whole case frame; later refreshes read only the rows changed or deleted since the
+    cached version (row_version and case_tombstones, as utils.load_cases does) and move
+    their counts between cells. Each (window_days, eps_meters, min_samples) keeps a
+    clustering.ClusterEngine over the window ending at the latest onset, fed the new
+    points; it is rebuilt only when a deleted or edited case was inside its window or
+    the latest onset moved back, since the engine cannot remove single points.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = -1
+        self.points = None  # lat, lon, x, y, confirmed, onset_date by case_id
+        self.cells = None   # {level: DataFrame(cases, confirmed) by cell key}
+        self.levels = None  # {level: DataFrame(cx, cy, cases, confirmed)}
+        self.latest = pd.NaT
+        self.engines = {}
+        self.epicenters = {}
+
+    def refresh(self):
+        with self.lock:
+            with connection() as conn, read_snapshot(conn):
+                version = _case_version(conn)
+                if self.points is not None and version == self.version:
+                    return self
+                changed = deleted = None
+                if self.points is not None:
+                    deleted = [r[0] for r in conn.execute(
+                        "SELECT case_id FROM case_tombstones WHERE row_version > ?", (self.version,))]
+                    changed = pd.read_sql_query(
+                        "SELECT case_id, coords, classification, onset_date FROM cases WHERE row_version > ?",
+                        conn, params=(self.version,))
+            if changed is None or len(changed) + len(deleted) > len(self.points) // 2:
+                self._rebuild()  # may already include rows past version; replaying them later is harmless
+            else:
+                self._apply(changed, deleted)
+            self.version, self.epicenters = version, {}
+            return self
+
+    def _rebuild(self):
+        self.points = _indexed_points(load_cases())
+        x, y, confirmed = self.points["x"].to_numpy(), self.points["y"].to_numpy(), self.points["confirmed"].to_numpy()
+        self.cells = {level: _keyed_cells(x, y, confirmed, level) for level in LEVELS}
+        self.levels = {level: _unkey(cells, level) for level, cells in self.cells.items()}
+        self.latest = self.points["onset_date"].max()
+        self.engines = {}
+
+    def _apply(self, changed, deleted):
+        gone = self.points.index.intersection(pd.Index(deleted).append(pd.Index(changed["case_id"])))
+        removed = self.points.loc[gone]
+        added = _indexed_points(changed)
+        self.points = pd.concat([self.points.drop(gone), added]) if len(added) else self.points.drop(gone)
+        for level in LEVELS:
+            cells = self.cells[level]
+            if len(removed):
+                cells = cells.sub(_keyed_cells(removed["x"].to_numpy(), removed["y"].to_numpy(),
+                                               removed["confirmed"].to_numpy(), level), fill_value=0)
+            if len(added):
+                cells = cells.add(_keyed_cells(added["x"].to_numpy(), added["y"].to_numpy(),
+                                               added["confirmed"].to_numpy(), level), fill_value=0)
+            cells = cells[cells["cases"] > 0].astype(np.int64)
+            self.cells[level], self.levels[level] = cells, _unkey(cells, level)
+        latest = self.points["onset_date"].max()
+        for key, engine in list(self.engines.items()):
+            cutoff = self.latest - pd.Timedelta(days=key[0])
+            if pd.isna(latest) or latest < self.latest or (removed["onset_date"] >= cutoff).any():
+                del self.engines[key]
+            else:
+                engine.update(added[["lat", "lon", "onset_date"]], now=latest)
+        self.latest = latest
+
+    def epicenters_for(self, window_days, eps_meters, min_samples):
+        key = (window_days, eps_meters, min_samples)
+        with self.lock:
+            if key not in self.epicenters:
+                if pd.isna(self.latest):
+                    self.epicenters[key] = []
+                else:
+                    if key not in self.engines:
+                        engine = ClusterEngine(eps_meters=eps_meters, min_samples=min_samples, window_days=window_days)
+                        engine.update(self.points[["lat", "lon", "onset_date"]], now=self.latest)
+                        self.engines[key] = engine
+                    self.epicenters[key] = self.engines[key].clusters()
+            return self.epicenters[key]
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def _cache():
+    with _caches_lock:
+        # keyed like utils.load_cases, whose DB may be repointed (tests, benchmarks)
+        return _caches.setdefault(utils.DB, _TileCache())
+
+
+def binned_levels():
+    """(data version, {level: cells}) for the current cases, rebuilt only when the data changed."""
+    cache = _cache().refresh()
+    return cache.version, cache.levels
+
+
+def cells_in_view(zoom, bounds=None, max_cells=MAX_CELLS):
+    """
+    Cells of the level matching zoom that intersect bounds = (south, west, north, east),
+    with cases, confirmed and cell bounds in degrees. Without bounds the whole level is
+    considered. At most max_cells cells are returned (the busiest ones).
+    """
+    _, levels = binned_levels()
+    level = level_for(zoom)
+    cells = levels[level]
+    if bounds is not None and not cells.empty:
+        south, west, north, east = bounds
+        n = cells_across(level)
+        x0, y1 = mercator(south, west)
+        x1, y0 = mercator(north, east)
+        cx0, cx1 = int(math.floor(x0 * n)), int(math.floor(x1 * n))
+        cy0, cy1 = int(math.floor(y0 * n)), int(math.floor(y1 * n))
+        if west <= east:
+            in_x = cells["cx"].between(cx0, cx1)
+        else:  # viewport crosses the antimeridian
+            in_x = (cells["cx"] >= cx0) | (cells["cx"] <= cx1)
+        cells = cells[in_x & cells["cy"].between(cy0, cy1)]
+    if len(cells) > max_cells:
+        cells = cells.nlargest(max_cells, "cases")
+    cells = cells.reset_index(drop=True)
+    south, west, north, east = cell_bounds(level, cells["cx"], cells["cy"])
+    return cells.assign(level=level, south=south, west=west, north=north, east=east)
+
+
+def recent_epicenters(window_days=14, eps_meters=2000, min_samples=3):
+    """DBSCAN epicenters of cases with onset in the last window_days, kept up to date per data version."""
+    return _cache().refresh().epicenters_for(window_days, eps_meters, min_samples)
@@ -1,29 +1,198 @@
+"""
+train_model.py
 
-# LightGBM training scaffold for district-level risk scoring.
-# This script is a template: you'll need to provide a training dataset with features such as:
-# district, date, cases_last_7, population, population_density, rainfall, mobility_index, etc.
-# The script trains a simple LightGBM model and writes out a pickle model.
+LightGBM training pipeline for district-level risk scoring.
 
+The labelled training set is built straight from the cases table with the same
+district-week features score_districts.py scores (features.py), so training and
+scoring features cannot drift. A district-week is labelled high_risk (1) when the
+following week's 7-day count reaches the district's alert threshold from
+config.yaml (alerts.district_thresholds, else alerts.high_activity_threshold).
+
+The built matrix is cached on disk under feature_cache/, keyed by the case table
+version, population file, thresholds and feature version, so repeated experiments
+skip feature construction. Hyperparameters are chosen by expanding-window
+time-series cross-validation (folds split on whole weeks), with every
+(parameters, fold) fit run in parallel across a process pool.
+
+Usage:
+    python train_model.py
+    python train_model.py --folds 5 --workers 4 --no-cache
+"""
+import argparse
+import hashlib
+import itertools
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
 import pandas as pd
-import lightgbm as lgb
-import joblib
-from sklearn.model_selection import train_test_split
 from sklearn.metrics import roc_auc_score
+from sklearn.model_selection import TimeSeriesSplit
+
+from features import FEATURE_COLUMNS, FEATURE_VERSION, POPULATION_CSV, build_features, load_population, week_end
+from model_server import NATIVE_MODEL, save_model
+from settings import load_config
+from utils import _case_version, connection, init_db
+
+try:
+    import lightgbm as lgb
+except Exception:
+    lgb = None
+
+MODEL = NATIVE_MODEL
+FEATURE_CACHE_DIR = os.environ.get("SURVEILAI_FEATURE_CACHE", os.path.join(os.path.dirname(__file__), "feature_cache"))
+BASE_PARAMS = {"objective": "binary", "metric": "auc", "verbosity": -1}
+PARAM_GRID = {
+    "num_leaves": [15, 31],
+    "learning_rate": [0.05, 0.1],
+    "min_data_in_leaf": [20, 50],
+}
+NUM_BOOST_ROUND = 500
+EARLY_STOPPING_ROUNDS = 20
+
+
+# ---------- training set ----------
+def label_weeks(features, config=None):
+    """Add high_risk: next week's cases_7d reaches the district threshold. Drops weeks without a next week."""
+    alerts = (config or load_config()).alerts
+    df = features.sort_values(["district", "week_end"]).reset_index(drop=True)
+    nxt = df.groupby("district")["cases_7d"].shift(-1)
+    threshold = df["district"].map(alerts.threshold_for).astype(float)
+    df["high_risk"] = (nxt >= threshold).astype(int)
+    return df[nxt.notna()].reset_index(drop=True)
+
+
+def _file_digest(path):
+    if not path or not os.path.exists(path):
+        return ""
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def training_cache_key(end_week, population_path=POPULATION_CSV, config=None):
+    config = config or load_config()
+    with connection() as conn:
+        version = _case_version(conn)
+    parts = {
+        "feature_version": FEATURE_VERSION,
+        "case_version": version,
+        "end_week": str(end_week.date()),
+        "population": _file_digest(population_path),
+        "alerts": [config.alerts.high_activity_threshold, dict(config.alerts.district_thresholds)],
+    }
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def build_training_set(population_path=POPULATION_CSV, end_week=None, use_cache=True, cache_dir=FEATURE_CACHE_DIR):
+    """
+    Labelled district-week matrix (district, week_end, FEATURE_COLUMNS..., high_risk)
+    for every complete week, served from the on-disk cache when nothing changed.
+    """
+    config = load_config()
+    # the current week is still filling up, so the last labelled week ends a week earlier
+    end_week = week_end(end_week) if end_week is not None else week_end(pd.Timestamp.now()) - pd.Timedelta(days=7)
+    path = os.path.join(cache_dir, training_cache_key(end_week, population_path, config) + ".pkl")
+    if use_cache and os.path.exists(path):
+        return pd.read_pickle(path)
+    features = build_features(None, end_week, population=load_population(population_path))
+    df = label_weeks(features, config)
+    if use_cache:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = path + ".tmp"
+        df.to_pickle(tmp)
+        os.replace(tmp, path)
+    return df
+
+
+def week_folds(weeks, n_splits=5):
+    """Expanding-window (train_idx, valid_idx) row indices; folds never split a week."""
+    unique = np.sort(pd.unique(weeks))
+    n_splits = min(n_splits, len(unique) - 1)
+    if n_splits < 2:
+        raise ValueError("Not enough weeks of data for time-series cross-validation")
+    folds = []
+    for train_w, valid_w in TimeSeriesSplit(n_splits=n_splits).split(unique):
+        folds.append((np.flatnonzero(np.isin(weeks, unique[train_w])),
+                      np.flatnonzero(np.isin(weeks, unique[valid_w]))))
+    return folds
+
+
+# ---------- parallel cross-validation ----------
+_worker_data = {}
+
+
+def _init_worker(X, y):
+    # ship the matrix once per worker process instead of once per task
+    _worker_data["X"], _worker_data["y"] = X, y
+
+
+def _fit_fold(params, train_idx, valid_idx):
+    X, y = _worker_data["X"], _worker_data["y"]
+    train = lgb.Dataset(X.iloc[train_idx], label=y[train_idx])
+    valid = lgb.Dataset(X.iloc[valid_idx], label=y[valid_idx], reference=train)
+    bst = lgb.train({**BASE_PARAMS, **params}, train, num_boost_round=NUM_BOOST_ROUND, valid_sets=[valid],
+                    callbacks=[lgb.early_stopping(EARLY_STOPPING_ROUNDS, verbose=False)])
+    y_valid = y[valid_idx]
+    if len(np.unique(y_valid)) < 2:
+        return np.nan, bst.best_iteration
+    return roc_auc_score(y_valid, bst.predict(X.iloc[valid_idx], num_iteration=bst.best_iteration)), bst.best_iteration
+
+
+def param_candidates(grid=PARAM_GRID):
+    keys = sorted(grid)
+    return [dict(zip(keys, values)) for values in itertools.product(*(grid[k] for k in keys))]
+
+
+def cross_validate(df, grid=PARAM_GRID, n_splits=5, workers=None):
+    """
+    Score every parameter set on every fold in a process pool.
+    Returns a DataFrame with one row per parameter set: params, mean_auc, std_auc, best_iteration.
+    """
+    if lgb is None:
+        raise RuntimeError("Training requires lightgbm (pip install lightgbm)")
+    X = df[FEATURE_COLUMNS].astype(float)
+    y = df["high_risk"].to_numpy()
+    folds = week_folds(df["week_end"].to_numpy(), n_splits)
+    candidates = param_candidates(grid)
+    tasks = [(i, params, tr, va) for i, params in enumerate(candidates) for tr, va in folds]
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(X, y)) as pool:
+        futures = [(i, pool.submit(_fit_fold, params, tr, va)) for i, params, tr, va in tasks]
+        results = [(i, *f.result()) for i, f in futures]
+    res = pd.DataFrame(results, columns=["candidate", "auc", "best_iteration"])
+    summary = res.groupby("candidate").agg(mean_auc=("auc", "mean"), std_auc=("auc", "std"),
+                                           best_iteration=("best_iteration", "mean"))
+    summary["params"] = [candidates[i] for i in summary.index]
+    return summary.sort_values("mean_auc", ascending=False).reset_index(drop=True)
+
+
+def train(df, params, num_boost_round):
+    """Fit the final model on every labelled week."""
+    data = lgb.Dataset(df[FEATURE_COLUMNS].astype(float), label=df["high_risk"].to_numpy())
+    return lgb.train({**BASE_PARAMS, **params}, data, num_boost_round=max(int(num_boost_round), 1))
 
-# Load data - replace with your dataset path
-df = pd.read_csv("training_data.csv")  # expects label column 'high_risk' (0/1)
-features = [c for c in df.columns if c not in ['district','date','high_risk']]
 
-X = df[features]
-y = df['high_risk']
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Train the district risk model from surveilai.db")
+    parser.add_argument("--population", default=POPULATION_CSV)
+    parser.add_argument("--folds", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=None, help="process pool size (default: CPU count)")
+    parser.add_argument("--no-cache", action="store_true", help="rebuild the feature matrix")
+    parser.add_argument("--out", default=MODEL)
+    args = parser.parse_args(argv)
+    init_db()
+    df = build_training_set(args.population, use_cache=not args.no_cache)
+    print(f"{len(df)} district-weeks, {int(df['high_risk'].sum())} high-risk.")
+    summary = cross_validate(df, n_splits=args.folds, workers=args.workers)
+    best = summary.iloc[0]
+    print(summary[["params", "mean_auc", "std_auc", "best_iteration"]].to_string(index=False))
+    print("Best params:", best["params"], "CV AUC:", round(best["mean_auc"], 4))
+    bst = train(df, best["params"], round(best["best_iteration"]))
+    save_model(bst, args.out)
+    print("Saved model to", args.out)
+    return 0
 
-X_train, X_val, y_train, y_val = train_test_split(X,y,test_size=0.2,random_state=42)
-train_data = lgb.Dataset(X_train, label=y_train)
-val_data = lgb.Dataset(X_val, label=y_val, reference=train_data)
 
-params = {'objective':'binary','metric':'auc','verbosity':-1}
-bst = lgb.train(params, train_data, valid_sets=[val_data], early_stopping_rounds=20, num_boost_round=500)
-y_pred = bst.predict(X_val)
-print("AUC:", roc_auc_score(y_val, y_pred))
-joblib.dump(bst, "district_risk_model.pkl")
-print("Saved model to district_risk_model.pkl")
+if __name__ == "__main__":
+    raise SystemExit(main())
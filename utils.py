@@ -1,26 +1,126 @@
-
-import sqlite3, os, io, zipfile, yaml
+import sqlite3, os, threading, queue, itertools
+from collections import Counter
+from contextlib import contextmanager
 import pandas as pd
-import geopandas as gpd
-from shapely.geometry import Point
 from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime, timedelta
+from datetime import datetime, date, timedelta
 import numpy as np
-from sklearn.cluster import DBSCAN
+from geo import locator_for, load_boundaries_from_zip
+from clustering import cluster_points
+from classification import compile_rules
+from settings import ensure_config
+from instrumentation import timed
 
 DB = os.path.join(os.path.dirname(__file__), "surveilai.db")
 CONFIG = os.path.join(os.path.dirname(__file__), "config.yaml")
 
-def init_db():
-    conn = sqlite3.connect(DB)
-    c = conn.cursor()
-    c.execute("""CREATE TABLE IF NOT EXISTS users (
+# ---------- CONNECTIONS ----------
+# Connections are pooled per database path and handed out one per thread at a
+# time, so nested helpers (e.g. add_case inside a transaction) share the
+# caller's connection instead of contending for the write lock.
+POOL_SIZE = int(os.getenv("SURVEILAI_DB_POOL_SIZE", "8"))
+BUSY_TIMEOUT_MS = 30000
+PRAGMAS = [
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-20000",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA foreign_keys=ON",
+]
+
+_pools = {}
+_pools_lock = threading.Lock()
+_local = threading.local()
+
+def _open_conn(path):
+    # autocommit mode: transactions are opened explicitly by transaction()
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT_MS / 1000, isolation_level=None, check_same_thread=False)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+def _pool(path):
+    with _pools_lock:
+        if path not in _pools:
+            _pools[path] = queue.LifoQueue(maxsize=POOL_SIZE)
+        return _pools[path]
+
+@contextmanager
+def connection():
+    """Borrow a pooled connection to DB; re-entrant within a thread."""
+    held = getattr(_local, "held", None)
+    if held is not None and held[0] == DB:
+        yield held[1]
+        return
+    path = DB
+    pool = _pool(path)
+    try:
+        conn = pool.get_nowait()
+    except queue.Empty:
+        conn = _open_conn(path)
+    _local.held = (path, conn)
+    try:
+        yield conn
+    finally:
+        _local.held = None
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+@contextmanager
+def transaction():
+    """Run the block in a write transaction, joining an outer one if present."""
+    with connection() as conn:
+        if conn.in_transaction:
+            yield conn
+            return
+        # take the write lock up front so readers-turned-writers never deadlock
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+
+@contextmanager
+def read_snapshot(conn):
+    """Read in one consistent WAL snapshot, joining the caller's transaction if one is open."""
+    if conn.in_transaction:
+        yield conn
+        return
+    conn.execute("BEGIN")
+    try:
+        yield conn
+    finally:
+        conn.rollback()
+
+def close_pool(path=None):
+    """Close idle pooled connections (all databases when path is None)."""
+    with _pools_lock:
+        paths = [path] if path else list(_pools)
+        pools = [_pools.pop(p) for p in paths if p in _pools]
+    for pool in pools:
+        while True:
+            try:
+                pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+# ---------- SCHEMA ----------
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS users (
                 username TEXT PRIMARY KEY,
                 password TEXT,
                 name TEXT,
                 role TEXT DEFAULT 'user'
-                )""")
-    c.execute("""CREATE TABLE IF NOT EXISTS cases (
+                )""",
+    """CREATE TABLE IF NOT EXISTS cases (
                 case_id TEXT PRIMARY KEY,
                 name TEXT,
                 sex TEXT,
@@ -34,176 +134,615 @@ def init_db():
                 symptoms TEXT,
                 classification TEXT,
                 coords TEXT
-                )""")
-    c.execute("""CREATE TABLE IF NOT EXISTS thresholds (
+                )""",
+    """CREATE TABLE IF NOT EXISTS thresholds (
                 name TEXT PRIMARY KEY,
                 value REAL
-                )""")
-    conn.commit()
-    conn.close()
+                )""",
+]
+
+# Each entry upgrades the schema by one version (tracked in PRAGMA user_version).
+# Steps are SQL strings or callables taking the connection (for data backfills).
+# Append new steps; never edit or reorder released ones.
+MIGRATIONS = [
+    # 1: indexes for date/district filters used by the dashboard and scoring
+    [
+        "CREATE INDEX IF NOT EXISTS idx_cases_onset_date ON cases(onset_date)",
+        "CREATE INDEX IF NOT EXISTS idx_cases_district ON cases(district)",
+        "CREATE INDEX IF NOT EXISTS idx_cases_district_onset ON cases(district, onset_date)",
+    ],
+    # 2: monotonically increasing row versions + delete tombstones for incremental loads
+    [
+        "ALTER TABLE cases ADD COLUMN row_version INTEGER",
+        "UPDATE cases SET row_version = rowid",
+        "CREATE INDEX IF NOT EXISTS idx_cases_row_version ON cases(row_version)",
+        """CREATE TABLE IF NOT EXISTS case_version (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                version INTEGER NOT NULL
+                )""",
+        "INSERT OR IGNORE INTO case_version (id, version) VALUES (1, (SELECT IFNULL(MAX(rowid), 0) FROM cases))",
+        """CREATE TABLE IF NOT EXISTS case_tombstones (
+                case_id TEXT PRIMARY KEY,
+                row_version INTEGER NOT NULL
+                )""",
+        "CREATE INDEX IF NOT EXISTS idx_case_tombstones_version ON case_tombstones(row_version)",
+        """CREATE TRIGGER IF NOT EXISTS cases_version_insert AFTER INSERT ON cases
+           BEGIN
+               UPDATE case_version SET version = version + 1 WHERE id = 1;
+               UPDATE cases SET row_version = (SELECT version FROM case_version WHERE id = 1) WHERE rowid = NEW.rowid;
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS cases_version_update AFTER UPDATE ON cases
+           WHEN NEW.row_version IS OLD.row_version
+           BEGIN
+               UPDATE case_version SET version = version + 1 WHERE id = 1;
+               UPDATE cases SET row_version = (SELECT version FROM case_version WHERE id = 1) WHERE rowid = NEW.rowid;
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS cases_version_delete AFTER DELETE ON cases
+           BEGIN
+               UPDATE case_version SET version = version + 1 WHERE id = 1;
+               INSERT OR REPLACE INTO case_tombstones (case_id, row_version)
+                   VALUES (OLD.case_id, (SELECT version FROM case_version WHERE id = 1));
+           END""",
+    ],
+    # 3: epiweek/district/sex/age-band rollups maintained on write
+    [
+        """CREATE TABLE IF NOT EXISTS case_rollups (
+                year INTEGER NOT NULL,
+                epiweek INTEGER NOT NULL,
+                district TEXT NOT NULL,
+                sex TEXT NOT NULL,
+                age_band TEXT NOT NULL,
+                cases INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (year, epiweek, district, sex, age_band)
+                ) WITHOUT ROWID""",
+        lambda conn: _rebuild_rollups(conn),
+    ],
+    # 4: weekly district risk scores written by score_districts.py
+    [
+        """CREATE TABLE IF NOT EXISTS district_scores (
+                district TEXT NOT NULL,
+                week_end TEXT NOT NULL,
+                cases_7d INTEGER,
+                cases_14d INTEGER,
+                cases_28d INTEGER,
+                growth_7d REAL,
+                per_1000 REAL,
+                score REAL,
+                model TEXT,
+                scored_at TEXT,
+                PRIMARY KEY (district, week_end)
+                ) WITHOUT ROWID""",
+        "CREATE INDEX IF NOT EXISTS idx_district_scores_week ON district_scores(week_end)",
+    ],
+    # 5: notification outbox drained by notifications.Dispatcher
+    [
+        """CREATE TABLE IF NOT EXISTS notification_outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                channel TEXT NOT NULL,
+                recipient TEXT NOT NULL,
+                subject TEXT,
+                body TEXT NOT NULL,
+                dedup_key TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                created_at REAL NOT NULL,
+                sent_at REAL,
+                provider_id TEXT,
+                last_error TEXT
+                )""",
+        "CREATE INDEX IF NOT EXISTS idx_outbox_due ON notification_outbox(status, next_attempt_at)",
+        "CREATE INDEX IF NOT EXISTS idx_outbox_dedup ON notification_outbox(dedup_key, created_at)",
+    ],
+    # 6: per-district daily counters and alert episode state for alerts.py
+    [
+        """CREATE TABLE IF NOT EXISTS district_daily_counts (
+                district TEXT NOT NULL,
+                day TEXT NOT NULL,
+                cases INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (district, day)
+                ) WITHOUT ROWID""",
+        "CREATE INDEX IF NOT EXISTS idx_district_daily_day ON district_daily_counts(day)",
+        """CREATE TABLE IF NOT EXISTS alert_state (
+                district TEXT PRIMARY KEY,
+                active INTEGER NOT NULL DEFAULT 0,
+                episode INTEGER NOT NULL DEFAULT 0,
+                count INTEGER NOT NULL DEFAULT 0,
+                threshold REAL,
+                fired_at TEXT,
+                cleared_at TEXT,
+                updated_at TEXT
+                ) WITHOUT ROWID""",
+        """CREATE TABLE IF NOT EXISTS alert_events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                district TEXT NOT NULL,
+                episode INTEGER NOT NULL,
+                kind TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                threshold REAL,
+                window_start TEXT,
+                window_end TEXT,
+                created_at TEXT NOT NULL
+                )""",
+        lambda conn: _rebuild_daily_counts(conn),
+    ],
+    # 7: key/value watermarks for external sync jobs (firebase_integration.py)
+    [
+        """CREATE TABLE IF NOT EXISTS sync_state (
+                key TEXT PRIMARY KEY,
+                value TEXT
+                )""",
+    ],
+    # 8: likely duplicate reports (dedup.py); case_id is the later report
+    [
+        """CREATE TABLE IF NOT EXISTS case_duplicates (
+                case_id TEXT NOT NULL,
+                duplicate_of TEXT NOT NULL,
+                score REAL NOT NULL,
+                status TEXT NOT NULL DEFAULT 'flagged',
+                created_at TEXT NOT NULL,
+                PRIMARY KEY (case_id, duplicate_of)
+                )""",
+        "CREATE INDEX IF NOT EXISTS idx_case_duplicates_of ON case_duplicates(duplicate_of)",
+        "CREATE INDEX IF NOT EXISTS idx_case_duplicates_status ON case_duplicates(status)",
+    ],
+    # 9: epidemiological links to confirmed cases (epilink.py), labelled for existing cases
+    [
+        lambda conn: _add_column(conn, "cases", "epi_link", "INTEGER NOT NULL DEFAULT 0"),
+        lambda conn: _add_column(conn, "cases", "epi_link_of", "TEXT"),
+        "CREATE INDEX IF NOT EXISTS idx_cases_epi_link_of ON cases(epi_link_of)",
+        "CREATE INDEX IF NOT EXISTS idx_cases_confirmed_onset ON cases(onset_date) WHERE lab_positive != 0",
+        lambda conn: _link_existing(conn),
+    ],
+    # 10: ids of archived cases (archive.py), so a re-sent case is not inserted and counted twice
+    [
+        """CREATE TABLE IF NOT EXISTS archived_cases (
+                case_id TEXT PRIMARY KEY,
+                year INTEGER NOT NULL,
+                epiweek INTEGER NOT NULL
+                ) WITHOUT ROWID""",
+        lambda conn: _index_archived(conn),
+    ],
+    # 11: which dispatcher claimed an outbox row and when, so only stale claims are taken over
+    [
+        "ALTER TABLE notification_outbox ADD COLUMN claimed_by TEXT",
+        "ALTER TABLE notification_outbox ADD COLUMN claimed_at REAL",
+    ],
+]
+
+_initialized = set()
+
+def _add_column(conn, table, column, declaration):
+    # some older databases already carry a hand-made column of the same name
+    if column not in [r[1] for r in conn.execute(f"PRAGMA table_info({table})")]:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+
+def migrate(conn):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for target, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # re-check under the write lock in case another process migrated first
+            if conn.execute("PRAGMA user_version").fetchone()[0] >= target:
+                conn.rollback()
+                continue
+            for stmt in statements:
+                if callable(stmt):
+                    stmt(conn)
+                else:
+                    conn.execute(stmt)
+            conn.execute(f"PRAGMA user_version = {target}")
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+
+def init_db():
+    if DB not in _initialized or not os.path.exists(DB):
+        with connection() as conn:
+            for stmt in SCHEMA:
+                conn.execute(stmt)
+            migrate(conn)
+        _initialized.add(DB)
     # ensure config file exists
-    if not os.path.exists(CONFIG):
-        default = {
-            'classification_rules': {
-                'confirmed': {'lab_positive': True},
-                'probable': {'symptoms_required': ['fever','cough'], 'epidemiological_link_required': False},
-                'suspected': {}
-            },
-            'alerts': {
-                'recent_days': 7,
-                'high_activity_threshold': 10
-            }
-        }
-        with open(CONFIG,'w') as f:
-            yaml.dump(default, f)
+    ensure_config(CONFIG)
 
 def create_user(username, password, name, role='user'):
-    conn = sqlite3.connect(DB)
-    c = conn.cursor()
     try:
         hashed = generate_password_hash(password)
-        c.execute("INSERT INTO users (username,password,name,role) VALUES (?, ?, ?, ?)", (username, hashed, name, role))
-        conn.commit()
+        with transaction() as conn:
+            conn.execute("INSERT INTO users (username,password,name,role) VALUES (?, ?, ?, ?)", (username, hashed, name, role))
         return True, "Account created. Please login."
     except Exception as e:
         return False, str(e)
-    finally:
-        conn.close()
 
+@timed("db")
 def get_user(username):
-    conn = sqlite3.connect(DB)
-    c = conn.cursor()
-    c.execute("SELECT username,password,name,role FROM users WHERE username=?", (username,))
-    row = c.fetchone()
-    conn.close()
+    with connection() as conn:
+        row = conn.execute("SELECT username,password,name,role FROM users WHERE username=?", (username,)).fetchone()
     if row:
         return {"username": row[0], "password": row[1], "name": row[2], "role": row[3]}
     return None
 
+@timed("db")
 def get_all_users():
-    conn = sqlite3.connect(DB)
-    df = pd.read_sql_query("SELECT username,name,role FROM users", conn)
-    conn.close()
-    return df
+    with connection() as conn:
+        return pd.read_sql_query("SELECT username,name,role FROM users", conn)
 
 def set_user_role(username, role):
-    conn = sqlite3.connect(DB)
-    c = conn.cursor()
-    c.execute("UPDATE users SET role=? WHERE username=?", (role, username))
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        conn.execute("UPDATE users SET role=? WHERE username=?", (role, username))
 
 def check_password(password, hashed):
     return check_password_hash(hashed, password)
 
+CASE_COLUMNS = ['case_id', 'name', 'sex', 'age', 'reporter', 'region', 'district', 'community',
+                'onset_date', 'lab_positive', 'symptoms', 'classification', 'coords']
+AGE_BINS = [0, 4, 9, 14, 24, 44, 64, 120]
+AGE_LABELS = ["0-4", "5-9", "10-14", "15-24", "25-44", "45-64", "65+"]
+_INSERT_CASE = "INSERT {verb} INTO cases ({cols}) VALUES ({marks})"
+BULK_BATCH_SIZE = 5000
+
+def _sql_value(value):
+    # sqlite3 only adapts exact builtin types; pandas/numpy scalars and dates need converting
+    if isinstance(value, float) and value != value:
+        return None  # NaN from pandas; sqlite would store NULL anyway
+    if value is None or isinstance(value, (str, int, float)) and not isinstance(value, bool):
+        return value
+    if isinstance(value, (bool, np.bool_)):
+        return int(value)
+    if isinstance(value, (datetime, date)):
+        if pd.isna(value):
+            return None
+        if isinstance(value, datetime) and value.time() == datetime.min.time():
+            value = value.date()
+        return value.isoformat()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+def _case_params(entry):
+    return tuple(_sql_value(entry.get(c)) for c in CASE_COLUMNS)
+
+def _insert_case_sql(on_conflict='abort'):
+    verb = {'abort': '', 'ignore': 'OR IGNORE', 'replace': 'OR REPLACE'}[on_conflict]
+    return _INSERT_CASE.format(verb=verb, cols=",".join(CASE_COLUMNS), marks=",".join("?" * len(CASE_COLUMNS)))
+
+@timed("db")
 def add_case(entry):
-    conn = sqlite3.connect(DB)
-    c = conn.cursor()
-    c.execute("""INSERT INTO cases (case_id,name,sex,age,reporter,region,district,community,onset_date,lab_positive,symptoms,classification,coords)
-                 VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)""",
-              (entry.get('case_id'), entry.get('name'), entry.get('sex'), entry.get('age'), entry.get('reporter'),
-               entry.get('region'), entry.get('district'), entry.get('community'), entry.get('onset_date'),
-               entry.get('lab_positive'), entry.get('symptoms'), entry.get('classification'), entry.get('coords')))
-    conn.commit()
-    conn.close()
-
-def query_summary():
-    conn = sqlite3.connect(DB)
-    df = pd.read_sql_query("SELECT * FROM cases", conn)
-    conn.close()
-    if 'onset_date' in df.columns:
+    with transaction() as conn:
+        version_before = _case_version(conn)
+        params = _case_params(entry)
+        if _archived_ids(conn, [params[0]]):
+            raise sqlite3.IntegrityError(f"case {params[0]} is already archived")
+        conn.execute(_insert_case_sql(), params)
+        # count the values as stored, so missing values from pandas (NaN) land in the same buckets as NULL
+        touched = _apply_counters(conn, [tuple(params[CASE_COLUMNS.index(c)] for c in ('onset_date', 'district', 'sex', 'age'))])
+        _after_write(conn, touched, version_before)
+
+@timed("db")
+def add_cases_bulk(entries, batch_size=BULK_BATCH_SIZE, on_conflict='abort'):
+    """
+    Insert an iterable of case dicts in one transaction, batch_size rows per executemany.
+    on_conflict: 'abort' (default, whole load rolls back on a duplicate case_id),
+    'ignore' (keep existing rows) or 'replace'. Returns the number of rows written.
+    Archived weeks are closed: ids already in the archive abort the load, or are
+    skipped with 'ignore' and 'replace'.
+    The iterable is consumed lazily, so generators of any length are fine.
+    """
+    sql = _insert_case_sql(on_conflict)
+    it = iter(entries)
+    touched = set()
+    with transaction() as conn:
+        version_before = _case_version(conn)
+        while True:
+            batch = [_case_params(e) for e in itertools.islice(it, batch_size)]
+            if not batch:
+                break
+            archived = _archived_ids(conn, [p[0] for p in batch])
+            if archived:
+                if on_conflict == 'abort':
+                    raise sqlite3.IntegrityError(f"case {sorted(archived)[0]} is already archived")
+                batch = [p for p in batch if p[0] not in archived]
+            if on_conflict == 'replace':
+                # rows about to be replaced leave the rollups before their successors enter
+                touched |= _apply_counters(conn, _select_rollup_fields(conn, [p[0] for p in batch]), sign=-1)
+            conn.executemany(sql, batch)
+        # count exactly the rows that landed (ignored duplicates have no new row_version);
+        # total_changes would also count the rows written by the row_version triggers
+        landed = conn.execute("SELECT onset_date, district, sex, age FROM cases WHERE row_version > ?",
+                              (version_before,)).fetchall()
+        written = len(landed)
+        touched |= _apply_counters(conn, landed)
+        _after_write(conn, touched, version_before)
+    return written
+
+def _after_write(conn, districts, version_before):
+    # flag duplicates, link and evaluate alerts inside the writing transaction, so each happens exactly once
+    from dedup import on_cases_written as flag_duplicates  # dedup imports utils
+    flag_duplicates(conn, version_before)
+    # after dedup: relinking bumps row_version of existing cases, which dedup would take for new rows
+    from epilink import on_cases_written as link_cases  # epilink imports utils
+    link_cases(conn, version_before)
+    if districts:
+        from alerts import on_cases_written  # alerts imports utils
+        on_cases_written(conn, districts)
+
+def _index_archived(conn):
+    from archive import index_archived_ids  # archive imports utils
+    index_archived_ids(conn)
+
+def _archived_ids(conn, case_ids):
+    """The subset of case_ids that already live in the Parquet archive."""
+    found = set()
+    for i in range(0, len(case_ids), 500):
+        chunk = case_ids[i:i + 500]
+        found.update(r[0] for r in conn.execute(
+            f"SELECT case_id FROM archived_cases WHERE case_id IN ({','.join('?' * len(chunk))})", chunk))
+    return found
+
+def _link_existing(conn):
+    from epilink import relink_all  # epilink imports utils
+    relink_all(conn)
+
+def _case_version(conn):
+    row = conn.execute("SELECT version FROM case_version WHERE id = 1").fetchone()
+    return row[0] if row else 0
+
+def _select_rollup_fields(conn, case_ids):
+    rows = []
+    for i in range(0, len(case_ids), 500):
+        chunk = case_ids[i:i + 500]
+        rows += conn.execute(
+            f"SELECT onset_date, district, sex, age FROM cases WHERE case_id IN ({','.join('?' * len(chunk))})",
+            chunk).fetchall()
+    return rows
+
+# ---------- ROLLUPS ----------
+def _age_band(age):
+    try:
+        age = int(float(age))
+    except (TypeError, ValueError):
+        return "Unknown"
+    for upper, label in zip(AGE_BINS[1:], AGE_LABELS):
+        if 0 <= age <= upper:
+            return label
+    return "Unknown"
+
+def _iso_week(onset):
+    if isinstance(onset, str):
         try:
-            df['onset_date'] = pd.to_datetime(df['onset_date'])
-        except:
-            pass
+            onset = datetime.fromisoformat(onset.strip())
+        except ValueError:
+            return 0, 0
+    if onset is None or pd.isna(onset):
+        return 0, 0
+    iso = onset.isocalendar()
+    return iso[0], iso[1]
+
+def rollup_key(onset_date, district, sex, age):
+    """(year, epiweek, district, sex, age_band) bucket for one case; unknown dates map to week 0."""
+    year, week = _iso_week(onset_date)
+    return (year, week, district or "", sex or "Unknown", _age_band(age))
+
+def onset_day(onset_date):
+    """'YYYY-MM-DD' for an onset date (str, date or Timestamp), or None when unknown."""
+    if onset_date is None or not isinstance(onset_date, str) and pd.isna(onset_date):
+        return None
+    day = str(_sql_value(onset_date))[:10]
+    try:
+        date.fromisoformat(day)
+    except ValueError:
+        return None
+    return day
+
+def _apply_counters(conn, rows, sign=1):
+    """Update rollups and district daily counts for written (sign=1) or removed rows; returns districts touched."""
+    rollups, daily = Counter(), Counter()
+    for onset, district, sex, age in rows:
+        rollups[rollup_key(onset, district, sex, age)] += 1
+        day = onset_day(onset)
+        if district and day:
+            daily[(district, day)] += 1
+    _upsert_rollups(conn, rollups, sign)
+    _upsert_daily_counts(conn, daily, sign)
+    return {d for d, _ in daily}
+
+def _upsert_daily_counts(conn, counts, sign=1):
+    if not counts:
+        return
+    conn.executemany("""INSERT INTO district_daily_counts (district, day, cases) VALUES (?,?,?)
+                        ON CONFLICT (district, day) DO UPDATE SET cases = cases + excluded.cases""",
+                     [k + (sign * n,) for k, n in counts.items()])
+    if sign < 0:
+        conn.execute("DELETE FROM district_daily_counts WHERE cases <= 0")
+
+def _rebuild_daily_counts(conn):
+    conn.execute("DELETE FROM district_daily_counts")
+    conn.execute("""INSERT INTO district_daily_counts (district, day, cases)
+                    SELECT district, substr(onset_date, 1, 10), COUNT(*) FROM cases
+                    WHERE district IS NOT NULL AND district != '' AND date(substr(onset_date, 1, 10)) IS NOT NULL
+                    GROUP BY district, substr(onset_date, 1, 10)""")
+    daily = Counter((d, onset_day(o)) for o, d, _, _ in _archived_fields(conn))
+    _upsert_daily_counts(conn, Counter({k: n for k, n in daily.items() if k[0] and k[1]}))
+
+def _archived_fields(conn):
+    # archived cases still count towards rollups and daily counters
+    from archive import archived_fields  # archive imports utils
+    return archived_fields(conn)
+
+def _counted_fields(conn):
+    """(onset_date, district, sex, age) of every hot and archived case."""
+    yield from conn.execute("SELECT onset_date, district, sex, age FROM cases")
+    yield from _archived_fields(conn)
+
+def _apply_rollups(conn, rows, sign=1):
+    _upsert_rollups(conn, Counter(rollup_key(*r) for r in rows), sign)
+
+def _upsert_rollups(conn, counts, sign=1):
+    if not counts:
+        return
+    conn.executemany("""INSERT INTO case_rollups (year, epiweek, district, sex, age_band, cases) VALUES (?,?,?,?,?,?)
+                        ON CONFLICT (year, epiweek, district, sex, age_band) DO UPDATE SET cases = cases + excluded.cases""",
+                     [k + (sign * n,) for k, n in counts.items()])
+    if sign < 0:
+        conn.execute("DELETE FROM case_rollups WHERE cases <= 0")
+
+def _rebuild_rollups(conn):
+    conn.execute("DELETE FROM case_rollups")
+    _apply_rollups(conn, _counted_fields(conn))
+
+@timed("db")
+def rebuild_rollups(check_only=False):
+    """
+    Recompute rollups from the raw cases (hot table and archive) and compare with the stored ones.
+    Returns a DataFrame of mismatched buckets (empty when consistent). Unless
+    check_only is set, the stored rollups are then replaced with the recomputed ones.
+    """
+    with transaction() as conn:
+        expected = Counter(rollup_key(*r) for r in _counted_fields(conn))
+        stored = {tuple(r[:5]): r[5] for r in conn.execute(
+            "SELECT year, epiweek, district, sex, age_band, cases FROM case_rollups")}
+        diffs = [k + (stored.get(k, 0), expected.get(k, 0)) for k in set(stored) | set(expected)
+                 if stored.get(k, 0) != expected.get(k, 0)]
+        if not check_only:
+            _rebuild_rollups(conn)
+    return pd.DataFrame(sorted(diffs), columns=['year', 'epiweek', 'district', 'sex', 'age_band', 'stored', 'expected'])
+
+ROLLUP_DIMENSIONS = ('year', 'epiweek', 'district', 'sex', 'age_band')
+
+@timed("db")
+def query_rollups(group_by=('year', 'epiweek'), district=None):
+    """Sum case_rollups over the given dimensions, optionally for one district."""
+    dims = [d for d in group_by if d in ROLLUP_DIMENSIONS]
+    if len(dims) != len(group_by):
+        raise ValueError(f"group_by must be drawn from {ROLLUP_DIMENSIONS}")
+    cols = ", ".join(dims)
+    sql = f"SELECT {cols + ', ' if cols else ''}SUM(cases) AS cases FROM case_rollups"
+    params = ()
+    if district is not None:
+        sql += " WHERE district = ?"
+        params = (district,)
+    if cols:
+        sql += f" GROUP BY {cols} ORDER BY {cols}"
+    with connection() as conn:
+        return pd.read_sql_query(sql, conn, params=params)
+
+@timed("db")
+def query_district_scores(week_end=None, district=None):
+    """Stored district risk scores; week_end='latest' returns only the most recent scored week."""
+    sql, where, params = "SELECT * FROM district_scores", [], []
+    if week_end == 'latest':
+        where.append("week_end = (SELECT MAX(week_end) FROM district_scores)")
+    elif week_end is not None:
+        where.append("week_end = ?")
+        params.append(str(week_end)[:10])
+    if district is not None:
+        where.append("district = ?")
+        params.append(district)
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY week_end, score DESC"
+    with connection() as conn:
+        return pd.read_sql_query(sql, conn, params=params)
+
+@timed("db")
+def query_summary(start=None, end=None, include_archive=True):
+    """Cases from the hot table and the Parquet archive (archive.py), optionally limited to onset dates in [start, end]."""
+    from archive import query_cases  # archive imports utils
+    return query_cases(start, end, include_archive=include_archive)
+
+def _type_cases(df):
+    # parse once when rows enter the cache; derived columns are reused by every rerun
+    df['onset_date'] = pd.to_datetime(df['onset_date'], format='ISO8601', errors='coerce')
+    df['age'] = pd.to_numeric(df['age'], errors='coerce')
+    df['lab_positive'] = pd.to_numeric(df['lab_positive'], errors='coerce')
+    iso = df['onset_date'].dt.isocalendar()
+    df['year'] = iso['year']
+    df['epiweek'] = iso['week']
+    df['age_group'] = pd.cut(df['age'], bins=[-1] + AGE_BINS[1:], labels=AGE_LABELS, right=True)
     return df
 
+class _CaseFrame:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.df = None
+        self.version = -1
+
+    def refresh(self, conn):
+        with self.lock:
+            # uncommitted rows seen inside a caller's transaction may still roll back: don't cache them
+            joined = conn.in_transaction
+            # one read transaction = one consistent WAL snapshot for all three queries
+            with read_snapshot(conn):
+                version = conn.execute("SELECT version FROM case_version WHERE id = 1").fetchone()[0]
+                if self.df is not None and version == self.version:
+                    return self.df
+                if self.df is None:
+                    df = _type_cases(pd.read_sql_query("SELECT * FROM cases ORDER BY row_version", conn))
+                else:
+                    deleted = [r[0] for r in conn.execute(
+                        "SELECT case_id FROM case_tombstones WHERE row_version > ?", (self.version,))]
+                    changed = _type_cases(pd.read_sql_query(
+                        "SELECT * FROM cases WHERE row_version > ? ORDER BY row_version", conn, params=(self.version,)))
+                    df = self.df
+                    stale = df['case_id'].isin(deleted) | df['case_id'].isin(changed['case_id'])
+                    if stale.any():
+                        df = df[~stale]
+                    if not changed.empty:
+                        df = pd.concat([df, changed], ignore_index=True) if not df.empty else changed
+                    elif stale.any():
+                        df = df.reset_index(drop=True)
+            if not joined:
+                self.df, self.version = df, version
+            return df
+
+_case_frames = {}
+
+@timed("db")
+def load_cases():
+    """
+    Return the shared, typed cases DataFrame, fetching only rows added, changed or
+    deleted since the last call (tracked by row_version). The frame is shared by
+    all sessions in this process: treat it as read-only and copy before mutating.
+    """
+    with _pools_lock:
+        frame = _case_frames.setdefault(DB, _CaseFrame())
+    with connection() as conn:
+        return frame.refresh(conn)
+
+def invalidate_cases(path=None):
+    """Drop the cached case frame so the next load_cases() does a full reload."""
+    with _pools_lock:
+        _case_frames.pop(path or DB, None)
+
+@timed("geo")
 def load_shapefile_from_zip(zipped_file):
-    # zipped_file is a UploadedFile
-    bytes_data = zipped_file.read()
-    z = zipfile.ZipFile(io.BytesIO(bytes_data))
-    tmpdir = os.path.join(os.path.dirname(__file__), "tmp_shp")
-    if os.path.exists(tmpdir):
-        import shutil
-        shutil.rmtree(tmpdir)
-    os.makedirs(tmpdir, exist_ok=True)
-    z.extractall(tmpdir)
-    shp = None
-    for root,_,files in os.walk(tmpdir):
-        for f in files:
-            if f.endswith(".shp"):
-                shp = os.path.join(root, f)
-                break
-    if not shp:
-        raise ValueError("No .shp file found in zip")
-    gdf = gpd.read_file(shp)
-    # ensure consistent crs
-    if gdf.crs is None:
-        gdf.set_crs(epsg=4326, inplace=True)
-    else:
-        gdf = gdf.to_crs(epsg=4326)
+    # zipped_file is a UploadedFile; boundaries are cached by content hash (see geo.py)
+    _, gdf = load_boundaries_from_zip(zipped_file.read())
     return gdf
 
+@timed("geo")
 def assign_district_from_point(lat, lon, gdf):
     # returns metadata dict with region/district/community if found
-    pt = Point(lon, lat)
-    # ensure same crs
-    if gdf.crs is None:
-        gdf.set_crs(epsg=4326, inplace=True)
-    else:
-        gdf = gdf.to_crs(epsg=4326)
-    matches = gdf[gdf.contains(pt)]
-    if matches.empty:
-        return {}
-    # pick first match and try common fields
-    r = matches.iloc[0]
-    out = {}
-    for candidate in ['district','District','NAME_2','ADM2_NAME','ADM1_NAME','region','Region']:
-        if candidate in r.index:
-            out['district'] = r[candidate]
-            break
-    for candidate in ['region','Region','ADM1_NAME','NAME_1']:
-        if candidate in r.index:
-            out['region'] = r[candidate]
-            break
-    for candidate in ['community','COMMUNITY','NAME_3']:
-        if candidate in r.index:
-            out['community'] = r[candidate]
-            break
-    return out
-
-def cluster_epicenters(df_coords, eps_meters=2000, min_samples=3, time_window_days=None):
+    return locator_for(gdf).locate(lat, lon)
+
+@timed("geo")
+def assign_districts(lats, lons, gdf):
+    """Vectorized assign_district_from_point: DataFrame of district/region/community per point."""
+    return locator_for(gdf).assign_districts(lats, lons)
+
+@timed("clustering")
+def cluster_epicenters(df_coords, eps_meters=2000, min_samples=3, time_window_days=None, eps_days=None):
     # df_coords: DataFrame with lat,lon and optional onset_date
+    # eps_days additionally requires neighbours to be within eps_days of each other (ST-DBSCAN);
+    # for rolling updates keep a clustering.ClusterEngine instead of calling this repeatedly
     if df_coords.shape[0] < 3:
         return []
-    coords_df = df_coords.copy()
-    # filter by time window if provided
-    if time_window_days is not None and 'onset_date' in coords_df.columns:
-        cutoff = pd.Timestamp.now() - pd.Timedelta(days=int(time_window_days))
-        coords_df = coords_df[coords_df['onset_date'] >= cutoff]
-        if coords_df.shape[0] < 3:
-            return []
-    # convert degrees to radians for haversine DBSCAN
-    coords = np.radians(coords_df[['lat','lon']].values)
-    kms_per_radian = 6371.0088
-    epsilon = eps_meters/1000.0 / kms_per_radian
-    clustering = DBSCAN(eps=epsilon, min_samples=min_samples, metric='haversine').fit(coords)
-    labels = clustering.labels_
-    clusters = []
-    for lbl in set(labels):
-        if lbl == -1:
-            continue
-        members = coords_df[labels==lbl]
-        # temporal weighting: compute mean date as timestamp and convert to iso
-        mean_date = None
-        if 'onset_date' in members.columns:
-            try:
-                mean_date = pd.to_datetime(members['onset_date']).mean()
-            except:
-                mean_date = None
-        clusters.append({'lat': float(members['lat'].mean()), 'lon': float(members['lon'].mean()),
-                         'count': int(len(members)), 'mean_date': str(mean_date)})
-    return clusters
+    if 'onset_date' not in df_coords.columns:
+        time_window_days = eps_days = None
+    return cluster_points(df_coords, eps_meters=eps_meters, min_samples=min_samples,
+                          time_window_days=time_window_days, eps_days=eps_days)
 
 
 def classify_case(entry, config_rules=None):
@@ -213,32 +752,47 @@ def classify_case(entry, config_rules=None):
     {
       'confirmed': {'lab_positive': True},
       'probable': {'symptoms_required': ['fever','cough'], 'epi_link_required': False},
-      'suspected': {}
+      'suspected': {'symptoms_required_any': ['fever']}
     }
     Entry keys: lab_positive (int/bool), symptoms (string semicolon or comma separated), epi_link (bool, optional)
+    Rules are compiled once per distinct config (see classification.py).
     """
-    if config_rules is None:
-        # fallback: basic rules
-        if entry.get('lab_positive'):
-            return "Confirmed"
-        if 'fever' in (entry.get('symptoms') or "").lower() and 'cough' in (entry.get('symptoms') or "").lower():
-            return "Probable"
-        return "Suspected"
-    # Confirmed
-    conf = config_rules.get('confirmed', {})
-    if conf.get('lab_positive') and entry.get('lab_positive'):
-        return "Confirmed"
-    # Probable
-    prob = config_rules.get('probable', {})
-    symptoms_required = [s.lower() for s in prob.get('symptoms_required', [])]
-    symptoms_present = [s.strip().lower() for s in (entry.get('symptoms') or "").replace(';',',').split(',') if s.strip()]
-    if symptoms_required:
-        if all(s in symptoms_present for s in symptoms_required):
-            # check epi link if required
-            if prob.get('epi_link_required'):
-                if entry.get('epi_link'):
-                    return "Probable"
-            else:
-                return "Probable"
-    # default
-    return "Suspected"
+    return compile_rules(config_rules).classify(entry)
+
+@timed("classification")
+def classify_cases(df, config_rules=None, case_definitions=None):
+    """Vectorized classify_case over a DataFrame; returns a Series of classifications."""
+    return compile_rules(config_rules, case_definitions).classify_frame(df)
+
+@timed("db")
+def reclassify_all(config_rules=None, case_definitions=None):
+    """Re-run classification over the whole cases table; returns the number of rows changed."""
+    with transaction() as conn:
+        return _reclassify(conn, None, config_rules, case_definitions)
+
+def _reclassify(conn, case_ids=None, config_rules=None, case_definitions=None):
+    """Reclassify the given cases (all when None) inside conn's transaction; returns the number changed."""
+    cols = [r[1] for r in conn.execute("PRAGMA table_info(cases)")]
+    wanted = [c for c in ('case_id', 'symptoms', 'lab_positive', 'epi_link', 'disease', 'classification') if c in cols]
+    sql = f"SELECT {', '.join(wanted)} FROM cases"
+    if case_ids is not None and len(case_ids) <= 20:
+        # a handful of rows (single inserts): per-row rules, no DataFrame
+        rules = compile_rules(config_rules, case_definitions)
+        rows = conn.execute(f"{sql} WHERE case_id IN ({','.join('?' * len(case_ids))})", list(case_ids)).fetchall()
+        changed = [(c, r[0]) for r in rows for c in [rules.classify(dict(zip(wanted, r)))] if c != r[-1]]
+        conn.executemany("UPDATE cases SET classification = ? WHERE case_id = ?", changed)
+        return len(changed)
+    if case_ids is None:
+        df = pd.read_sql_query(sql, conn)
+    else:
+        case_ids = list(case_ids)
+        chunks = [case_ids[i:i + 500] for i in range(0, len(case_ids), 500)]
+        df = pd.concat([pd.read_sql_query(f"{sql} WHERE case_id IN ({','.join('?' * len(c))})", conn, params=c)
+                        for c in chunks] or [pd.DataFrame(columns=wanted)], ignore_index=True)
+    if df.empty:
+        return 0
+    new = classify_cases(df, config_rules, case_definitions)
+    changed = new.to_numpy() != df['classification'].to_numpy()
+    conn.executemany("UPDATE cases SET classification = ? WHERE case_id = ?",
+                     zip(new[changed].tolist(), df.loc[changed, 'case_id'].tolist()))
+    return int(changed.sum())